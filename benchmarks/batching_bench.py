@@ -0,0 +1,111 @@
+#Messages/sec and latency of small peer messages under different write batching settings
+#  python benchmarks/batching_bench.py --messages 100000 --rate 5000 --batch-delay-ms 0 --batch-delay-ms 1 --batch-delay-ms 5
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'peer-client'))
+
+from client import TCPManager
+
+class BenchPeer:
+    def __init__(self, username):
+        self.username = username
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def run(port, nodelay, batch_delay, messages, size, rate):
+    TCPManager.TCP_NODELAY = nodelay
+    latencies = []
+    done = threading.Event()
+    expected = [messages]
+
+    def on_message(conn, message):
+        # Every message starts with its send timestamp
+        latencies.append(time.perf_counter() - float(message[:message.index(' ')]))
+        if len(latencies) == expected[0]:
+            done.set()
+
+    receiver = TCPManager(BenchPeer('receiver'))
+    receiver.message_handler = on_message
+    if not receiver.start_tcp_server(port):
+        raise SystemExit(f"Cannot listen on port {port}")
+    sender = TCPManager(BenchPeer('sender'), batch_delay=batch_delay)
+    conn = sender.connect_to_peer('127.0.0.1', port, 'sender')
+    padding = 'x' * size
+
+    # Burst: as fast as the sender can queue
+    writes_before = conn.writes
+    start = time.perf_counter()
+    for _ in range(messages):
+        sender.send_message(conn, f"{time.perf_counter()} {padding}")
+    done.wait(timeout=120)
+    burst_elapsed = time.perf_counter() - start
+    burst_writes = conn.writes - writes_before
+    burst_count = len(latencies)
+
+    # Paced: a steady rate, where batching trades latency for fewer syscalls
+    paced = max(1, min(messages, rate * 2))
+    latencies.clear()
+    done.clear()
+    expected[0] = paced
+    writes_before = conn.writes
+    start = time.perf_counter()
+    for i in range(paced):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        sender.send_message(conn, f"{time.perf_counter()} {padding}")
+    done.wait(timeout=120)
+    paced_writes = conn.writes - writes_before
+
+    sender.stop()
+    receiver.stop()
+    return {
+        "tcp_nodelay": nodelay,
+        "batch_delay_ms": batch_delay * 1000,
+        "burst": {
+            "messages": burst_count,
+            "messages_per_s": round(burst_count / burst_elapsed, 1),
+            "messages_per_write": round(burst_count / max(burst_writes, 1), 1)
+        },
+        "paced": {
+            "rate": rate,
+            "messages": len(latencies),
+            "messages_per_write": round(len(latencies) / max(paced_writes, 1), 1),
+            "latency_ms": {
+                "p50": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+                "p99": round(percentile(latencies, 99) * 1000, 3) if latencies else None
+            }
+        }
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Write batching and Nagle micro-benchmark')
+    parser.add_argument('--port', type=int, default=8300, help='First loopback port to use')
+    parser.add_argument('--messages', type=int, default=50000, help='Messages in the burst phase')
+    parser.add_argument('--size', type=int, default=32, help='Message size in bytes')
+    parser.add_argument('--rate', type=int, default=2000, help='Messages per second in the paced phase')
+    parser.add_argument('--batch-delay-ms', type=float, action='append', help='Batching latency budget (repeatable, 0 = off)')
+    args = parser.parse_args()
+
+    results = []
+    port = args.port
+    with contextlib.redirect_stdout(io.StringIO()):
+        for nodelay in (False, True):
+            for delay_ms in args.batch_delay_ms or [0, 1, 5]:
+                results.append(run(port, nodelay, delay_ms / 1000, args.messages, args.size, args.rate))
+                port += 1
+    print(json.dumps({"benchmark": "batching", "results": results}, indent=2))
+
+if __name__ == '__main__':
+    main()
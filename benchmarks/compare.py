@@ -0,0 +1,45 @@
+#Compares two JSON benchmark reports and prints the relative change of every number
+#  python benchmarks/compare.py baseline.json current.json --threshold 10
+import argparse
+import json
+
+# Entries of a results list are matched on these fields rather than position
+KEY_FIELDS = ('endpoint', 'concurrency', 'group_size', 'message_size', 'tcp_nodelay', 'batch_delay_ms', 'peers')
+
+def flatten(value, path=''):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, f"{path}.{key}" if path else key)
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            label = index
+            if isinstance(item, dict) and any(k in item for k in KEY_FIELDS):
+                label = ','.join(f"{k}={item[k]}" for k in KEY_FIELDS if k in item)
+            yield from flatten(item, f"{path}[{label}]")
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield path, value
+
+def main():
+    parser = argparse.ArgumentParser(description='Diff two benchmark JSON reports')
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0, help='Only show changes of at least this many percent')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = dict(flatten(json.load(f)))
+    with open(args.current) as f:
+        current = dict(flatten(json.load(f)))
+
+    rows = []
+    for path, new in current.items():
+        old = baseline.get(path)
+        if old is None:
+            continue
+        change = (new - old) / old * 100 if old else (0.0 if new == old else float('inf'))
+        if abs(change) >= args.threshold:
+            rows.append({"metric": path, "baseline": old, "current": new, "change_pct": round(change, 1)})
+    print(json.dumps(rows, indent=2))
+
+if __name__ == '__main__':
+    main()
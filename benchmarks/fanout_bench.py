@@ -0,0 +1,109 @@
+#Group fan-out latency and throughput through TCPManager.send_group
+#  python benchmarks/fanout_bench.py --group-size 1 --group-size 8 --group-size 32 --messages 2000
+#  python benchmarks/fanout_bench.py --messages 500 --interval 0.001   # paced, latency without queueing
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'peer-client'))
+
+from client import TCPManager
+
+class BenchPeer:
+    def __init__(self, username):
+        self.username = username
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def run(port, group_size, messages, size, interval):
+    lock = threading.Lock()
+    arrivals = {}
+    delivered = [0]
+    done = threading.Event()
+
+    def on_group(conn, group, message):
+        # The message body starts with its sequence number
+        seq = int(message.split(':', 1)[0])
+        with lock:
+            count = arrivals.get(seq, 0) + 1
+            arrivals[seq] = count
+            if count == group_size:
+                completed[seq] = time.perf_counter()
+            delivered[0] += 1
+            if delivered[0] == group_size * messages:
+                done.set()
+
+    completed = {}
+    receivers = []
+    for i in range(group_size):
+        receiver = TCPManager(BenchPeer(f'receiver{i}'))
+        receiver.group_handler = on_group
+        if not receiver.start_tcp_server(port + i):
+            raise SystemExit(f"Cannot listen on port {port + i}")
+        receivers.append(receiver)
+    sender = TCPManager(BenchPeer('sender'))
+    conns = [sender.connect_to_peer('127.0.0.1', port + i, 'sender') for i in range(group_size)]
+
+    padding = 'x' * size
+    sent_at = {}
+    dropped = 0
+    start = time.perf_counter()
+    for seq in range(messages):
+        sent_at[seq] = time.perf_counter()
+        results = sender.send_group(conns, 'bench', f"{seq}:{padding}")
+        dropped += sum(1 for ok in results.values() if not ok)
+        if dropped:
+            # Dropped members would never complete; let the queues drain and stop
+            break
+        if interval:
+            time.sleep(interval)
+    done.wait(timeout=120)
+    elapsed = time.perf_counter() - start
+
+    sender.stop()
+    for receiver in receivers:
+        receiver.stop()
+    latencies = [completed[seq] - sent_at[seq] for seq in completed]
+    return {
+        "group_size": group_size,
+        "message_size": size,
+        "messages": len(completed),
+        "dropped": dropped,
+        "seconds": round(elapsed, 3),
+        "messages_per_s": round(len(completed) / elapsed, 1),
+        "deliveries_per_s": round(delivered[0] / elapsed, 1),
+        "fanout_latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+            "p99": round(percentile(latencies, 99) * 1000, 3) if latencies else None
+        }
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Group chat fan-out benchmark')
+    parser.add_argument('--port', type=int, default=8000, help='First loopback port to use')
+    parser.add_argument('--messages', type=int, default=2000, help='Messages per group size')
+    parser.add_argument('--size', type=int, default=64, help='Message size in bytes')
+    parser.add_argument('--interval', type=float, default=0,
+                        help='Seconds between messages; 0 sends a burst, so latency includes queueing')
+    parser.add_argument('--group-size', type=int, action='append', help='Receivers per group (repeatable)')
+    args = parser.parse_args()
+
+    results = []
+    port = args.port
+    with contextlib.redirect_stdout(io.StringIO()):
+        for group_size in args.group_size or [1, 2, 4, 8, 16, 32]:
+            results.append(run(port, group_size, args.messages, args.size, args.interval))
+            port += group_size
+    print(json.dumps({"benchmark": "fanout", "results": results}, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#Loopback throughput of the framed peer protocol through two TCPManagers
+#  python benchmarks/framing_bench.py --messages 200000 --size 64 --size 4096 --size 1048576
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'peer-client'))
+
+from client import TCPManager
+
+class BenchPeer:
+    def __init__(self, username):
+        self.username = username
+
+def run(port, messages, size):
+    received = [0, 0]
+    done = threading.Event()
+
+    def on_message(conn, message):
+        received[0] += 1
+        received[1] += len(message)
+        if received[0] == messages:
+            done.set()
+
+    server = TCPManager(BenchPeer('receiver'))
+    server.message_handler = on_message
+    if not server.start_tcp_server(port):
+        raise SystemExit(f"Cannot listen on port {port}")
+    sender = TCPManager(BenchPeer('sender'))
+    conn = sender.connect_to_peer('127.0.0.1', port, 'sender')
+
+    payload = 'x' * size
+    start = time.perf_counter()
+    for _ in range(messages):
+        if not sender.send_message(conn, payload):
+            break
+    done.wait(timeout=120)
+    elapsed = time.perf_counter() - start
+
+    sender.stop()
+    server.stop()
+    return {
+        "message_size": size,
+        "messages": received[0],
+        "seconds": round(elapsed, 3),
+        "messages_per_s": round(received[0] / elapsed, 1),
+        "mb_per_s": round(received[1] / elapsed / 1e6, 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Framed protocol loopback benchmark')
+    parser.add_argument('--port', type=int, default=7900, help='First loopback port to use')
+    parser.add_argument('--messages', type=int, default=50000, help='Messages per run (scaled down for large sizes)')
+    parser.add_argument('--size', type=int, action='append', help='Message size in bytes (repeatable)')
+    args = parser.parse_args()
+
+    results = []
+    # Keep the peers' connection chatter out of the JSON report
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i, size in enumerate(args.size or [64, 4096, 65536]):
+            # Keep every run to roughly the same number of bytes as the smallest one
+            count = max(100, min(args.messages, args.messages * 4096 // max(size, 4096)))
+            results.append(run(args.port + i, count, size))
+    print(json.dumps({"benchmark": "framing", "results": results}, indent=2))
+
+if __name__ == '__main__':
+    main()
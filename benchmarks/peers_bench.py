@@ -0,0 +1,132 @@
+#N TCPManager peers on loopback, each sending to its neighbours at once
+#  python benchmarks/peers_bench.py --peers 50 --fanout 4 --messages 2000 --size 128
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'peer-client'))
+
+from client import TCPManager
+
+class BenchPeer:
+    def __init__(self, username):
+        self.username = username
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def run(port, peers, fanout, messages, size):
+    fanout = min(fanout, peers - 1)
+    expected = peers * fanout * messages
+    lock = threading.Lock()
+    latencies = []
+    done = threading.Event()
+
+    def on_message(conn, message):
+        # Every message starts with its send timestamp
+        latency = time.perf_counter() - float(message[:message.index(' ')])
+        with lock:
+            latencies.append(latency)
+            if len(latencies) == expected:
+                done.set()
+
+    rss_start = rss_mb()
+    threads_start = threading.active_count()
+    managers = []
+    for i in range(peers):
+        manager = TCPManager(BenchPeer(f'peer{i}'))
+        manager.message_handler = on_message
+        if not manager.start_tcp_server(port + i):
+            raise SystemExit(f"Cannot listen on port {port + i}")
+        managers.append(manager)
+
+    # Peer i talks to the next `fanout` peers around the ring
+    connect_start = time.perf_counter()
+    links = []
+    for i, manager in enumerate(managers):
+        neighbours = [(i + k) % peers for k in range(1, fanout + 1)]
+        conns = [manager.get_connection(f'peer{j}', '127.0.0.1', port + j) for j in neighbours]
+        links.append([c for c in conns if c])
+    connect_elapsed = time.perf_counter() - connect_start
+    rss_connected = rss_mb()
+
+    padding = 'x' * size
+
+    def sender(manager, conns):
+        for _ in range(messages):
+            for conn in conns:
+                manager.send_message(conn, f"{time.perf_counter()} {padding}")
+
+    senders = [threading.Thread(target=sender, args=(managers[i], links[i])) for i in range(peers)]
+    start = time.perf_counter()
+    for thread in senders:
+        thread.start()
+    for thread in senders:
+        thread.join()
+    done.wait(timeout=300)
+    elapsed = time.perf_counter() - start
+    threads_running = threading.active_count()
+
+    for manager in managers:
+        manager.stop()
+    return {
+        "peers": peers,
+        "fanout": fanout,
+        "message_size": size,
+        "connections": sum(len(conns) for conns in links),
+        "connect_seconds": round(connect_elapsed, 3),
+        "messages": len(latencies),
+        "expected": expected,
+        "seconds": round(elapsed, 3),
+        "messages_per_s": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+            "p99": round(percentile(latencies, 99) * 1000, 3) if latencies else None
+        },
+        "threads": threads_running - threads_start,
+        "memory_mb": {
+            "rss_start": rss_start,
+            "rss_connected": rss_connected,
+            "rss_end": rss_mb()
+        }
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated peer mesh benchmark')
+    parser.add_argument('--port', type=int, default=9000, help='First loopback port to use')
+    parser.add_argument('--peers', type=int, default=20, help='Number of simulated peers')
+    parser.add_argument('--fanout', type=int, default=3, help='Neighbours each peer sends to')
+    parser.add_argument('--messages', type=int, default=1000, help='Messages per peer and neighbour')
+    parser.add_argument('--size', type=int, default=128, help='Message size in bytes')
+    parser.add_argument('--output', help='Also write the JSON report to this file')
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = run(args.port, args.peers, args.fanout, args.messages, args.size)
+    output = json.dumps(dict(benchmark="peers", **result), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#Load generator for the registry HTTP API (/register, /peers, /peerinfo)
+#  python benchmarks/registry_bench.py --directory-size 10000 --concurrency 1 --concurrency 16 --duration 5
+#  python benchmarks/registry_bench.py --url http://localhost:5000 --redis 127.0.0.1:6379
+#
+#Without --url the Flask app is served in-process on a threaded werkzeug
+#server. --redis fake (the default) runs a fakeredis TCP server in-process;
+#pass host:port to use a real redis-server instead. Benchmark peers are named
+#bench-<n> and are written to --redis-db (15 unless given), which --flush clears first.
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import threading
+import time
+
+import requests
+
+STUN_SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stun-server')
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def rss_mb():
+    # Current resident set size of this process, from /proc when available
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_fake_redis():
+    from fakeredis import TcpFakeServer
+
+    class NoDelayFakeServer(TcpFakeServer):
+        # redis-server disables Nagle on client sockets; without it pipelined
+        # replies stall on delayed ACKs and every MGET+ZMSCORE costs ~40 ms
+        def get_request(self):
+            sock, address = super().get_request()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock, address
+
+    port = free_port()
+    server = NoDelayFakeServer(('127.0.0.1', port), server_type='redis')
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return '127.0.0.1', port
+
+def start_app(redis_host, redis_port, redis_db):
+    # The app reads its Redis settings at import time
+    os.environ['REDIS_HOST'] = redis_host
+    os.environ['REDIS_PORT'] = str(redis_port)
+    os.environ['REDIS_DB'] = str(redis_db)
+    sys.path.insert(0, STUN_SERVER_DIR)
+    import logging
+    from werkzeug.serving import make_server
+    import app as registry
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    # Per-request INFO lines would dominate the measurement
+    logging.getLogger(registry.__name__).setLevel(logging.WARNING)
+    # As under gunicorn: the read cache only serves while its invalidation feed is up
+    registry.start_cache_invalidation()
+    port = free_port()
+    server = make_server('127.0.0.1', port, registry.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{port}", server
+
+def redis_memory(host, port, db):
+    import redis
+    try:
+        info = redis.Redis(host=host, port=port, db=db).info('memory')
+        return round(info['used_memory'] / 1024 / 1024, 1) if 'used_memory' in info else None
+    except (redis.RedisError, KeyError):
+        return None
+
+def seed_directory(url, size, batch=1000):
+    session = requests.Session()
+    for start in range(0, size, batch):
+        peers = [
+            {"username": f"bench-{i}", "ip": f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", "port": 5000 + i % 1000}
+            for i in range(start, min(size, start + batch))
+        ]
+        response = session.post(f"{url}/register/batch", json={"peers": peers}, timeout=60)
+        response.raise_for_status()
+
+def make_request(endpoint, session, url, size, page_size, etag):
+    user = f"bench-{random.randrange(size)}"
+    if endpoint == 'register':
+        i = int(user[6:])
+        return session.post(f"{url}/register", timeout=10, json={
+            "username": user, "ip": f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", "port": 5000 + i % 1000
+        })
+    if endpoint == 'peers':
+        return session.get(f"{url}/peers", params={"limit": page_size}, timeout=10)
+    if endpoint == 'peers_etag':
+        return session.get(f"{url}/peers", params={"limit": page_size},
+                           headers={"If-None-Match": etag[0]} if etag[0] else {}, timeout=10)
+    if endpoint == 'peerinfo':
+        return session.get(f"{url}/peerinfo", params={"username": user}, timeout=10)
+    raise ValueError(endpoint)
+
+def run_phase(url, endpoint, concurrency, duration, size, page_size):
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    etag = [None]
+    if endpoint == 'peers_etag':
+        etag[0] = requests.get(f"{url}/peers", params={"limit": page_size}, timeout=10).headers.get('ETag')
+    start_barrier = threading.Barrier(concurrency + 1)
+    deadline = [0]
+
+    def worker(n):
+        session = requests.Session()
+        samples = latencies[n]
+        start_barrier.wait()
+        while time.perf_counter() < deadline[0]:
+            started = time.perf_counter()
+            try:
+                response = make_request(endpoint, session, url, size, page_size, etag)
+                ok = response.status_code < 400
+            except requests.RequestException:
+                ok = False
+            samples.append(time.perf_counter() - started)
+            if not ok:
+                errors[n] += 1
+
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    deadline[0] = time.perf_counter() + duration
+    start = time.perf_counter()
+    start_barrier.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    samples = [s for per_thread in latencies for s in per_thread]
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": sum(errors),
+        "requests_per_s": round(len(samples) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(samples, 50) * 1000, 3) if samples else None,
+            "p99": round(percentile(samples, 99) * 1000, 3) if samples else None,
+            "max": round(max(samples) * 1000, 3) if samples else None
+        }
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Registry API benchmark')
+    parser.add_argument('--url', help='Benchmark a running server instead of an in-process one')
+    parser.add_argument('--redis', default='fake', help="'fake' for in-process fakeredis, or host:port")
+    parser.add_argument('--redis-db', type=int, default=15, help='Redis database used by the in-process server')
+    parser.add_argument('--flush', action='store_true', help='FLUSHDB the benchmark database before seeding')
+    parser.add_argument('--directory-size', type=int, default=1000, help='Peers registered before measuring')
+    parser.add_argument('--page-size', type=int, default=100, help='limit used for GET /peers')
+    parser.add_argument('--concurrency', type=int, action='append', help='Client threads (repeatable)')
+    parser.add_argument('--endpoint', action='append',
+                        choices=['register', 'peers', 'peers_etag', 'peerinfo'], help='Endpoints to drive (repeatable)')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds per endpoint and concurrency level')
+    parser.add_argument('--output', help='Also write the JSON report to this file')
+    args = parser.parse_args()
+
+    if args.redis == 'fake':
+        redis_host, redis_port = start_fake_redis()
+    else:
+        redis_host, _, port = args.redis.rpartition(':')
+        redis_port = int(port)
+    if args.flush:
+        import redis
+        redis.Redis(host=redis_host, port=redis_port, db=args.redis_db).flushdb()
+
+    rss_before = rss_mb()
+    url = args.url or start_app(redis_host, redis_port, args.redis_db)[0]
+    seed_directory(url, args.directory_size)
+
+    results = []
+    for endpoint in args.endpoint or ['register', 'peers', 'peers_etag', 'peerinfo']:
+        for concurrency in args.concurrency or [1, 8, 32]:
+            results.append(run_phase(url, endpoint, concurrency, args.duration, args.directory_size, args.page_size))
+
+    report = {
+        "benchmark": "registry",
+        "target": args.url or "in-process",
+        "redis": args.redis,
+        "directory_size": args.directory_size,
+        "page_size": args.page_size,
+        "results": results,
+        "memory_mb": {
+            # In-process runs include the load generator itself
+            "process_rss_before": rss_before,
+            "process_rss_after": rss_mb(),
+            "redis_used": redis_memory(redis_host, redis_port, args.redis_db)
+        }
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+if __name__ == '__main__':
+    main()
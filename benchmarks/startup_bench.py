@@ -0,0 +1,94 @@
+#Cold start of a swarm: N P2PClients run their auto-mode start-up at once
+#  python benchmarks/startup_bench.py --peers 50
+#  python benchmarks/startup_bench.py --url http://localhost:5000 --peers 200 --deadline 30
+#
+#Each client probes the server, binds its listener and registers (see
+#P2PClient.start); the report gives time-to-ready percentiles, the same per
+#start-up step, outcomes and retries. Without --url the app is served
+#in-process against fakeredis as in registry_bench.py.
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'peer-client'))
+
+from client import P2PClient
+from registry_bench import percentile, rss_mb, start_app, start_fake_redis
+
+def summary(samples):
+    if not samples:
+        return None
+    return {
+        "p50": round(percentile(samples, 50) * 1000, 1),
+        "p95": round(percentile(samples, 95) * 1000, 1),
+        "p99": round(percentile(samples, 99) * 1000, 1),
+        "max": round(max(samples) * 1000, 1)
+    }
+
+async def start_swarm(url, port, peers, deadline, stun_udp):
+    # Every blocking step runs in the default executor, so give it room for the whole swarm
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=peers * 3))
+    clients = [P2PClient(url, stun_udp=stun_udp) for _ in range(peers)]
+    start = time.perf_counter()
+    results = await asyncio.gather(*(
+        client.start(f"startup-{i}", port + i, deadline) for i, client in enumerate(clients)
+    ))
+    return clients, results, time.perf_counter() - start
+
+def run(url, port, peers, deadline, stun_udp):
+    threads_start = threading.active_count()
+    clients, results, elapsed = asyncio.run(start_swarm(url, port, peers, deadline, stun_udp))
+    threads_ready = threading.active_count()
+    reports = [client.startup_report for client in clients]
+    ready = [r['seconds'] for r in reports if r['outcome'] == 'ready']
+    outcomes = {}
+    for r in reports:
+        outcomes[r['outcome']] = outcomes.get(r['outcome'], 0) + 1
+    steps = {}
+    for r in reports:
+        for step, seconds in r['steps'].items():
+            steps.setdefault(step, []).append(seconds)
+    retries = sum(max(0, n - 1) for r in reports for n in r['attempts'].values())
+    for client, ok in zip(clients, results):
+        if ok:
+            client.unregister()
+    return {
+        "peers": peers,
+        "deadline_s": deadline,
+        "elapsed_s": round(elapsed, 3),
+        "outcomes": outcomes,
+        "time_to_ready_ms": summary(ready),
+        "steps_ms": {step: summary(samples) for step, samples in steps.items()},
+        "retries": retries,
+        "threads": threads_ready - threads_start,
+        "memory_mb": rss_mb()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Swarm start-up benchmark')
+    parser.add_argument('--url', help='Register with a running server instead of an in-process one')
+    parser.add_argument('--port', type=int, default=9500, help='First peer port to use')
+    parser.add_argument('--peers', type=int, default=20, help='Clients starting at once')
+    parser.add_argument('--deadline', type=float, default=30, help='Start-up budget per client in seconds')
+    parser.add_argument('--stun-udp', default='off', help="UDP STUN service host:port ('off' to skip discovery)")
+    parser.add_argument('--output', help='Also write the JSON report to this file')
+    args = parser.parse_args()
+
+    url = args.url or start_app(*start_fake_redis(), 15)[0]
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = run(url, args.port, args.peers, args.deadline, args.stun_udp)
+    output = json.dumps(dict(benchmark="startup", **result), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#Load generator for the UDP STUN binding service
+#  python benchmarks/stun_udp_bench.py --target 127.0.0.1:3478 --sockets 8 --window 32 --duration 10
+import argparse
+import json
+import os
+import selectors
+import socket
+import struct
+import time
+
+MAGIC_COOKIE = 0x2112A442
+HEADER = struct.Struct('!HHI12s')
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def run(host, port, sockets, window, duration):
+    sel = selectors.DefaultSelector()
+    pending = {}
+    latencies = []
+    sent = received = lost = 0
+
+    def send(sock):
+        nonlocal sent
+        txid = os.urandom(12)
+        sock.send(HEADER.pack(0x0001, 0, MAGIC_COOKIE, txid))
+        pending[txid] = time.perf_counter()
+        sent += 1
+
+    socks = []
+    for _ in range(sockets):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((host, port))
+        sock.setblocking(False)
+        sel.register(sock, selectors.EVENT_READ)
+        socks.append(sock)
+        for _ in range(window):
+            send(sock)
+
+    start = time.perf_counter()
+    deadline = start + duration
+    while time.perf_counter() < deadline:
+        events = sel.select(timeout=0.5)
+        if not events:
+            # Everything in flight was dropped; count it lost and refill the windows
+            lost += len(pending)
+            pending.clear()
+            for sock in socks:
+                for _ in range(window):
+                    send(sock)
+            continue
+        for key, _ in events:
+            sock = key.fileobj
+            while True:
+                try:
+                    data = sock.recv(2048)
+                except BlockingIOError:
+                    break
+                sent_at = pending.pop(data[8:20], None)
+                if sent_at is None:
+                    continue
+                latencies.append(time.perf_counter() - sent_at)
+                received += 1
+                send(sock)
+    elapsed = time.perf_counter() - start
+
+    for sock in socks:
+        sock.close()
+    return {
+        "benchmark": "stun_udp",
+        "target": f"{host}:{port}",
+        "sockets": sockets,
+        "window": window,
+        "duration_s": round(elapsed, 3),
+        "sent": sent,
+        "received": received,
+        "lost": lost,
+        "responses_per_s": round(received / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+            "p99": round(percentile(latencies, 99) * 1000, 3) if latencies else None
+        }
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='STUN binding load generator')
+    parser.add_argument('--target', default='127.0.0.1:3478', help='STUN service host:port')
+    parser.add_argument('--sockets', type=int, default=4, help='Client sockets (distinct source ports)')
+    parser.add_argument('--window', type=int, default=16, help='Requests in flight per socket')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds to run')
+    args = parser.parse_args()
+
+    host, _, port = args.target.rpartition(':')
+    print(json.dumps(run(host, int(port), args.sockets, args.window, args.duration), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#Loopback file transfer throughput through two TCPManagers
+#  python benchmarks/transfer_bench.py --size-mb 1024 --chunk-size 262144 --window 16
+#  python benchmarks/transfer_bench.py --size-mb 256 --interrupt   # drop the link halfway, then resume
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'peer-client'))
+
+import transfer
+from client import TCPManager
+
+class BenchPeer:
+    def __init__(self, username):
+        self.username = username
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def run(port, path, workdir, interrupt):
+    received = []
+    receiver = TCPManager(BenchPeer('receiver'))
+    receiver.download_dir = os.path.join(workdir, 'downloads')
+    receiver.file_handler = lambda conn, t: received.append(t)
+    if not receiver.start_tcp_server(port):
+        raise SystemExit(f"Cannot listen on port {port}")
+    sender = TCPManager(BenchPeer('sender'))
+
+    start = time.perf_counter()
+    conn = sender.connect_to_peer('127.0.0.1', port, 'sender')
+    outgoing = sender.send_file(conn, path)
+    resumed_from = 0
+    if interrupt:
+        while not outgoing.wait(0.001) and outgoing.acked < outgoing.size // 2:
+            pass
+        sender.call_soon(sender._close, conn, True)
+        outgoing.wait(10)
+        conn = sender.connect_to_peer('127.0.0.1', port, 'sender')
+        outgoing = sender.send_file(conn, path)
+    outgoing.wait(600)
+    elapsed = time.perf_counter() - start
+    resumed_from = outgoing.resumed_from or 0
+
+    sender.stop()
+    receiver.stop()
+    size = os.path.getsize(path)
+    return {
+        "size_mb": round(size / 1e6, 1),
+        "chunk_size": transfer.CHUNK_SIZE,
+        "window": transfer.WINDOW,
+        "state": outgoing.state,
+        "resumed_from": resumed_from,
+        "seconds": round(elapsed, 3),
+        "mb_per_s": round(size / elapsed / 1e6, 1),
+        "verified": bool(received) and file_digest(received[0].path) == file_digest(path)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Peer file transfer loopback benchmark')
+    parser.add_argument('--port', type=int, default=8100, help='Loopback port to use')
+    parser.add_argument('--size-mb', type=int, default=256, help='Size of the generated test file')
+    parser.add_argument('--chunk-size', type=int, default=transfer.CHUNK_SIZE, help='Bytes per FILE_CHUNK frame')
+    parser.add_argument('--window', type=int, default=transfer.WINDOW, help='Unacknowledged chunks in flight')
+    parser.add_argument('--interrupt', action='store_true', help='Close the connection halfway and resume')
+    args = parser.parse_args()
+
+    transfer.CHUNK_SIZE = args.chunk_size
+    transfer.WINDOW = TCPManager.FILE_WINDOW = args.window
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'payload.bin')
+        with open(path, 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = run(args.port, path, workdir, args.interrupt)
+    print(json.dumps(dict(benchmark="transfer", **result), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#asyncio front end for embedding the peer client in other programs
+#
+#    client = AsyncP2PClient('http://stun-server:5000')
+#    await client.register('alice', 5001)
+#    await client.send('bob', 'hello')
+#    async for message in client.messages():
+#        print(message.sender, message.text)
+#
+#The blocking P2PClient still does the work; its calls run in the default
+#executor and incoming frames are handed from the TCP event loop thread to
+#asyncio with call_soon_threadsafe.
+import asyncio
+import collections
+import time
+
+from client import P2PClient
+
+Message = collections.namedtuple('Message', 'kind sender group text path received_at')
+
+class MessageStream:
+    # Async iterator over incoming messages; one per messages() call
+    def __init__(self, owner, maxsize):
+        self.owner = owner
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # A consumer that falls behind loses its oldest messages, not the client
+            self.queue.get_nowait()
+            self.queue.put_nowait(message)
+            self.dropped += 1
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.queue.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def close(self):
+        self.owner.streams.discard(self)
+        self.put(None)
+
+class AsyncP2PClient:
+    def __init__(self, server_url=None, **options):
+        self.client = P2PClient(server_url, **options)
+        self.loop = None
+        self.callbacks = []
+        self.streams = set()
+        self.client.message_handler = self._on_text
+        self.client.group_handler = self._on_group
+        self.client.file_handler = self._on_file
+        self.client.mailbox_handler = self._on_stored
+
+    @property
+    def username(self):
+        return self.client.username
+
+    async def _call(self, func, *args):
+        self.loop = self.loop or asyncio.get_running_loop()
+        return await self.loop.run_in_executor(None, func, *args)
+
+    async def register(self, username, port):
+        self.loop = asyncio.get_running_loop()
+        return await self._call(self.client.register, username, port)
+
+    async def start(self, username, port, deadline=None):
+        # Auto-mode start-up with retries; see P2PClient.start
+        self.loop = asyncio.get_running_loop()
+        return await self.client.start(username, port, deadline)
+
+    async def unregister(self):
+        return await self._call(self.client.unregister)
+
+    async def peers(self):
+        return await self._call(self.client.list_peers)
+
+    async def peer_info(self, username):
+        return await self._call(self.client.lookup_peer, username)
+
+    async def send(self, username, text, store=True):
+        # True when queued to the peer, or stored on the server for an unreachable one
+        return await self._call(self.client.send_message, username, text, store)
+
+    async def send_group(self, usernames, group, text):
+        return await self._call(self.client.send_group, list(usernames), group, text)
+
+    async def send_file(self, username, path):
+        return await self._call(self.client.send_file, username, path)
+
+    def connections(self):
+        return self.client.tcp_manager.connection_states() if self.client.tcp_manager else {}
+
+    def stats(self):
+        return self.client.tcp_manager.stats() if self.client.tcp_manager else {}
+
+    def on_message(self, callback):
+        # callback(message) runs on the asyncio loop; coroutine functions are scheduled as tasks
+        self.callbacks.append(callback)
+        return callback
+
+    def messages(self, maxsize=10000):
+        stream = MessageStream(self, maxsize)
+        self.streams.add(stream)
+        return stream
+
+    async def close(self):
+        if self.client.username:
+            await self.unregister()
+        elif self.client.tcp_manager:
+            await self._call(self.client.tcp_manager.stop)
+        self.client.running = False
+        for stream in list(self.streams):
+            stream.close()
+
+    def _on_text(self, conn, text):
+        self._deliver(Message('text', conn.label(), None, text, None, time.time()))
+
+    def _on_group(self, conn, group, text):
+        self._deliver(Message('group', conn.label(), group, text, None, time.time()))
+
+    def _on_stored(self, sender, text, sent_at):
+        self._deliver(Message('stored', sender, None, text, None, time.time()))
+
+    def _on_file(self, conn, transfer):
+        self._deliver(Message('file', conn.label(), None, transfer.name, transfer.path, time.time()))
+
+    def _deliver(self, message):
+        # Runs on the TCP event loop thread, or the mailbox thread for stored messages
+        if self.loop is None or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self._dispatch, message)
+
+    def _dispatch(self, message):
+        for callback in self.callbacks:
+            try:
+                result = callback(message)
+                if asyncio.iscoroutine(result):
+                    self.loop.create_task(result)
+            except Exception as e:
+                print(f"Message callback error: {e}")
+        for stream in self.streams:
+            stream.put(message)
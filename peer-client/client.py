@@ -1,3 +1,4 @@
+import asyncio
 import requests
 import json
 import socket
@@ -5,164 +6,1340 @@ import sys
 import os
 import time
 import threading
-import select
+import selectors
+import collections
+import errno
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import random
+import struct
+import ipaddress
+from urllib.parse import urlparse
 from datetime import datetime
+try:
+    import msgpack
+except ImportError:  # directory responses are then fetched as JSON
+    msgpack = None
+from protocol import (
+    FrameReader, ProtocolError, MAX_FRAME_SIZE, encode_frame, encode_hello, decode_hello,
+    encode_welcome, decode_welcome, negotiate_version, encode_group_text, decode_group_text,
+    encode_file_offer, decode_file_offer, encode_file_accept, decode_file_accept,
+    encode_chunk_header, decode_file_chunk, encode_file_ack, decode_file_ack,
+    encode_file_cancel, decode_file_cancel, encode_ping, encode_pong, decode_pong,
+    MIN_PROTOCOL_VERSION, PROTOCOL_VERSION, WELCOME, HELLO, ERROR, TEXT, GROUP_TEXT,
+    FILE_OFFER, FILE_ACCEPT, FILE_CHUNK, FILE_ACK, FILE_CANCEL, PING, PONG
+)
+from transfer import OutgoingTransfer, IncomingTransfer, DOWNLOAD_DIR, WINDOW, offer_error, safe_name
+from datagram import (
+    SendWindow, ReceiveWindow, SEGMENT_SIZE, MAX_RETRIES, PUNCH, PUNCH_ACK, DATA, ACK, CLOSE,
+    new_session, encode_packet, decode_packet
+)
+
+STUN_MAGIC_COOKIE = 0x2112A442
+STUN_HEADER = struct.Struct('!HHI12s')
+
+def parse_binding_response(data, txid):
+    # Returns the (ip, port) from a Binding Success Response, or None
+    if len(data) < STUN_HEADER.size:
+        return None
+    msg_type, length, cookie, rtxid = STUN_HEADER.unpack_from(data)
+    if msg_type != 0x0101 or cookie != STUN_MAGIC_COOKIE or rtxid != txid:
+        return None
+    offset = STUN_HEADER.size
+    end = min(len(data), offset + length)
+    while offset + 4 <= end:
+        attr_type, attr_len = struct.unpack_from('!HH', data, offset)
+        value = data[offset + 4:offset + 4 + attr_len]
+        offset += 4 + attr_len + (-attr_len % 4)
+        if attr_type not in (0x0020, 0x0001) or len(value) < 8:
+            continue
+        family, port = struct.unpack_from('!xBH', value)
+        raw = value[4:8] if family == 0x01 else value[4:20]
+        if attr_type == 0x0020:
+            # XOR-MAPPED-ADDRESS: port with the top of the cookie, address with cookie + txid
+            port ^= STUN_MAGIC_COOKIE >> 16
+            mask = struct.pack('!I', STUN_MAGIC_COOKIE) + txid
+            raw = bytes(b ^ m for b, m in zip(raw, mask))
+        return str(ipaddress.ip_address(raw)), port
+    return None
+
+def stun_binding_request(host, port, timeout=1.0, retries=2, sock=None):
+    # Asks a STUN server (RFC 5389) for our reflexive transport address
+    txid = os.urandom(12)
+    request = STUN_HEADER.pack(0x0001, 0, STUN_MAGIC_COOKIE, txid)
+    own_socket = sock is None
+    if own_socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.settimeout(timeout)
+        for _ in range(retries + 1):
+            sock.sendto(request, (host, port))
+            try:
+                data, _ = sock.recvfrom(2048)
+            except socket.timeout:
+                continue
+            mapped = parse_binding_response(data, txid)
+            if mapped:
+                return mapped
+        return None
+    finally:
+        if own_socket:
+            sock.close()
+
+class PeerConnection:
+    datagram = False
+    
+    def __init__(self, sock, address, username=None, outbound=False):
+        self.sock = sock
+        self.address = address
+        self.username = username
+        self.outbound = outbound
+        self.connected_at = datetime.now()
+        self.closed = False
+        # Set once HELLO/WELCOME have been exchanged (or the connection died first)
+        self.version = None
+        self.ready = threading.Event()
+        self.closing = False
+        self.closing_since = None
+        # Set on the losing side of a simultaneous connect; senders follow it to the survivor
+        self.replaced_by = None
+        self.last_active = time.monotonic()
+        self.reader = FrameReader()
+        # Outgoing chunks are queued by any thread and written by the event loop
+        self.send_queue = collections.deque()
+        self.queued_bytes = 0
+        # Token of the pending delayed flush when batching is on, otherwise None
+        self.batch_pending = None
+        # Transport counters; messages are chat and group texts
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.reads = 0
+        self.writes = 0
+        # Round-trip time from PING/PONG, in seconds: last, smoothed (1/8 gain like TCP) and lowest
+        self.ping_sent_at = None
+        self.rtt = None
+        self.rtt_avg = None
+        self.rtt_min = None
+        self.lock = threading.Lock()
+        self.drained = threading.Condition(self.lock)
+    
+    def label(self):
+        return self.username or f"{self.address[0]}:{self.address[1]}"
+    
+    def record_rtt(self, rtt):
+        self.rtt = rtt
+        self.rtt_avg = rtt if self.rtt_avg is None else self.rtt_avg + (rtt - self.rtt_avg) / 8
+        self.rtt_min = rtt if self.rtt_min is None else min(self.rtt_min, rtt)
+    
+    def stats(self):
+        def ms(value):
+            return round(value * 1000, 3) if value is not None else None
+        return {
+            'transport': 'udp' if self.datagram else 'tcp',
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'messages_in': self.messages_in,
+            'messages_out': self.messages_out,
+            'reads': self.reads,
+            'writes': self.writes,
+            'queued_bytes': self.queued_bytes,
+            'queued_chunks': len(self.send_queue),
+            'rtt_ms': ms(self.rtt),
+            'rtt_avg_ms': ms(self.rtt_avg),
+            'rtt_min_ms': ms(self.rtt_min),
+            'connected_seconds': round((datetime.now() - self.connected_at).total_seconds(), 1)
+        }
+    
+    def state(self):
+        if self.closed:
+            return 'closed'
+        if self.closing:
+            return 'closing'
+        if not self.ready.is_set():
+            return 'connecting'
+        return 'ready'
+
+class DatagramChannel(PeerConnection):
+    # A peer connection carried by the shared UDP socket (see datagram.py).
+    # The frame stream is queued in send_queue like on TCP; queued_bytes
+    # includes segments in flight until they are acknowledged.
+    datagram = True
+    
+    def __init__(self, sock, session, username, candidates, outbound):
+        super().__init__(sock, candidates[0], username=username, outbound=outbound)
+        self.session = session
+        self.candidates = list(candidates)
+        self.version = PROTOCOL_VERSION
+        self.sender = SendWindow()
+        self.receiver = ReceiveWindow()
+        self.punch_deadline = None
+        self.timer_armed = False
+    
+    def next_segment(self):
+        # Cuts up to SEGMENT_SIZE bytes off the front of send_queue; caller holds the lock
+        parts = []
+        size = 0
+        while self.send_queue and size < SEGMENT_SIZE:
+            chunk = self.send_queue[0]
+            take = SEGMENT_SIZE - size
+            if len(chunk) <= take:
+                parts.append(chunk)
+                size += len(chunk)
+                self.send_queue.popleft()
+            else:
+                parts.append(chunk[:take])
+                size += take
+                self.send_queue[0] = memoryview(chunk)[take:]
+        return b''.join(parts)
+    
+    def stats(self):
+        stats = super().stats()
+        stats['in_flight'] = len(self.sender.in_flight)
+        stats['retransmits'] = self.sender.retransmits
+        return stats
+
+class UDPTransport:
+    # Owns the UDP socket shared by all datagram channels. open() and accept()
+    # may be called from any thread; everything else runs on the event loop.
+    PUNCH_INTERVAL = float(os.getenv('PEER_PUNCH_INTERVAL_MS', 100)) / 1000
+    PUNCH_TIMEOUT = float(os.getenv('PEER_PUNCH_TIMEOUT', 5))
+    
+    def __init__(self, manager, sock):
+        self.manager = manager
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.port = sock.getsockname()[1]
+        # session id -> DatagramChannel
+        self.channels = {}
+        manager.selector.register(sock, selectors.EVENT_READ, 'udp')
+    
+    def open(self, username, candidates, session=None, outbound=True):
+        # Starts punching towards the candidate addresses; the channel's ready event
+        # is set once the peer answers
+        channel = DatagramChannel(self.sock, session or new_session(), username, candidates, outbound)
+        self.manager.call_soon(self._start, channel)
+        return channel
+    
+    def accept(self, signal):
+        # Punches back towards a peer that asked for a channel through the server
+        try:
+            username = signal['from']
+            session = int(signal['session'], 16)
+            candidates = [(str(ip), int(port)) for ip, port in signal['candidates']][:4]
+        except (KeyError, TypeError, ValueError):
+            return None
+        if not candidates or float(signal.get('age', 0)) > self.PUNCH_TIMEOUT:
+            return None
+        return self.open(username, candidates, session, outbound=False)
+    
+    def _start(self, channel):
+        if channel.closed or channel.session in self.channels:
+            return
+        self.channels[channel.session] = channel
+        channel.punch_deadline = time.monotonic() + self.PUNCH_TIMEOUT
+        self._punch(channel)
+    
+    def _punch(self, channel):
+        if channel.closed or channel.ready.is_set():
+            return
+        if time.monotonic() > channel.punch_deadline:
+            self.manager._close(channel, quiet=True)
+            return
+        packet = encode_packet(PUNCH, channel.session, 0, self.manager._my_username().encode('utf-8'))
+        for address in channel.candidates:
+            self._send(packet, address)
+        self.manager.call_later(self.PUNCH_INTERVAL, self._punch, channel)
+    
+    def _send(self, packet, address):
+        try:
+            self.sock.sendto(packet, address)
+        except (BlockingIOError, InterruptedError):
+            pass  # lost like any datagram; the retransmission timer covers it
+        except OSError:
+            pass
+    
+    def on_readable(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            packet = decode_packet(data)
+            if packet is None:
+                continue
+            kind, session, seq, payload = packet
+            channel = self.channels.get(session)
+            if channel is not None and not channel.closed:
+                self._on_packet(channel, kind, seq, payload, address)
+    
+    def _on_packet(self, channel, kind, seq, payload, address):
+        if kind in (PUNCH, PUNCH_ACK):
+            if kind == PUNCH:
+                self._send(encode_packet(PUNCH_ACK, channel.session, 0,
+                                         self.manager._my_username().encode('utf-8')), address)
+            if not channel.ready.is_set():
+                channel.address = address
+                channel.last_active = time.monotonic()
+                channel.ready.set()
+                if self.manager._adopt(channel):
+                    print(f"Connected to {channel.label()} at {address[0]}:{address[1]} over UDP")
+                self.pump(channel)
+            return
+        if not channel.ready.is_set():
+            return
+        if kind == DATA:
+            channel.reads += 1
+            channel.bytes_in += len(payload)
+            for segment in channel.receiver.receive(seq, payload):
+                channel.reader.feed(segment)
+            # Every DATA is acknowledged, including duplicates whose ACK was lost
+            self._send(encode_packet(ACK, channel.session, channel.receiver.expected), channel.address)
+            self.manager._process_frames(channel)
+        elif kind == ACK:
+            acked, resend = channel.sender.ack(seq, time.monotonic())
+            if resend:
+                self._send(encode_packet(DATA, channel.session, *resend), channel.address)
+            if acked:
+                with channel.lock:
+                    channel.queued_bytes -= acked
+                    if channel.queued_bytes <= self.manager.SEND_LOW_WATER:
+                        channel.drained.notify_all()
+            self.pump(channel)
+        elif kind == CLOSE:
+            if not channel.closing:
+                print(f"\n{channel.label()} closed connection")
+            self.manager._close(channel, quiet=True)
+    
+    def pump(self, channel):
+        # Sends queued data while the window has room; closes a draining channel once all is acknowledged
+        if channel.closed or not channel.ready.is_set():
+            return
+        now = time.monotonic()
+        with channel.lock:
+            channel.batch_pending = None
+            while channel.send_queue and channel.sender.can_send():
+                segment = channel.next_segment()
+                seq = channel.sender.add(segment, now)
+                self._send(encode_packet(DATA, channel.session, seq, segment), channel.address)
+                channel.writes += 1
+                channel.bytes_out += len(segment)
+            drained = not channel.send_queue and not channel.sender.in_flight
+        if drained and channel.closing:
+            self.manager._close(channel, quiet=True)
+        elif channel.sender.in_flight and not channel.timer_armed:
+            channel.timer_armed = True
+            self.manager.call_later(max(0.0, channel.sender.deadline() - now), self._on_timer, channel)
+    
+    def _on_timer(self, channel):
+        channel.timer_armed = False
+        if channel.closed:
+            return
+        resend = channel.sender.due(time.monotonic())
+        if resend:
+            if channel.sender.retries > MAX_RETRIES:
+                print(f"\n{channel.label()} stopped answering over UDP")
+                self.manager._close(channel)
+                return
+            self._send(encode_packet(DATA, channel.session, *resend), channel.address)
+        self.pump(channel)
+    
+    def detach(self, channel):
+        # Called from TCPManager._close
+        if self.channels.pop(channel.session, None) is not None and channel.ready.is_set():
+            self._send(encode_packet(CLOSE, channel.session), channel.address)
+    
+    def close(self):
+        try:
+            self.manager.selector.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        self.sock.close()
 
 class TCPManager:
-    def __init__(self, client_instance):
+    # A peer whose send queue grows past the high-water mark blocks its
+    # senders until the event loop drains it below the low-water mark
+    SEND_HIGH_WATER = 1024 * 1024
+    SEND_LOW_WATER = 256 * 1024
+    SEND_TIMEOUT = 10
+    HANDSHAKE_TIMEOUT = 10
+    # Group fan-out never waits: a member whose queue is this full misses the message
+    GROUP_QUEUE_LIMIT = 4 * 1024 * 1024
+    # Chunks a sender may have unacknowledged when streaming a file to us
+    FILE_WINDOW = WINDOW
+    # Opt-in write batching: hold queued frames up to BATCH_DELAY seconds (or
+    # until BATCH_BYTES are queued) so they leave in one sendmsg call
+    BATCH_DELAY = float(os.getenv('PEER_BATCH_DELAY_MS', 0)) / 1000
+    BATCH_BYTES = int(os.getenv('PEER_BATCH_BYTES', 64 * 1024))
+    # Frames are already coalesced in user space, so Nagle only adds delay
+    TCP_NODELAY = os.getenv('PEER_TCP_NODELAY', '1') == '1'
+    # Linux only; re-armed after every read since the kernel clears it
+    TCP_QUICKACK = os.getenv('PEER_TCP_QUICKACK', '0') == '1' and hasattr(socket, 'TCP_QUICKACK')
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 16, 1024)
+    # Seconds between RTT probes on every ready connection (0 disables them)
+    PING_INTERVAL = float(os.getenv('PEER_PING_INTERVAL', 15))
+    # Periodic JSON dump of stats(): a file path or '-' for stdout, every STATS_INTERVAL seconds
+    STATS_FILE = os.getenv('PEER_STATS_FILE')
+    STATS_INTERVAL = float(os.getenv('PEER_STATS_INTERVAL', 60))
+    # Connection cache limits: least recently used peers are closed first
+    MAX_CONNECTIONS = int(os.getenv('PEER_POOL_SIZE', 256))
+    IDLE_TIMEOUT = float(os.getenv('PEER_IDLE_TIMEOUT', 300))
+    # A closing connection whose peer never drains it is dropped after this many seconds
+    CLOSE_GRACE = float(os.getenv('PEER_CLOSE_GRACE', 10))
+    # Whole budget for reaching a peer over any address or transport
+    CONNECT_TIMEOUT = float(os.getenv('PEER_CONNECT_TIMEOUT', 5))
+    # Head start each address gets before the next one is dialed too (happy eyeballs, RFC 8305)
+    CONNECT_STAGGER = float(os.getenv('PEER_CONNECT_STAGGER_MS', 250)) / 1000
+    
+    def __init__(self, client_instance, batch_delay=None, batch_bytes=None):
         self.client = client_instance
+        self.batch_delay = self.BATCH_DELAY if batch_delay is None else batch_delay
+        self.batch_bytes = batch_bytes or self.BATCH_BYTES
         self.tcp_server = None
-        self.active_connections = {}
+        # UDPTransport once start_udp() was called; carries hole-punched channels
+        self.udp = None
+        # One live connection per peer username, in least-recently-used order
+        self.active_connections = collections.OrderedDict()
+        self.pool_lock = threading.Lock()
+        # username -> {'failures', 'last_error', 'since'} for peers we could not reach
+        self.peer_failures = {}
+        # username -> connections adopted over our lifetime; more than one means reconnects
+        self.peer_connects = collections.Counter()
+        # Counters of closed connections, so totals cover the manager's whole lifetime
+        self.retired_totals = collections.Counter()
+        self.started_at = time.monotonic()
+        self.last_eviction = time.monotonic()
         self.running = True
         self.server_thread = None
+        # Called as handler(conn, text) for every chat message; prints when unset
+        self.message_handler = None
+        # Called as handler(conn, group, text) for group messages; prints when unset
+        self.group_handler = None
+        # File transfers by transfer id; handler(conn, transfer) runs when a download completes
+        self.outgoing_transfers = {}
+        self.incoming_transfers = {}
+        self.download_dir = DOWNLOAD_DIR
+        self.file_handler = None
+        self.selector = selectors.DefaultSelector()
+        # Other threads hand work to the loop through this queue and wake it via the socket pair
+        self.pending_calls = collections.deque()
+        # (deadline, seq, func, args) heap for call_later
+        self.timers = []
+        self.timer_lock = threading.Lock()
+        self.timer_seq = itertools.count()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, 'wake')
         
     def start_tcp_server(self, port):
         try:
             self.tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.tcp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.tcp_server.bind(('0.0.0.0', port))
-            self.tcp_server.listen(5)
-            self.tcp_server.settimeout(1.0)
+            self.tcp_server.listen(socket.SOMAXCONN)
+            self.tcp_server.setblocking(False)
+            self.selector.register(self.tcp_server, selectors.EVENT_READ, 'accept')
             
             print(f"TCP Server started on port {port}")
             
-            self.server_thread = threading.Thread(target=self._accept_connections)
-            self.server_thread.daemon = True
-            self.server_thread.start()
-            
+            self.start_event_loop()
             return True
             
         except Exception as e:
             print(f"Failed to start TCP server: {e}")
             return False
     
-    def _accept_connections(self):
+    def start_udp(self, sock):
+        # The selector is only touched from the event loop thread once it runs
+        if self.server_thread and self.server_thread.is_alive() and threading.current_thread() is not self.server_thread:
+            self.call_soon(self.start_udp, sock)
+            return
+        self.udp = UDPTransport(self, sock)
+        print(f"UDP channel ready on port {self.udp.port}")
+    
+    def start_event_loop(self):
+        if self.server_thread and self.server_thread.is_alive():
+            return
+        self.server_thread = threading.Thread(target=self._event_loop, name="peer-event-loop")
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        if self.PING_INTERVAL > 0:
+            self.call_later(self.PING_INTERVAL, self._ping_all)
+        if self.STATS_FILE and self.STATS_INTERVAL > 0:
+            self.call_later(self.STATS_INTERVAL, self._dump_stats)
+    
+    def call_soon(self, func, *args):
+        self.pending_calls.append((func, args))
+        try:
+            self.wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # a wakeup is already pending
+    
+    def call_later(self, delay, func, *args):
+        with self.timer_lock:
+            heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_seq), func, args))
+        self.call_soon(lambda: None)  # let the loop shorten its select timeout
+    
+    def _run_timers(self):
+        now = time.monotonic()
+        while True:
+            with self.timer_lock:
+                if not self.timers or self.timers[0][0] > now:
+                    return
+                _, _, func, args = heapq.heappop(self.timers)
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Event loop error: {e}")
+    
+    def _select_timeout(self):
+        with self.timer_lock:
+            if not self.timers:
+                return 1.0
+            return min(1.0, max(0.0, self.timers[0][0] - time.monotonic()))
+    
+    def _event_loop(self):
+        # One thread multiplexes the listener and every peer socket
         while self.running:
             try:
-                readable, _, _ = select.select([self.tcp_server], [], [], 1.0)
-                if self.tcp_server in readable:
-                    client_socket, client_address = self.tcp_server.accept()
-                    
+                events = self.selector.select(timeout=self._select_timeout())
+            except OSError:
+                if not self.running:
+                    break
+                raise
+            for key, mask in events:
+                if key.data == 'wake':
                     try:
-                        username_data = client_socket.recv(1024).decode('utf-8').strip()
-                        if username_data.startswith("USER:"):
-                            username = username_data.split(":")[1]
-                            
-                            self.active_connections[username] = {
-                                'socket': client_socket,
-                                'address': client_address,
-                                'connected_at': datetime.now()
-                            }
-                            
-                            print(f"Connected to {username} from {client_address}")
-                            
-                            thread = threading.Thread(
-                                target=self._receive_messages,
-                                args=(client_socket, username)
-                            )
-                            thread.daemon = True
-                            thread.start()
-                            
+                        while self.wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                elif key.data == 'accept':
+                    self._accept_connections()
+                elif key.data == 'udp':
+                    self.udp.on_readable()
+                else:
+                    conn = key.data
+                    try:
+                        if mask & selectors.EVENT_READ:
+                            self._on_readable(conn)
+                        if mask & selectors.EVENT_WRITE and not conn.closed:
+                            self._flush(conn)
                     except Exception as e:
-                        print(f"Error accepting connection: {e}")
-                        client_socket.close()
-                        
-            except socket.timeout:
-                continue
-            except Exception as e:
+                        print(f"Event loop error on {conn.label()}: {e}")
+                        self._close(conn)
+            while self.pending_calls:
+                func, args = self.pending_calls.popleft()
+                try:
+                    func(*args)
+                except Exception as e:
+                    print(f"Event loop error: {e}")
+            self._run_timers()
+            self._evict_connections()
+    
+    def _accept_connections(self):
+        while True:
+            try:
+                client_socket, client_address = self.tcp_server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
                 if self.running:
                     print(f"Server error: {e}")
-    def _receive_messages(self, sock, username):
+                return
+            client_socket.setblocking(False)
+            self._tune(client_socket)
+            conn = PeerConnection(client_socket, client_address)
+            self.selector.register(client_socket, selectors.EVENT_READ, conn)
+    
+    def _on_readable(self, conn):
         try:
-            sock.settimeout(1.0)  # 1 second timeout
-            while self.running:
-                try:
-                    data = sock.recv(4096)
-                    if not data:
-                        print(f"\n{username} closed connection")
-                        break
-                        
-                    message = data.decode('utf-8')
-                    timestamp = datetime.now().strftime("%H:%M:%S")
-                    print(f"\n[{timestamp}] {username}: {message}")
-                    print("Your message: ", end="", flush=True)
-                    
-                except socket.timeout:
-                    continue  # Timeout is normal, just continue
-                except ConnectionResetError:
-                    print(f"\n{username} reset connection")
-                    break
-                except Exception as e:
-                    print(f"\nError receiving from {username}: {e}")
-                    break
-                    
-        except Exception as e:
-            print(f"Thread error: {e}")
-        finally:
+            received = conn.reader.recv_into(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except ConnectionResetError:
+            print(f"\n{conn.label()} reset connection")
+            self._close(conn)
+            return
+        except OSError as e:
+            print(f"\nError receiving from {conn.label()}: {e}")
+            self._close(conn)
+            return
+        
+        if not received:
+            if not conn.closing:
+                print(f"\n{conn.label()} closed connection")
+            self._close(conn, quiet=conn.closing)
+            return
+        
+        conn.reads += 1
+        conn.bytes_in += received
+        if self.TCP_QUICKACK:
             try:
-                sock.close()
-            except:
+                conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+            except OSError:
                 pass
-            if username in self.active_connections:
-                del self.active_connections[username]
-            print(f"\n{username} disconnected")
-            
-    def connect_to_peer(self, ip, port, my_username):
+        self._process_frames(conn)
+    
+    def _process_frames(self, conn):
+        active = False
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(10)
-            sock.connect((ip, port))
-            
-            # Enable keepalive
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-            
-            sock.send(f"USER:{my_username}".encode('utf-8'))
-            
-            self.active_connections[ip] = {
-                'socket': sock,
-                'address': (ip, port),
-                'connected_at': datetime.now()
+            for frame_type, payload in conn.reader.frames():
+                conn.frames_in += 1
+                # Probes don't count as activity, so idle connections still get evicted
+                active = active or frame_type not in (PING, PONG)
+                self._on_frame(conn, frame_type, payload)
+                if conn.closed:
+                    return
+            if active:
+                self._touch(conn)
+        except (ProtocolError, UnicodeDecodeError) as e:
+            print(f"\nProtocol error from {conn.label()}: {e}")
+            self._close(conn)
+    
+    def _on_frame(self, conn, frame_type, payload):
+        if frame_type == PING:
+            self._enqueue(conn, encode_pong(payload))
+            return
+        if frame_type == PONG:
+            token = decode_pong(payload)
+            if conn.ping_sent_at is not None and token == conn.ping_sent_at:
+                conn.record_rtt((time.monotonic_ns() - token) / 1e9)
+                conn.ping_sent_at = None
+            return
+        
+        if frame_type == ERROR:
+            print(f"\n{conn.label()} refused: {str(payload, 'utf-8', errors='replace')}")
+            self._close(conn, quiet=True)
+            return
+        
+        if not conn.ready.is_set():
+            if frame_type == HELLO and not conn.outbound:
+                peer_min, peer_max, username = decode_hello(payload)
+                version = negotiate_version(peer_min, peer_max)
+                if version is None:
+                    self._refuse(conn, f"unsupported protocol versions {peer_min}-{peer_max}")
+                    return
+                conn.username = username
+                conn.version = version
+                self._enqueue(conn, encode_welcome(version, self._my_username()))
+                conn.ready.set()
+                if self._adopt(conn):
+                    print(f"Connected to {username} from {conn.address}")
+            elif frame_type == WELCOME and conn.outbound:
+                version, username = decode_welcome(payload)
+                if not MIN_PROTOCOL_VERSION <= version <= PROTOCOL_VERSION:
+                    self._refuse(conn, f"unsupported protocol version {version}")
+                    return
+                conn.username = username or conn.username
+                conn.version = version
+                self._adopt(conn)
+                conn.ready.set()
+            else:
+                raise ProtocolError(f"Unexpected frame type {frame_type} before handshake")
+            return
+        
+        if frame_type == TEXT:
+            conn.messages_in += 1
+            message = str(payload, 'utf-8')
+            if self.message_handler:
+                self.message_handler(conn, message)
+            else:
+                timestamp = datetime.now().strftime("%H:%M:%S")
+                print(f"\n[{timestamp}] {conn.label()}: {message}")
+                print("Your message: ", end="", flush=True)
+        elif frame_type == GROUP_TEXT:
+            conn.messages_in += 1
+            group, message = decode_group_text(payload)
+            if self.group_handler:
+                self.group_handler(conn, group, message)
+            else:
+                timestamp = datetime.now().strftime("%H:%M:%S")
+                print(f"\n[{timestamp}] {conn.label()} @{group}: {message}")
+                print("Your message: ", end="", flush=True)
+        elif frame_type in (FILE_OFFER, FILE_ACCEPT, FILE_CHUNK, FILE_ACK, FILE_CANCEL):
+            self._on_file_frame(conn, frame_type, payload)
+        # Unknown frame types are skipped so newer peers can add their own
+    
+    def _on_file_frame(self, conn, frame_type, payload):
+        if frame_type == FILE_CHUNK:
+            transfer_id, offset, crc, data = decode_file_chunk(payload)
+            transfer = self.incoming_transfers.get(transfer_id)
+            if transfer is None or transfer.conn is not conn or transfer.state != 'receiving':
+                return
+            try:
+                result = transfer.write(offset, crc, data)
+            except OSError as e:
+                self._cancel_incoming(transfer, f"write failed: {e}")
+                return
+            if result == 'overflow':
+                self._cancel_incoming(transfer, "data past the offered size")
+            elif result == 'bad':
+                # Ask the sender to rewind; chunks already in flight are skipped
+                print(f"\nChecksum mismatch in {transfer.name} at {offset}, resending")
+                self._enqueue(conn, encode_file_accept(transfer.id, transfer.offset, self.FILE_WINDOW))
+            elif result == 'ok' and transfer.should_ack(self.FILE_WINDOW):
+                transfer.acked = transfer.offset
+                self._enqueue(conn, encode_file_ack(transfer.id, transfer.offset))
+                if transfer.offset == transfer.size:
+                    self._finish_incoming(transfer)
+        
+        elif frame_type == FILE_OFFER:
+            transfer_id, size, chunk_size, name = decode_file_offer(payload)
+            self._on_file_offer(conn, transfer_id, size, chunk_size, name)
+        
+        elif frame_type == FILE_ACCEPT:
+            transfer_id, offset, window = decode_file_accept(payload)
+            transfer = self.outgoing_transfers.get(transfer_id)
+            if transfer is None or transfer.conn is not conn or transfer.done.is_set():
+                return
+            transfer.accept(offset, window)
+            if transfer.ack(offset):
+                self._finish_outgoing(transfer, 'done')
+            else:
+                self._pump(transfer)
+        
+        elif frame_type == FILE_ACK:
+            transfer_id, offset = decode_file_ack(payload)
+            transfer = self.outgoing_transfers.get(transfer_id)
+            if transfer is None or transfer.conn is not conn or transfer.done.is_set():
+                return
+            if transfer.ack(offset):
+                self._finish_outgoing(transfer, 'done')
+            else:
+                self._pump(transfer)
+        
+        elif frame_type == FILE_CANCEL:
+            transfer_id, reason = decode_file_cancel(payload)
+            transfer = self.outgoing_transfers.get(transfer_id)
+            if transfer is not None and transfer.conn is conn:
+                print(f"\n{conn.label()} cancelled {transfer.name}: {reason}")
+                self._finish_outgoing(transfer, 'failed', reason)
+            transfer = self.incoming_transfers.get(transfer_id)
+            if transfer is not None and transfer.conn is conn:
+                print(f"\n{conn.label()} cancelled {transfer.name}: {reason}")
+                transfer.abort('failed', reason)
+                self.incoming_transfers.pop(transfer.id, None)
+    
+    def _on_file_offer(self, conn, transfer_id, size, chunk_size, name):
+        name = safe_name(name)
+        if name is None or not 0 < chunk_size <= MAX_FRAME_SIZE // 2:
+            self._enqueue(conn, encode_file_cancel(transfer_id, "invalid offer"))
+            return
+        previous = self.incoming_transfers.pop(transfer_id, None)
+        if previous is not None and previous.state == 'receiving':
+            previous.abort('interrupted')
+        try:
+            error = offer_error(self.download_dir, size)
+        except OSError as e:
+            error = f"cannot store file: {e}"
+        if error:
+            print(f"\nRefusing {name} ({size} bytes) from {conn.label()}: {error}")
+            self._enqueue(conn, encode_file_cancel(transfer_id, error))
+            return
+        try:
+            transfer = IncomingTransfer(conn, transfer_id, name, size, chunk_size, self.download_dir)
+        except OSError as e:
+            self._enqueue(conn, encode_file_cancel(transfer_id, f"cannot store file: {e}"))
+            return
+        self.incoming_transfers[transfer_id] = transfer
+        if transfer.resumed_from:
+            print(f"\nResuming {name} from {conn.label()} at {transfer.resumed_from}/{size} bytes")
+        else:
+            print(f"\nReceiving {name} ({size} bytes) from {conn.label()}")
+        self._enqueue(conn, encode_file_accept(transfer_id, transfer.offset, self.FILE_WINDOW))
+        if transfer.offset == size:
+            self._enqueue(conn, encode_file_ack(transfer_id, size))
+            self._finish_incoming(transfer)
+    
+    def _finish_incoming(self, transfer):
+        self.incoming_transfers.pop(transfer.id, None)
+        try:
+            transfer.complete()
+        except OSError as e:
+            transfer.abort('failed', str(e))
+            print(f"\nCould not save {transfer.name}: {e}")
+            return
+        if self.file_handler:
+            self.file_handler(transfer.conn, transfer)
+        else:
+            print(f"\nReceived {transfer.name} from {transfer.conn.label()} -> {transfer.path}")
+    
+    def _cancel_incoming(self, transfer, reason):
+        print(f"\nCancelling {transfer.name}: {reason}")
+        self.incoming_transfers.pop(transfer.id, None)
+        transfer.abort('failed', reason)
+        self._enqueue(transfer.conn, encode_file_cancel(transfer.id, reason))
+    
+    def _pump(self, transfer):
+        # Queues whatever the window allows; runs on the event loop as acks arrive
+        for offset, crc, data in transfer.chunks():
+            self._enqueue(transfer.conn, encode_chunk_header(transfer.id, offset, crc, len(data)), data)
+        self._touch(transfer.conn)
+    
+    def _finish_outgoing(self, transfer, state, error=None):
+        if self.outgoing_transfers.get(transfer.id) is transfer:
+            del self.outgoing_transfers[transfer.id]
+        transfer.finish(state, error)
+    
+    def _interrupt_transfers(self, conn):
+        for transfer in list(self.outgoing_transfers.values()):
+            if transfer.conn is conn:
+                self._finish_outgoing(transfer, 'interrupted', 'connection closed')
+        for transfer in list(self.incoming_transfers.values()):
+            if transfer.conn is conn:
+                self.incoming_transfers.pop(transfer.id, None)
+                transfer.abort('interrupted', 'connection closed')
+    
+    def _refuse(self, conn, reason):
+        # Sends ERROR and closes once it has been written
+        print(f"\nRefusing {conn.label()}: {reason}")
+        conn.closing = True
+        conn.closing_since = time.monotonic()
+        self._enqueue(conn, encode_frame(ERROR, reason.encode('utf-8')))
+    
+    def _my_username(self):
+        return getattr(self.client, 'username', None) or ''
+    
+    def _dialer(self, conn):
+        return self._my_username() if conn.outbound else conn.username
+    
+    def _adopt(self, conn):
+        # Makes conn the cached connection for its peer. When both peers dialed
+        # each other at once, both sides keep the connection opened by the
+        # lexicographically smaller username and close the other one once
+        # its queued data is written. Two connections dialed by the same side
+        # mean the peer reconnected (e.g. after a restart), so the newer one
+        # replaces the stale one. Returns False if conn lost.
+        with self.pool_lock:
+            existing = self.active_connections.get(conn.username)
+            if existing is None or existing is conn or existing.closed or existing.closing:
+                winner, loser = conn, None
+            elif existing.datagram != conn.datagram:
+                # TCP beats a punched UDP channel on both sides, whichever was ready first
+                winner, loser = (conn, existing) if existing.datagram else (existing, conn)
+            elif self._dialer(existing) == self._dialer(conn):
+                winner, loser = conn, existing
+            elif self._dialer(existing) < self._dialer(conn):
+                winner, loser = existing, conn
+            else:
+                winner, loser = conn, existing
+            self.active_connections[conn.username] = winner
+            self.active_connections.move_to_end(conn.username)
+            self.peer_failures.pop(conn.username, None)
+            if loser is not conn:
+                self.peer_connects[conn.username] += 1
+        if loser:
+            loser.replaced_by = winner
+            self._close_when_drained(loser)
+        return loser is not conn
+    
+    def _touch(self, conn):
+        conn.last_active = time.monotonic()
+        with self.pool_lock:
+            if self.active_connections.get(conn.username) is conn:
+                self.active_connections.move_to_end(conn.username)
+    
+    def _close_when_drained(self, conn):
+        if not conn.closing:
+            conn.closing = True
+            conn.closing_since = time.monotonic()
+        self._watch(conn)
+    
+    def _evict_connections(self):
+        # Closes idle connections and trims the cache to MAX_CONNECTIONS; runs about once a second.
+        # Connections already closing don't count, and are dropped once they outlast CLOSE_GRACE
+        now = time.monotonic()
+        if now - self.last_eviction < 1.0:
+            return
+        self.last_eviction = now
+        evicted = []
+        with self.pool_lock:
+            open_connections = [conn for conn in self.active_connections.values() if not conn.closing]
+            excess = len(open_connections) - self.MAX_CONNECTIONS
+            for conn in open_connections:
+                if excess <= 0 and now - conn.last_active < self.IDLE_TIMEOUT:
+                    break
+                evicted.append(conn)
+                excess -= 1
+        for conn in evicted:
+            print(f"\nClosing idle connection to {conn.label()}")
+            self._close_when_drained(conn)
+        
+        closing = [key.data for key in self.selector.get_map().values() if isinstance(key.data, PeerConnection)]
+        if self.udp:
+            closing.extend(self.udp.channels.values())
+        for conn in closing:
+            if conn.closing and not conn.closed and now - conn.closing_since >= self.CLOSE_GRACE:
+                print(f"\n{conn.label()} did not drain, dropping connection")
+                self._close(conn, True)
+    
+    def connection_states(self):
+        now = time.monotonic()
+        with self.pool_lock:
+            states = {
+                username: {
+                    'state': conn.state(),
+                    'outbound': conn.outbound,
+                    'address': f"{conn.address[0]}:{conn.address[1]}",
+                    'idle_seconds': round(now - conn.last_active, 1),
+                    'reconnects': max(0, self.peer_connects[username] - 1),
+                    **conn.stats()
+                }
+                for username, conn in self.active_connections.items()
             }
+            for username, failure in self.peer_failures.items():
+                if username not in states:
+                    states[username] = dict(failure, state='failed')
+        return states
+    
+    TOTAL_FIELDS = ('bytes_in', 'bytes_out', 'frames_in', 'frames_out', 'messages_in', 'messages_out')
+    
+    def stats(self):
+        connections = self.connection_states()
+        live = [c for c in connections.values() if 'bytes_in' in c]
+        with self.pool_lock:
+            retired = dict(self.retired_totals)
+        # Pool workers are counted per pool; unnamed threads as 'other'
+        threads = collections.Counter(
+            'other' if t.name.startswith('Thread-') else t.name.split('_')[0] for t in threading.enumerate()
+        )
+        return {
+            'timestamp': datetime.now().isoformat(),
+            'uptime_seconds': round(time.monotonic() - self.started_at, 1),
+            'totals': {
+                'connections': len(live),
+                'failed_peers': len(connections) - len(live),
+                'reconnects': sum(c['reconnects'] for c in live),
+                **{
+                    field: retired.get(field, 0) + sum(c[field] for c in live)
+                    for field in self.TOTAL_FIELDS
+                },
+                'queued_bytes': sum(c['queued_bytes'] for c in live),
+                'transfers_out': len(self.outgoing_transfers),
+                'transfers_in': len(self.incoming_transfers),
+                'pending_calls': len(self.pending_calls),
+                'timers': len(self.timers)
+            },
+            'threads': {'total': threading.active_count(), 'by_name': dict(threads)},
+            'connections': connections
+        }
+    
+    def ping(self, conn):
+        # Sends one RTT probe; the answer lands in conn.rtt. Safe from any thread.
+        conn = self._resolve(conn)
+        if conn.closed or conn.closing or not conn.ready.is_set():
+            return False
+        conn.ping_sent_at = time.monotonic_ns()
+        self._enqueue(conn, encode_ping(conn.ping_sent_at))
+        return True
+    
+    def _ping_all(self):
+        with self.pool_lock:
+            conns = list(self.active_connections.values())
+        for conn in conns:
+            self.ping(conn)
+        if self.running:
+            self.call_later(self.PING_INTERVAL, self._ping_all)
+    
+    def _dump_stats(self):
+        try:
+            data = json.dumps(self.stats(), indent=2)
+            if self.STATS_FILE == '-':
+                print(data, flush=True)
+            else:
+                # Write then rename so readers never see a half-written file
+                tmp = f"{self.STATS_FILE}.tmp"
+                with open(tmp, 'w') as f:
+                    f.write(data + '\n')
+                os.replace(tmp, self.STATS_FILE)
+        except (OSError, ValueError) as e:
+            print(f"Stats dump failed: {e}")
+        if self.running:
+            self.call_later(self.STATS_INTERVAL, self._dump_stats)
+    
+    def _tune(self, sock):
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.TCP_NODELAY else 0)
+            if self.TCP_QUICKACK:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        except OSError:
+            pass
+    
+    def _flush(self, conn):
+        with conn.lock:
+            conn.batch_pending = None
+            try:
+                while conn.send_queue:
+                    # Gather up to IOV_MAX queued chunks into one sendmsg (writev) call
+                    batch = list(itertools.islice(conn.send_queue, self.IOV_MAX))
+                    sent = conn.sock.sendmsg(batch) if len(batch) > 1 else conn.sock.send(batch[0])
+                    conn.writes += 1
+                    conn.bytes_out += sent
+                    conn.queued_bytes -= sent
+                    for chunk in batch:
+                        if sent < len(chunk):
+                            break
+                        sent -= len(chunk)
+                        conn.send_queue.popleft()
+                    else:
+                        continue
+                    # Short write: the socket buffer is full
+                    if sent:
+                        conn.send_queue[0] = memoryview(chunk)[sent:]
+                    break
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError as e:
+                print(f"\nSend to {conn.label()} failed: {e}")
+                conn.send_queue.clear()
+                conn.queued_bytes = 0
+                conn.drained.notify_all()
+                self._close(conn, locked=True)
+                return
             
-            print(f"Connected to {ip}:{port}")
-            
-            thread = threading.Thread(
-                target=self._receive_messages,
-                args=(sock, f"{ip}:{port}")
-            )
-            thread.daemon = True
-            thread.start()
-            
-            return sock
+            if conn.queued_bytes <= self.SEND_LOW_WATER:
+                conn.drained.notify_all()
+            if conn.closing and not conn.send_queue:
+                # Half-close: the peer still gets everything we queued, and we keep
+                # reading until it closes its side too
+                try:
+                    conn.sock.shutdown(socket.SHUT_WR)
+                except OSError:
+                    self._close(conn, quiet=True, locked=True)
+                    return
+            events = selectors.EVENT_READ
+            if conn.send_queue:
+                events |= selectors.EVENT_WRITE
+            self.selector.modify(conn.sock, events, conn)
+    
+    def _watch(self, conn):
+        if conn.closed:
+            return
+        if conn.datagram:
+            self.udp.pump(conn)
+            return
+        try:
+            self.selector.register(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+        except KeyError:
+            self.selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+    
+    def _close(self, conn, quiet=False, locked=False):
+        if conn.closed:
+            return
+        conn.closed = True
+        if conn.datagram:
+            self.udp.detach(conn)
+        else:
+            try:
+                self.selector.unregister(conn.sock)
+            except (KeyError, ValueError):
+                pass
+            try:
+                conn.sock.close()
+            except OSError:
+                pass
+        with self.pool_lock:
+            if conn.username and self.active_connections.get(conn.username) is conn:
+                del self.active_connections[conn.username]
+            for field in self.TOTAL_FIELDS:
+                self.retired_totals[field] += getattr(conn, field)
+        self._interrupt_transfers(conn)
+        conn.ready.set()
+        if not locked:
+            with conn.lock:
+                conn.drained.notify_all()
+        if not quiet:
+            print(f"\n{conn.label()} disconnected")
             
-        except Exception as e:
-            print(f"Connection failed: {e}")
-            return None
+    def get_connection(self, username, ip, port, alternates=(), punch=None):
+        # Reuses the cached connection to this peer, dialing only when there is none
+        with self.pool_lock:
+            conn = self.active_connections.get(username)
+        if conn and conn.state() == 'ready':
+            self._touch(conn)
+            return conn
+        return self.connect_to_peer(ip, port, self._my_username(), username, alternates, punch)
     
-    def send_message(self, sock, message):
+    def connect_to_peer(self, ip, port, my_username, username=None, alternates=(), punch=None):
+        # Races TCP connects to (ip, port) and the alternate addresses against UDP hole
+        # punching (when punch() starts a DatagramChannel); the first transport ready is kept
+        channel = punch() if punch else None
+        deadline = time.monotonic() + self.CONNECT_TIMEOUT
+        addresses = list(dict.fromkeys([(ip, port)] + [tuple(a) for a in alternates]))
+        error = None
         try:
-            sock.send(message.encode('utf-8'))
-            return True
-        except Exception as e:
-            print(f"Send failed: {e}")
+            sock, address = self._dial(addresses, deadline, channel)
+            if sock is not None:
+                conn = self._handshake(sock, address, my_username, username, deadline, channel)
+                if channel is not None and not channel.ready.is_set():
+                    self.call_soon(self._close, channel, True)
+                return conn
+        except OSError as e:
+            error = e
+        
+        # TCP failed or lost the race: the punched channel is the way in
+        if channel is not None:
+            if channel.ready.wait(max(0.0, deadline - time.monotonic())) and not channel.closed:
+                return self._resolve(channel)
+            self.call_soon(self._close, channel, True)
+            error = error or ConnectionError("no answer over TCP or UDP")
+        print(f"Connection failed: {error}")
+        if username:
+            with self.pool_lock:
+                failure = self.peer_failures.setdefault(username, {'failures': 0})
+                failure['failures'] += 1
+                failure['last_error'] = str(error)
+                failure['since'] = datetime.now().isoformat()
+        return None
+    
+    def _dial(self, addresses, deadline, channel=None):
+        # Happy eyeballs: starts a non-blocking connect to each address CONNECT_STAGGER
+        # after the previous one (at once if that one failed) and returns (sock, address)
+        # of the first that succeeds. Returns (None, None) if the channel got ready first.
+        selector = selectors.DefaultSelector()
+        pending = list(addresses)
+        errors = []
+        next_start = time.monotonic()
+        try:
+            while pending or selector.get_map():
+                now = time.monotonic()
+                if now >= deadline:
+                    errors.append("timed out")
+                    break
+                if channel is not None and channel.ready.is_set():
+                    return None, None
+                if pending and (now >= next_start or not selector.get_map()):
+                    address = pending.pop(0)
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    err = sock.connect_ex(address)
+                    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        errors.append(f"{address[0]}:{address[1]} {os.strerror(err)}")
+                        sock.close()
+                        continue
+                    selector.register(sock, selectors.EVENT_WRITE, address)
+                    next_start = now + self.CONNECT_STAGGER
+                    continue
+                wake = min(deadline, next_start) if pending else deadline
+                # Short slices so a UDP channel that wins is noticed quickly
+                for key, _ in selector.select(min(max(0.0, wake - now), 0.05)):
+                    sock = key.fileobj
+                    selector.unregister(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        return sock, key.data
+                    errors.append(f"{key.data[0]}:{key.data[1]} {os.strerror(err)}")
+                    sock.close()
+            raise ConnectionError('; '.join(errors) or "no address to dial")
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+    
+    def _handshake(self, sock, address, my_username, username, deadline=None, channel=None):
+        # Waits for WELCOME until the deadline (HANDSHAKE_TIMEOUT at most), or until
+        # the punched channel gets ready first so the caller can switch to it
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._tune(sock)
+        conn = PeerConnection(sock, address, username=username, outbound=True)
+        self.start_event_loop()
+        self._enqueue(conn, encode_hello(my_username))
+        
+        limit = time.monotonic() + self.HANDSHAKE_TIMEOUT
+        deadline = min(deadline, limit) if deadline is not None else limit
+        while True:
+            remaining = deadline - time.monotonic()
+            # Short slices while a UDP channel races us, as in _dial
+            ready = conn.ready.wait(max(0.0, min(remaining, 0.05) if channel is not None else remaining))
+            if ready or channel is None or remaining <= 0:
+                break
+            if channel.ready.is_set() and not channel.closed:
+                self.call_soon(self._close, conn, True)
+                raise ConnectionError(f"no handshake from {address[0]}:{address[1]} before the UDP channel was ready")
+        winner = self._resolve(conn)
+        if winner is not conn and not winner.closed:
+            # Our dial lost a simultaneous connect; the connection the peer opened carries on
+            if winner.ready.wait(max(0.0, deadline - time.monotonic())) and not winner.closed:
+                print(f"Connected to {winner.username} over its own connection (protocol v{winner.version})")
+                return winner
+        if not ready or conn.closed:
+            self.call_soon(self._close, conn, True)
+            raise ConnectionError(f"no handshake from {address[0]}:{address[1]}")
+        
+        print(f"Connected to {conn.username} at {address[0]}:{address[1]} (protocol v{conn.version})")
+        return winner
+    
+    def _resolve(self, conn):
+        # Follows a connection that lost a simultaneous-connect race to the one that won
+        while conn.replaced_by is not None and (conn.closed or conn.closing):
+            conn = conn.replaced_by
+        return conn
+    
+    def _enqueue(self, conn, *parts, limit=None):
+        # Queues the parts back to back so no other frame lands between them.
+        # Returns False (and queues nothing) if the queue already holds `limit` bytes
+        with conn.lock:
+            if limit is not None and conn.queued_bytes >= limit:
+                return False
+            was_idle = not conn.send_queue
+            for data in parts:
+                conn.send_queue.append(data)
+                conn.queued_bytes += len(data)
+            conn.frames_out += 1
+            batch = None
+            if was_idle and self.batch_delay and not conn.closing:
+                batch = conn.batch_pending = object()
+            # A batch that has reached BATCH_BYTES goes out without waiting for its deadline
+            flush_now = not was_idle and conn.batch_pending is not None and conn.queued_bytes >= self.batch_bytes
+            if flush_now:
+                conn.batch_pending = None
+        if batch is not None:
+            self.call_later(self.batch_delay, self._flush_batch, conn, batch)
+        elif was_idle or flush_now:
+            self.call_soon(self._watch, conn)
+        return True
+    
+    def _flush_batch(self, conn, batch):
+        if conn.batch_pending is batch:
+            conn.batch_pending = None
+            self._watch(conn)
+    
+    def send_group(self, conns, group, message):
+        # Encodes once and queues the same frame on every member without blocking;
+        # returns {username: delivered_to_queue}
+        frame = encode_group_text(group, message)
+        results = {}
+        for conn in conns:
+            conn = self._resolve(conn)
+            queued = not (conn.closed or conn.closing) and self._enqueue(conn, frame, limit=self.GROUP_QUEUE_LIMIT)
+            if queued:
+                conn.messages_out += 1
+                self._touch(conn)
+            results[conn.label()] = queued
+        return results
+    
+    def send_message(self, conn, message):
+        conn = self._resolve(conn)
+        if conn.closed or conn.closing:
+            print("Send failed: connection closed")
             return False
+        self._enqueue(conn, encode_frame(TEXT, message.encode('utf-8')))
+        conn.messages_out += 1
+        self._touch(conn)
+        
+        # Backpressure: wait for a slow peer instead of buffering without bound
+        with conn.lock:
+            if conn.queued_bytes > self.SEND_HIGH_WATER:
+                conn.drained.wait_for(
+                    lambda: conn.closed or conn.queued_bytes <= self.SEND_LOW_WATER,
+                    timeout=self.SEND_TIMEOUT
+                )
+                if conn.queued_bytes > self.SEND_LOW_WATER:
+                    print(f"Send failed: {conn.label()} is not reading")
+                    return False
+        return not conn.closed
+    
+    def send_file(self, conn, path):
+        # Starts streaming path to the peer and returns the OutgoingTransfer;
+        # wait() on it for the outcome. Offering the same file again resumes it.
+        conn = self._resolve(conn)
+        if conn.closed or conn.closing:
+            raise ConnectionError("connection closed")
+        transfer = OutgoingTransfer(conn, path, self._my_username())
+        previous = self.outgoing_transfers.get(transfer.id)
+        if previous is not None:
+            self.call_soon(self._finish_outgoing, previous, 'failed', 'superseded')
+        self.outgoing_transfers[transfer.id] = transfer
+        self._enqueue(conn, encode_file_offer(transfer.id, transfer.size, transfer.chunk_size, transfer.name))
+        self._touch(conn)
+        return transfer
     
     def stop(self):
         self.running = False
+        self.call_soon(lambda: None)
+        if self.server_thread and self.server_thread is not threading.current_thread():
+            self.server_thread.join(timeout=2)
         if self.tcp_server:
             self.tcp_server.close()
-        for conn in self.active_connections.values():
-            conn['socket'].close()
+        for key in list(self.selector.get_map().values()):
+            if isinstance(key.data, PeerConnection):
+                self._close(key.data, quiet=True)
+        with self.pool_lock:
+            channels = [c for c in self.active_connections.values() if c.datagram]
+        for channel in channels:
+            self._close(channel, quiet=True)
+        if self.udp:
+            self.udp.close()
         self.active_connections.clear()
+        self.selector.close()
+        self.wake_r.close()
+        self.wake_w.close()
 
 class P2PClient:
-    def __init__(self, server_url=None):
+    def __init__(self, server_url=None, heartbeat_interval=None, heartbeat_jitter=None, stun_udp=None):
         self.stun_server = server_url or os.getenv('STUN_SERVER', 'http://stun-server:5000')
+        # UDP STUN service as host:port; defaults to the HTTP server's host on 3478, 'off' disables it
+        self.stun_udp = stun_udp or os.getenv('STUN_UDP') or f"{urlparse(self.stun_server).hostname}:3478"
+        self.local_ip = None
+        # The server forgets a peer after 300 s without news, so the default leaves room for a few misses
+        self.heartbeat_interval = heartbeat_interval or float(os.getenv('HEARTBEAT_INTERVAL', 60))
+        self.heartbeat_jitter = heartbeat_jitter if heartbeat_jitter is not None else float(os.getenv('HEARTBEAT_JITTER', 0.2))
+        self.heartbeat_thread = None
+        self.heartbeat_stop = threading.Event()
         self.username = None
         self.ip = None
         self.port = None
         self.running = True
         self.tcp_manager = None
+        self.peers_etag = None
+        self.peers_cache = []
+        # Local copy of the peer directory, kept current from /peers/changes
+        self.directory = {}
+        self.directory_seq = None
+        self.directory_lock = threading.Lock()
+        self.directory_synced_at = None
+        # Within this many seconds of the last successful sync, lookups never touch the server
+        self.directory_ttl = float(os.getenv('DIRECTORY_TTL', 30))
+        self.watch_thread = None
+        # UDP hole punching: a socket bound next to the TCP port, the addresses it is
+        # reachable at (registered as 'udp'), and a long-poll for punch requests
+        self.udp_enabled = os.getenv('PEER_UDP', '1') == '1'
+        self.udp_socket = None
+        self.udp_candidates = []
+        self.signal_thread = None
+        # Installed on the TCP manager at registration; see TCPManager for the signatures
+        self.message_handler = None
+        self.group_handler = None
+        self.file_handler = None
+        # mailbox_handler(sender, text, sent_at) receives messages stored while we were offline
+        self.mailbox_handler = None
+        self.mailbox_batch = int(os.getenv('MAILBOX_BATCH', 100))
+        # Issued by every registration; reads and acks our mailbox
+        self.mailbox_token = None
+        self.mailbox_lock = threading.Lock()
+        # Auto-mode start-up (start()): overall budget, and the exponential backoff
+        # (full jitter) between attempts at each step
+        self.startup_deadline = float(os.getenv('STARTUP_DEADLINE', 30))
+        self.startup_backoff = float(os.getenv('STARTUP_BACKOFF', 0.25))
+        self.startup_backoff_max = float(os.getenv('STARTUP_BACKOFF_MAX', 4))
+        # Outcome, seconds per step and attempts of the last start()
+        self.startup_report = None
+        # One keep-alive HTTP session for every call to the STUN server
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        # /peers and /peerinfo answer in msgpack when asked, which is smaller and faster to parse
+        self.directory_accept = 'application/msgpack, application/json;q=0.9' if msgpack else 'application/json'
         
         print("=" * 60)
         print("P2P Chat Client")
@@ -176,40 +1353,87 @@ class P2PClient:
         except:
             return "172.20.0.x"
     
+    def discover_public_address(self, sock=None):
+        # With sock, the answer is that socket's own NAT mapping
+        if not self.stun_udp or self.stun_udp == 'off':
+            return None
+        host, _, port = self.stun_udp.rpartition(':')
+        try:
+            return stun_binding_request(host, int(port), sock=sock)
+        except (OSError, ValueError):
+            return None
+    
+    def open_udp_socket(self, port):
+        # Same port number as TCP when it is free, otherwise any
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for candidate in (port, 0):
+            try:
+                sock.bind(('0.0.0.0', candidate))
+                return sock
+            except OSError:
+                continue
+        sock.close()
+        return None
+    
+    def prepare_addresses(self, port):
+        # Binds the UDP socket and asks STUN for its mapping (one round trip)
+        self.local_ip = self.get_container_ip()
+        self.udp_socket = self.open_udp_socket(port) if self.udp_enabled else None
+        # Behind NAT only the reflexive address is reachable from other networks
+        mapped = self.discover_public_address(self.udp_socket)
+        self.ip = mapped[0] if mapped else self.local_ip
+        self.udp_candidates = []
+        if self.udp_socket:
+            local = [self.local_ip, self.udp_socket.getsockname()[1]]
+            self.udp_candidates = [list(mapped), local] if mapped and list(mapped) != local else [local]
+    
+    def start_listener(self, port):
+        manager = TCPManager(self)
+        manager.message_handler = self.message_handler
+        manager.group_handler = self.group_handler
+        manager.file_handler = self.file_handler
+        self.tcp_manager = manager
+        if self.udp_socket:
+            manager.start_udp(self.udp_socket)
+        if manager.start_tcp_server(port):
+            print(f"TCP server ready on port {port}")
+            return True
+        print("Warning: TCP server failed to start")
+        return False
+    
+    def start_services(self):
+        # start() binds the listener while the UDP socket may still be opening
+        if self.udp_socket and self.tcp_manager.udp is None:
+            self.tcp_manager.start_udp(self.udp_socket)
+        self.start_directory_watch()
+        self.start_heartbeat()
+        self.start_mailbox_flush()
+        self.start_signal_watch()
+    
+    def print_registration(self):
+        print(f"Registering with:")
+        print(f"  Username: {self.username}")
+        print(f"  IP: {self.ip}" + (f" (local {self.local_ip})" if self.ip != self.local_ip else ""))
+        print(f"  Port: {self.port}")
+    
     def register(self, username, port):
         try:
             self.username = username
             self.port = port
-            self.ip = self.get_container_ip()
-            
-            print(f"Registering with:")
-            print(f"  Username: {username}")
-            print(f"  IP: {self.ip}")
-            print(f"  Port: {port}")
+            self.prepare_addresses(port)
+            self.peers_etag = None
+            self.directory_seq = None
             
-            data = {
-                "username": username,
-                "ip": self.ip,
-                "port": port
-            }
+            self.print_registration()
             
-            response = requests.post(
-                f"{self.stun_server}/register",
-                json=data,
-                headers={'Content-Type': 'application/json'},
-                timeout=10
-            )
+            response = self.send_registration()
             
             if response.status_code in [200, 201]:
                 result = response.json()
                 print(f"Success: {result['message']}")
                 
-                self.tcp_manager = TCPManager(self)
-                if self.tcp_manager.start_tcp_server(port):
-                    print(f"TCP server ready on port {port}")
-                else:
-                    print("Warning: TCP server failed to start")
-                
+                self.start_listener(port)
+                self.start_services()
                 return True
             else:
                 error = response.json().get('message', 'Unknown error')
@@ -223,33 +1447,341 @@ class P2PClient:
             print(f"Error: {e}")
             return False
     
-    def get_peers(self):
+    def send_registration(self, timeout=10, startup=None):
+        data = {
+            "username": self.username,
+            "ip": self.ip,
+            "port": self.port,
+            "local_ip": self.local_ip
+        }
+        if self.udp_candidates:
+            data['udp'] = self.udp_candidates
+        if startup:
+            # Lets the server chart time-to-register across the fleet
+            data['startup'] = startup
+        
+        response = self.session.post(
+            f"{self.stun_server}/register",
+            json=data,
+            headers={'Content-Type': 'application/json'},
+            timeout=timeout
+        )
+        if response.status_code in [200, 201]:
+            self.mailbox_token = response.json().get('mailbox_token')
+        return response
+    
+    def send_heartbeat(self):
+        response = self.session.post(
+            f"{self.stun_server}/heartbeat",
+            json={"username": self.username},
+            timeout=5
+        )
+        if response.status_code == 404:
+            # Our record expired (e.g. the server was unreachable for a while)
+            response = self.send_registration()
+            if response.status_code in [200, 201]:
+                self.start_mailbox_flush()
+        return response.status_code in [200, 201]
+    
+    def start_heartbeat(self):
+        if self.heartbeat_thread and self.heartbeat_thread.is_alive():
+            return
+        self.heartbeat_stop.clear()
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name="heartbeat")
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+    
+    def _heartbeat_loop(self):
+        # Jitter spreads out a fleet that was started at the same moment
+        while not self.heartbeat_stop.wait(
+                self.heartbeat_interval * random.uniform(1 - self.heartbeat_jitter, 1 + self.heartbeat_jitter)):
+            if not self.running or not self.username:
+                break
+            try:
+                self.send_heartbeat()
+            except requests.exceptions.RequestException:
+                pass
+    
+    def store_offline(self, username, message):
+        # Leaves the message in the recipient's server mailbox for their next registration
+        try:
+            response = self.session.post(
+                f"{self.stun_server}/mailbox",
+                json={"from": self.username, "to": username, "text": message},
+                timeout=5
+            )
+        except requests.exceptions.RequestException:
+            print(f"Message to {username} lost: server unreachable")
+            return False
+        if response.status_code != 201:
+            print(f"Message to {username} not stored: {response.json().get('message', 'Unknown error')}")
+            return False
+        print(f"{username} is unreachable; message stored for later delivery")
+        return True
+    
+    def flush_mailbox(self):
+        # Delivers stored messages in batches and acks each batch once it was handed over;
+        # a crash before the ack delivers that batch again next time
+        if not self.mailbox_lock.acquire(blocking=False):
+            return 0
         try:
-            response = requests.get(
+            delivered = 0
+            after = None
+            headers = {'Authorization': f"Bearer {self.mailbox_token}"}
+            while self.running and self.username and self.mailbox_token:
+                params = {'username': self.username, 'limit': self.mailbox_batch}
+                if after:
+                    params['after'] = after
+                response = self.session.get(f"{self.stun_server}/mailbox", params=params,
+                                            headers=headers, timeout=10)
+                if response.status_code != 200:
+                    break
+                messages = response.json().get('messages', [])
+                if not messages:
+                    break
+                for message in messages:
+                    self._deliver_stored(message)
+                ids = [m['id'] for m in messages]
+                self.session.post(
+                    f"{self.stun_server}/mailbox/ack",
+                    json={"username": self.username, "ids": ids},
+                    headers=headers,
+                    timeout=10
+                )
+                delivered += len(messages)
+                after = ids[-1]
+            return delivered
+        finally:
+            self.mailbox_lock.release()
+    
+    def _deliver_stored(self, message):
+        if self.mailbox_handler:
+            self.mailbox_handler(message['from'], message['text'], message['sent_at'])
+        else:
+            sent_at = message['sent_at'][:19].replace('T', ' ')
+            print(f"\n[{sent_at}] {message['from']} (while you were away): {message['text']}")
+    
+    def start_mailbox_flush(self):
+        def run():
+            try:
+                count = self.flush_mailbox()
+                if count and not self.mailbox_handler:
+                    print(f"Delivered {count} stored messages")
+                    print("Your message: ", end="", flush=True)
+            except requests.exceptions.RequestException as e:
+                print(f"Mailbox fetch failed: {e}")
+        threading.Thread(target=run, name="mailbox", daemon=True).start()
+    
+    @staticmethod
+    def decode_body(response):
+        if msgpack and response.headers.get('Content-Type', '').startswith('application/msgpack'):
+            return msgpack.unpackb(response.content)
+        return response.json()
+    
+    def fetch_peers(self, page_size=500):
+        # Walks the paginated /peers listing; the first page carries the
+        # directory ETag so an unchanged directory costs a single 304
+        headers = {'Accept': self.directory_accept}
+        if self.peers_etag:
+            headers['If-None-Match'] = self.peers_etag
+        params = {'limit': page_size}
+        if self.username:
+            params['exclude'] = self.username
+        
+        peers = []
+        etag = None
+        while True:
+            response = self.session.get(
                 f"{self.stun_server}/peers",
+                params=params,
+                headers=headers,
                 timeout=5
             )
+            if response.status_code == 304:
+                return self.peers_cache
+            if response.status_code != 200:
+                return None
             
-            if response.status_code == 200:
-                result = response.json()
-                peers = result.get('peers', [])
-                
-                peers = [p for p in peers if p['username'] != self.username]
-                
-                if peers:
-                    print(f"\nOnline peers ({len(peers)}):")
-                    print("-" * 50)
-                    for i, peer in enumerate(peers, 1):
-                        status = peer.get('status', 'unknown')
-                        print(f"{i}. {peer['username']} - {peer['ip']}:{peer['port']} ({status})")
-                    print("-" * 50)
+            if etag is None:
+                etag = response.headers.get('ETag')
+            headers = {'Accept': self.directory_accept}
+            result = self.decode_body(response)
+            peers.extend(result.get('peers', []))
+            if not result.get('next_cursor'):
+                break
+            params['cursor'] = result['next_cursor']
+        
+        self.peers_etag = etag
+        self.peers_cache = peers
+        return peers
+    
+    def fetch_changes(self, since=None, wait=0):
+        params = {'timeout': wait}
+        if since:
+            params['since'] = since
+        response = self.session.get(
+            f"{self.stun_server}/peers/changes",
+            params=params,
+            timeout=wait + 5
+        )
+        if response.status_code != 200:
+            return None
+        return response.json()
+    
+    def sync_directory(self, wait=0):
+        with self.directory_lock:
+            since = self.directory_seq
+        
+        if since is None:
+            # Take the feed position first so nothing between it and the snapshot is lost
+            changes = self.fetch_changes()
+            if changes is None:
+                return False
+            peers = self.fetch_peers()
+            if peers is None:
+                return False
+            with self.directory_lock:
+                self.directory = {p['username']: p for p in peers}
+                self.directory_seq = changes['last_id']
+                self.directory_synced_at = time.monotonic()
+            return True
+        
+        changes = self.fetch_changes(since, wait)
+        if changes is None:
+            return False
+        if changes.get('reset'):
+            with self.directory_lock:
+                self.directory_seq = None
+            return self.sync_directory()
+        
+        with self.directory_lock:
+            if self.directory_seq != since:
+                return True
+            for event in changes['events']:
+                username = event['username']
+                if username == self.username:
+                    continue
+                if event['type'] == 'left':
+                    self.directory.pop(username, None)
                 else:
-                    print("\nNo online peers")
-                
-                return peers
-            else:
+                    self.directory[username] = event['peer']
+            self.directory_seq = changes['last_id']
+            self.directory_synced_at = time.monotonic()
+        return True
+    
+    def directory_is_fresh(self):
+        synced_at = self.directory_synced_at
+        return synced_at is not None and time.monotonic() - synced_at < self.directory_ttl
+    
+    def ensure_directory(self):
+        # The watcher thread keeps the cache fresh; only a stale cache costs a request
+        if self.directory_is_fresh():
+            return True
+        return self.sync_directory()
+    
+    def lookup_peer(self, username):
+        if self.ensure_directory():
+            with self.directory_lock:
+                peer = self.directory.get(username)
+            if peer:
+                return peer
+        return self.get_peer_info(username)
+    
+    def forget_peer(self, username):
+        with self.directory_lock:
+            self.directory.pop(username, None)
+    
+    def start_directory_watch(self):
+        if self.watch_thread and self.watch_thread.is_alive():
+            return
+        self.watch_thread = threading.Thread(target=self._watch_directory, name="directory-watch")
+        self.watch_thread.daemon = True
+        self.watch_thread.start()
+    
+    def _watch_directory(self):
+        while self.running and self.username:
+            try:
+                if not self.sync_directory(wait=20):
+                    time.sleep(2)
+            except Exception:
+                time.sleep(2)
+    
+    def start_punch(self, username, peer):
+        # Starts punching towards the peer's UDP addresses and asks it, through the
+        # server, to punch back at ours. Returns the DatagramChannel or None.
+        udp = self.tcp_manager.udp if self.tcp_manager else None
+        candidates = [tuple(c) for c in peer.get('udp') or []]
+        if not udp or not candidates or not self.udp_candidates:
+            return None
+        channel = udp.open(username, candidates)
+        signal = {
+            "from": self.username,
+            "to": username,
+            "session": f"{channel.session:016x}",
+            "candidates": self.udp_candidates
+        }
+        # Off the connect path, so the TCP attempts start without waiting for the server
+        threading.Thread(target=self._send_signal, args=(signal,), name="punch-signal", daemon=True).start()
+        return channel
+    
+    def _send_signal(self, signal):
+        try:
+            self.session.post(f"{self.stun_server}/signal", json=signal, timeout=5)
+        except requests.exceptions.RequestException:
+            pass  # the TCP attempts still run
+    
+    def start_signal_watch(self):
+        if not self.tcp_manager or not self.tcp_manager.udp:
+            return
+        if self.signal_thread and self.signal_thread.is_alive():
+            return
+        self.signal_thread = threading.Thread(target=self._watch_signals, name="signal-watch")
+        self.signal_thread.daemon = True
+        self.signal_thread.start()
+    
+    def _watch_signals(self):
+        # Long-polls the punch requests other peers leave for us and punches back
+        since = None
+        while self.running and self.username and self.tcp_manager and self.tcp_manager.udp:
+            params = {'username': self.username, 'timeout': 20}
+            if since:
+                params['since'] = since
+            try:
+                response = self.session.get(f"{self.stun_server}/signal", params=params, timeout=30)
+            except requests.exceptions.RequestException:
+                time.sleep(2)
+                continue
+            if response.status_code == 404:
+                return  # server without hole-punching support
+            if response.status_code != 200:
+                time.sleep(2)
+                continue
+            result = response.json()
+            since = result.get('last_id', since)
+            for signal in result.get('signals', []):
+                self.tcp_manager.udp.accept(signal)
+    
+    def get_peers(self):
+        try:
+            # Served from memory while fresh; a full download happens on first use or reset
+            if not self.ensure_directory():
                 print("Error getting peers list")
                 return []
+            
+            with self.directory_lock:
+                peers = sorted(self.directory.values(), key=lambda p: p['username'])
+            
+            if peers:
+                print(f"\nOnline peers ({len(peers)}):")
+                print("-" * 50)
+                for i, peer in enumerate(peers, 1):
+                    status = peer.get('status', 'unknown')
+                    print(f"{i}. {peer['username']} - {peer['ip']}:{peer['port']} ({status})")
+                print("-" * 50)
+            else:
+                print("\nNo online peers")
+            
+            return peers
                 
         except requests.exceptions.ConnectionError:
             print("Cannot connect to server")
@@ -258,17 +1790,25 @@ class P2PClient:
             print(f"Error: {e}")
             return []
     
+    def list_peers(self):
+        # get_peers without the printout, for programmatic use
+        if not self.ensure_directory():
+            return []
+        with self.directory_lock:
+            return sorted(self.directory.values(), key=lambda p: p['username'])
+    
     def get_peer_info(self, username):
         try:
             params = {'username': username}
-            response = requests.get(
+            response = self.session.get(
                 f"{self.stun_server}/peerinfo",
                 params=params,
+                headers={'Accept': self.directory_accept},
                 timeout=5
             )
             
             if response.status_code == 200:
-                result = response.json()
+                result = self.decode_body(response)
                 return result.get('peer')
             else:
                 print(f"User '{username}' not found")
@@ -293,16 +1833,10 @@ class P2PClient:
             
             if 0 <= idx < len(peers):
                 peer = peers[idx]
-                print(f"Connecting to {peer['username']} at {peer['ip']}:{peer['port']}...")
-                
-                sock = self.tcp_manager.connect_to_peer(
-                    peer['ip'], 
-                    peer['port'], 
-                    self.username
-                )
+                conn = self.connect_to_username(peer['username'], peer)
                 
-                if sock:
-                    self.chat_with_peer(sock, peer['username'])
+                if conn:
+                    self.chat_with_peer(conn, peer['username'])
                 else:
                     print("Connection failed")
             else:
@@ -313,7 +1847,131 @@ class P2PClient:
         except Exception as e:
             print(f"Error: {e}")
     
-    def chat_with_peer(self, sock, peer_username):
+    def connect_to_username(self, username, peer=None):
+        peer = peer or self.lookup_peer(username)
+        if not peer:
+            return None
+        print(f"Connecting to {username} at {peer['ip']}:{peer['port']}...")
+        conn = self._connect_peer(username, peer)
+        if conn:
+            return conn
+        
+        # The cached address may be stale: ask the server once more
+        self.forget_peer(username)
+        fresh = self.get_peer_info(username)
+        fields = ('ip', 'port', 'local_ip', 'udp')
+        if not fresh or all(fresh.get(f) == peer.get(f) for f in fields):
+            return None
+        print(f"Retrying {username} at {fresh['ip']}:{fresh['port']}...")
+        return self._connect_peer(username, fresh)
+    
+    def _connect_peer(self, username, peer):
+        # Same-network peers are also tried on their LAN address, and over UDP in parallel
+        alternates = [(peer['local_ip'], peer['port'])] if peer.get('local_ip') else []
+        return self.tcp_manager.get_connection(
+            username, peer['ip'], peer['port'], alternates, lambda: self.start_punch(username, peer)
+        )
+    
+    def send_message(self, username, message, store=True):
+        # True once the message is queued to the peer or, when it cannot be reached, stored on the server
+        if not self.tcp_manager:
+            return False
+        conn = self.connect_to_username(username)
+        if conn and self.tcp_manager.send_message(conn, message):
+            return True
+        return store and self.store_offline(username, message)
+    
+    def send_group(self, usernames, group, message):
+        # Returns {username: queued}; members that cannot be reached map to False
+        if not self.tcp_manager:
+            return {username: False for username in usernames}
+        with ThreadPoolExecutor(max_workers=max(1, min(16, len(usernames)))) as pool:
+            conns = dict(zip(usernames, pool.map(self.connect_to_username, usernames)))
+        results = self.tcp_manager.send_group([c for c in conns.values() if c], group, message)
+        return {username: bool(conn) and results.get(conn.label(), False) for username, conn in conns.items()}
+    
+    def send_file(self, username, path, attempts=3):
+        # Streams a file to a peer, reconnecting and resuming if the connection drops
+        if not os.path.isfile(path):
+            print(f"No such file: {path}")
+            return False
+        
+        for attempt in range(attempts):
+            conn = self.connect_to_username(username)
+            if not conn:
+                time.sleep(min(2 ** attempt, 10))
+                continue
+            try:
+                transfer = self.tcp_manager.send_file(conn, path)
+            except (ConnectionError, OSError) as e:
+                print(f"Send failed: {e}")
+                return False
+            
+            while not transfer.wait(1.0):
+                info = transfer.progress()
+                if info['size']:
+                    print(f"  {transfer.name}: {100 * info['acked'] // info['size']}% ({info['mb_per_s']} MB/s)")
+            
+            info = transfer.progress()
+            if transfer.state == 'done':
+                print(f"Sent {transfer.name} to {username} ({info['size']} bytes, {info['mb_per_s']} MB/s)")
+                return True
+            print(f"Transfer {transfer.state}: {transfer.error}")
+            if transfer.state != 'interrupted':
+                return False
+            print(f"Resuming from {info['acked']} bytes...")
+        return False
+    
+    def group_chat(self):
+        if not self.tcp_manager:
+            print("TCP manager not initialized")
+            return
+        
+        peers = self.get_peers()
+        if not peers:
+            return
+        
+        try:
+            choice = input("Select peer numbers (comma separated): ").strip()
+            indexes = [int(c) - 1 for c in choice.split(',') if c.strip()]
+            if not indexes or min(indexes) < 0:
+                print("Invalid selection")
+                return
+            members = [peers[i] for i in dict.fromkeys(indexes)]
+            group = input("Group name: ").strip() or "group"
+        except (ValueError, IndexError):
+            print("Please enter valid peer numbers")
+            return
+        
+        # Dial all members at once instead of one after another
+        with ThreadPoolExecutor(max_workers=min(16, len(members))) as pool:
+            conns = list(pool.map(lambda p: self.connect_to_username(p['username'], p), members))
+        conns = [c for c in conns if c]
+        if not conns:
+            print("Could not connect to any member")
+            return
+        
+        print(f"\n--- Group '{group}' with {', '.join(c.label() for c in conns)} ---")
+        print("Type 'exit' to end chat")
+        print("-" * 30)
+        
+        try:
+            while self.running:
+                message = input("Your message: ").strip()
+                if message.lower() == 'exit':
+                    print("Ending chat...")
+                    break
+                if not message:
+                    continue
+                results = self.tcp_manager.send_group(conns, group, message)
+                missed = [name for name, ok in results.items() if not ok]
+                print(f"You @{group}: {message}")
+                if missed:
+                    print(f"Not delivered to: {', '.join(missed)}")
+        except KeyboardInterrupt:
+            print("\nChat interrupted")
+    
+    def chat_with_peer(self, conn, peer_username):
         print(f"\n--- Chat with {peer_username} ---")
         print("Type 'exit' to end chat")
         print("-" * 30)
@@ -328,12 +1986,12 @@ class P2PClient:
                         break
                     
                     if message:
-                        sock.send(message.encode('utf-8'))
+                        if not self.tcp_manager.send_message(conn, message):
+                            print("Connection lost!")
+                            self.store_offline(peer_username, message)
+                            break
                         print(f"You: {message}")
                         
-                except (BrokenPipeError, ConnectionResetError):
-                    print("Connection lost!")
-                    break
                 except Exception as e:
                     print(f"Error: {e}")
                     break
@@ -345,7 +2003,7 @@ class P2PClient:
     
     def test_server(self):
         try:
-            response = requests.get(f"{self.stun_server}/health", timeout=5)
+            response = self.session.get(f"{self.stun_server}/health", timeout=5)
             if response.status_code == 200:
                 print("STUN server is available")
                 return True
@@ -363,7 +2021,7 @@ class P2PClient:
                 return False
             
             data = {"username": self.username}
-            response = requests.post(
+            response = self.session.post(
                 f"{self.stun_server}/unregister",
                 json=data,
                 timeout=5
@@ -371,6 +2029,7 @@ class P2PClient:
             
             if response.status_code == 200:
                 print("Successfully unregistered")
+                self.heartbeat_stop.set()
                 
                 if self.tcp_manager:
                     self.tcp_manager.stop()
@@ -387,19 +2046,136 @@ class P2PClient:
             return False
     
     def auto_register(self, username, port):
+        return asyncio.run(self.start(username, port))
+    
+    async def start(self, username, port, deadline=None):
+        # Probes the server, learns our addresses and binds the listener at the same
+        # time, then registers. Server-side failures are retried with exponential
+        # backoff and full jitter until `deadline` seconds have passed; answers that
+        # cannot change by asking again (not a P2P server, 4xx) fail at once.
         print(f"Auto-registering as '{username}'...")
+        self.username = username
+        self.port = port
+        self.peers_etag = None
+        self.directory_seq = None
+        began = time.monotonic()
+        expires = began + (deadline or self.startup_deadline)
+        report = self.startup_report = {"outcome": None, "seconds": None, "steps": {}, "attempts": {}}
         
-        max_retries = 10
-        for i in range(max_retries):
-            if self.test_server():
-                if self.register(username, port):
-                    return True
-            else:
-                print(f"Attempt {i+1}/{max_retries} - waiting for server...")
-                time.sleep(2)
+        async def timed(step, func, *args):
+            start = time.monotonic()
+            try:
+                return await asyncio.to_thread(func, *args)
+            finally:
+                report['steps'][step] = round(time.monotonic() - start, 4)
         
-        print("Auto-registration failed")
-        return False
+        async def retried(step, attempt, *args):
+            start = time.monotonic()
+            try:
+                return await self._with_backoff(step, expires, attempt, *args)
+            finally:
+                report['steps'][step] = round(time.monotonic() - start, 4)
+        
+        probe = asyncio.ensure_future(retried('probe', self._probe_once))
+        addresses = asyncio.ensure_future(timed('addresses', self.prepare_addresses, port))
+        listener = asyncio.ensure_future(timed('listener', self.start_listener, port))
+        outcome = 'failed'
+        try:
+            outcome = await probe
+            await addresses
+            if outcome == 'ok' and not await listener:
+                # Registering an address nobody can connect to would only strand the peers dialing it
+                print(f"Cannot listen on port {port}, not registering")
+                outcome = 'fatal'
+            if outcome == 'ok':
+                self.print_registration()
+                outcome = await retried('register', self._register_once, began)
+            await listener
+        except Exception as e:
+            print(f"Error: {e}")
+            outcome = 'failed'
+        finally:
+            report['outcome'] = 'ready' if outcome == 'ok' else outcome
+            report['seconds'] = round(time.monotonic() - began, 4)
+            if outcome != 'ok':
+                # Threads cannot be cancelled; let them finish before undoing their work
+                await asyncio.gather(probe, addresses, listener, return_exceptions=True)
+                self._abort_start()
+        
+        if outcome != 'ok':
+            print(f"Auto-registration failed ({outcome}) after {report['seconds']:.2f}s")
+            return False
+        self.start_services()
+        steps = ', '.join(f"{step} {seconds * 1000:.0f} ms" for step, seconds in report['steps'].items())
+        print(f"Ready in {report['seconds'] * 1000:.0f} ms ({steps})")
+        return True
+    
+    async def _with_backoff(self, step, expires, attempt, *args):
+        # Calls attempt(timeout, *args) in a thread until it returns something other
+        # than 'retry', or 'timeout' once less than 100 ms is left before `expires`
+        tries = 0
+        while True:
+            remaining = expires - time.monotonic()
+            if remaining < 0.1:
+                return 'timeout'
+            tries += 1
+            self.startup_report['attempts'][step] = tries
+            result = await asyncio.to_thread(attempt, min(10, remaining), *args)
+            if result != 'retry':
+                return result
+            delay = random.uniform(0, min(self.startup_backoff_max, self.startup_backoff * 2 ** tries))
+            delay = max(0, min(delay, expires - time.monotonic() - 0.1))
+            print(f"Attempt {tries} at {step} failed, retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+    
+    def _probe_once(self, timeout):
+        try:
+            response = self.session.get(f"{self.stun_server}/health", timeout=timeout)
+        except requests.exceptions.RequestException:
+            print(f"Cannot connect to server: {self.stun_server}")
+            return 'retry'
+        if response.status_code >= 500:
+            return 'retry'
+        try:
+            health = response.json()
+        except ValueError:
+            health = None
+        if response.status_code != 200 or not isinstance(health, dict) or 'redis' not in health:
+            print(f"{self.stun_server} is not a P2P STUN server (HTTP {response.status_code})")
+            return 'fatal'
+        if health['redis'] != 'connected':
+            print("STUN server is up but its Redis is not")
+            return 'retry'
+        print("STUN server is available")
+        return 'ok'
+    
+    def _register_once(self, timeout, began):
+        startup = {"seconds": round(time.monotonic() - began, 4),
+                   "attempt": self.startup_report['attempts'].get('register', 1)}
+        try:
+            response = self.send_registration(timeout, startup)
+        except requests.exceptions.RequestException as e:
+            print(f"Registration failed: {e.__class__.__name__}")
+            return 'retry'
+        if response.status_code in [200, 201]:
+            print(f"Success: {response.json()['message']}")
+            return 'ok'
+        try:
+            error = response.json().get('message', 'Unknown error')
+        except ValueError:
+            error = response.reason
+        print(f"Error: {error}")
+        # 5xx and 429 are the server or its Redis having a moment; a 4xx will not change
+        return 'retry' if response.status_code >= 500 or response.status_code == 429 else 'fatal'
+    
+    def _abort_start(self):
+        if self.tcp_manager:
+            self.tcp_manager.stop()
+            self.tcp_manager = None
+        if self.udp_socket:
+            self.udp_socket.close()
+            self.udp_socket = None
+        self.username = None
     
     def interactive_mode(self):
         while self.running:
@@ -410,6 +2186,10 @@ class P2PClient:
             print("3. Connect to peer (P2P Chat)")
             print("4. Test server connection")
             print("5. Unregister")
+            print("6. Group chat")
+            print("7. Send file")
+            print("8. Connection stats")
+            print("9. Send message (stored if offline)")
             print("0. Exit")
             print("=" * 50)
             
@@ -428,7 +2208,7 @@ class P2PClient:
                         continue
                     target = input("Username: ").strip()
                     if target:
-                        info = self.get_peer_info(target)
+                        info = self.lookup_peer(target)
                         if info:
                             print(f"\nInfo for {target}:")
                             for k, v in info.items():
@@ -446,6 +2226,37 @@ class P2PClient:
                 elif choice == "5":
                     self.unregister()
                     
+                elif choice == "6":
+                    if not self.username:
+                        print("Please register first")
+                        continue
+                    self.group_chat()
+                    
+                elif choice == "7":
+                    if not self.username:
+                        print("Please register first")
+                        continue
+                    target = input("Username: ").strip()
+                    path = input("File path: ").strip()
+                    if target and path:
+                        self.send_file(target, path)
+                    
+                elif choice == "8":
+                    if not self.tcp_manager:
+                        print("TCP manager not initialized")
+                        continue
+                    print(json.dumps(self.tcp_manager.stats(), indent=2))
+                    
+                elif choice == "9":
+                    if not self.username:
+                        print("Please register first")
+                        continue
+                    target = input("Username: ").strip()
+                    message = input("Message: ").strip()
+                    if target and message:
+                        if self.send_message(target, message):
+                            print(f"You -> {target}: {message}")
+                    
                 elif choice == "0":
                     print("\nGoodbye!")
                     self.running = False
@@ -471,10 +2282,13 @@ def main():
     parser.add_argument('--username', help='Username for auto-registration')
     parser.add_argument('--port', type=int, default=5001, help='Port number')
     parser.add_argument('--auto', action='store_true', help='Auto mode')
+    parser.add_argument('--heartbeat-interval', type=float, default=None, help='Seconds between heartbeats')
+    parser.add_argument('--heartbeat-jitter', type=float, default=None, help='Random +/- fraction added to the interval')
+    parser.add_argument('--stun-udp', default=None, help="UDP STUN service host:port ('off' to disable)")
     
     args = parser.parse_args()
     
-    client = P2PClient(args.server)
+    client = P2PClient(args.server, args.heartbeat_interval, args.heartbeat_jitter, args.stun_udp)
     
     if args.auto and args.username:
         if client.auto_register(args.username, args.port):
@@ -0,0 +1,198 @@
+#Headless peer client controlled over a local socket
+#
+#    python daemon.py --username alice --port 5001 --control /tmp/p2p-alice.sock
+#    python daemon.py --control /tmp/p2p-alice.sock --command '{"cmd": "send", "to": "bob", "text": "hi"}'
+#
+#The control socket speaks JSON lines. Every request is an object with "cmd"
+#and an optional "id" that is echoed in the reply:
+#  status                          -> username, connection states and start-up timings
+#  stats                           -> transport counters, RTTs and thread counts
+#  peers                           -> online peers
+#  send       to, text             -> whether the message was queued
+#  group      to (list), group, text -> {username: queued}
+#  send_file  to, path             -> whether the transfer completed
+#  subscribe                       -> acknowledged, then one {"event": ...} line per incoming message
+#  shutdown                        -> unregisters and exits
+#--control accepts a Unix socket path or host:port; the host must be a loopback address.
+import argparse
+import asyncio
+import ipaddress
+import json
+import os
+import signal
+import socket
+import sys
+
+from api import AsyncP2PClient
+
+def parse_control(control):
+    # (host, port) or a Unix socket path; raises ValueError for a host that is not loopback
+    host, sep, port = control.rpartition(':')
+    if sep and port.isdigit() and '/' not in control:
+        host = host.strip('[]') or '127.0.0.1'
+        if host != 'localhost':
+            try:
+                loopback = ipaddress.ip_address(host).is_loopback
+            except ValueError:
+                loopback = False
+            if not loopback:
+                raise ValueError(f"control address {control} is not a loopback address")
+        return host, int(port)
+    return control
+
+class Daemon:
+    def __init__(self, client, control):
+        self.client = client
+        self.control = control
+        self.server = None
+        self.stopped = asyncio.Event()
+
+    async def start(self):
+        address = parse_control(self.control)
+        if isinstance(address, tuple):
+            self.server = await asyncio.start_server(self.handle, address[0], address[1])
+        else:
+            if os.path.exists(address):
+                os.unlink(address)
+            self.server = await asyncio.start_unix_server(self.handle, address)
+        print(f"Control socket listening on {self.control}", flush=True)
+
+    async def handle(self, reader, writer):
+        try:
+            while not self.stopped.is_set():
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("request must be a JSON object")
+                except ValueError as e:
+                    await self.reply(writer, {"ok": False, "error": f"bad request: {e}"})
+                    continue
+                if request.get('cmd') == 'subscribe':
+                    await self.reply(writer, {"ok": True, "id": request.get('id')})
+                    await self.stream(writer)
+                    break
+                await self.reply(writer, await self.execute(request))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def reply(self, writer, response):
+        writer.write(json.dumps(response).encode('utf-8') + b'\n')
+        await writer.drain()
+
+    async def stream(self, writer):
+        stream = self.client.messages()
+        try:
+            async for message in stream:
+                event = {"event": message.kind, "from": message.sender, "text": message.text,
+                         "received_at": message.received_at}
+                if message.group is not None:
+                    event["group"] = message.group
+                if message.path is not None:
+                    event["path"] = message.path
+                await self.reply(writer, event)
+        finally:
+            stream.close()
+
+    async def execute(self, request):
+        cmd = request.get('cmd')
+        response = {"id": request.get('id')}
+        try:
+            if cmd == 'status':
+                response.update(ok=True, username=self.client.username, connections=self.client.connections(),
+                                startup=self.client.client.startup_report)
+            elif cmd == 'stats':
+                response.update(ok=True, stats=self.client.stats())
+            elif cmd == 'peers':
+                response.update(ok=True, peers=await self.client.peers())
+            elif cmd == 'send':
+                response.update(ok=await self.client.send(request['to'], request['text']))
+            elif cmd == 'group':
+                results = await self.client.send_group(request['to'], request.get('group', 'group'), request['text'])
+                response.update(ok=any(results.values()), results=results)
+            elif cmd == 'send_file':
+                response.update(ok=await self.client.send_file(request['to'], request['path']))
+            elif cmd == 'shutdown':
+                response.update(ok=True)
+                self.stopped.set()
+            else:
+                response.update(ok=False, error=f"unknown command: {cmd}")
+        except KeyError as e:
+            response.update(ok=False, error=f"missing field: {e.args[0]}")
+        return response
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        if isinstance(parse_control(self.control), str) and os.path.exists(self.control):
+            os.unlink(self.control)
+        await self.client.close()
+
+async def run(args):
+    client = AsyncP2PClient(args.server, heartbeat_interval=args.heartbeat_interval, stun_udp=args.stun_udp)
+    if not await client.start(args.username, args.port):
+        return 1
+    daemon = Daemon(client, args.control)
+    await daemon.start()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, daemon.stopped.set)
+    await daemon.stopped.wait()
+    await daemon.close()
+    return 0
+
+def send_command(control, command, timeout=30):
+    # One request/response round trip (or the event stream for subscribe); used by --command
+    address = parse_control(control)
+    try:
+        request = json.loads(command)
+    except ValueError:
+        request = None
+    if not isinstance(request, dict):
+        raise ValueError(f"--command must be a JSON object, got {command!r}")
+    subscribe = request.get('cmd') == 'subscribe'
+    if isinstance(address, tuple):
+        family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+    else:
+        family = socket.AF_UNIX
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(None if subscribe else timeout)
+        sock.connect(address)
+        sock.sendall(command.encode('utf-8').rstrip(b'\n') + b'\n')
+        with sock.makefile('rb') as reader:
+            for line in reader:
+                print(line.decode('utf-8').rstrip('\n'), flush=True)
+                if not subscribe:
+                    break
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless P2P client daemon')
+    parser.add_argument('--server', default=None, help='STUN server address')
+    parser.add_argument('--username', help='Username to register')
+    parser.add_argument('--port', type=int, default=5001, help='Peer TCP port')
+    parser.add_argument('--heartbeat-interval', type=float, default=None, help='Seconds between heartbeats')
+    parser.add_argument('--stun-udp', default=None, help="UDP STUN service host:port ('off' to disable)")
+    parser.add_argument('--control', default=os.getenv('P2P_CONTROL', '/tmp/p2p-client.sock'),
+                        help='Control socket: Unix socket path or host:port')
+    parser.add_argument('--command', help='Send one JSON command to a running daemon and print the reply')
+    args = parser.parse_args()
+
+    try:
+        parse_control(args.control)
+        if args.command:
+            send_command(args.control, args.command)
+            return
+    except ValueError as e:
+        parser.error(str(e))
+    if not args.username:
+        parser.error('--username is required to start the daemon')
+    sys.exit(asyncio.run(run(args)))
+
+if __name__ == '__main__':
+    main()
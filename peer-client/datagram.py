@@ -0,0 +1,160 @@
+#Reliable, ordered delivery over UDP for peers that can only reach each other
+#through NAT hole punching
+#
+#Every packet starts with a 14-byte header: magic byte, kind, session id and a
+#sequence number. Both peers send PUNCH packets (carrying their username) to
+#every UDP address the other registered, at the same time, which opens a
+#mapping in each NAT; the first PUNCH or PUNCH_ACK that arrives fixes the
+#peer's address. After that DATA packets carry consecutive slices of the same
+#frame stream a TCP connection would carry, and ACK carries the next sequence
+#number the receiver expects (cumulative). The sender keeps up to WINDOW
+#segments in flight and resends the oldest one when its timer (RFC 6298
+#estimate, doubled per retry) expires or after three duplicate ACKs; until
+#everything sent before that point is acknowledged, each partial ACK resends
+#the next hole straight away (NewReno, RFC 6582).
+import collections
+import os
+import struct
+
+PACKET_HEADER = struct.Struct('!BBQI')  # magic, kind, session, sequence
+MAGIC = 0xD7
+
+PUNCH = 1
+PUNCH_ACK = 2
+DATA = 3
+ACK = 4
+CLOSE = 5
+
+# Stays under the 1280-byte IPv6 minimum MTU with IP, UDP and our headers
+SEGMENT_SIZE = int(os.getenv('UDP_SEGMENT_SIZE', 1180))
+WINDOW = int(os.getenv('UDP_WINDOW', 64))
+MIN_RTO = 0.2
+MAX_RTO = 5.0
+INITIAL_RTO = 1.0
+# Timeouts in a row on the same segment before the channel is given up
+MAX_RETRIES = 8
+DUPLICATE_ACKS = 3
+
+def new_session():
+    return int.from_bytes(os.urandom(8), 'big')
+
+def encode_packet(kind, session, seq=0, payload=b''):
+    return PACKET_HEADER.pack(MAGIC, kind, session, seq) + payload
+
+def decode_packet(data):
+    # Returns (kind, session, seq, payload), or None for anything that is not ours
+    if len(data) < PACKET_HEADER.size or data[0] != MAGIC:
+        return None
+    _, kind, session, seq = PACKET_HEADER.unpack_from(data)
+    return kind, session, seq, memoryview(data)[PACKET_HEADER.size:]
+
+class SendWindow:
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.next_seq = 0
+        # seq -> [segment, sent_at, retransmitted]
+        self.in_flight = collections.OrderedDict()
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.retries = 0
+        self.timer_start = None
+        self.last_ack = 0
+        self.duplicates = 0
+        self.retransmits = 0
+        # next_seq when loss recovery started, or None outside recovery
+        self.recover = None
+
+    def can_send(self):
+        return len(self.in_flight) < self.window
+
+    def add(self, segment, now):
+        seq = self.next_seq
+        self.next_seq += 1
+        if not self.in_flight:
+            self.timer_start = now
+        self.in_flight[seq] = [segment, now, False]
+        return seq
+
+    def ack(self, next_expected, now):
+        # Drops every segment below next_expected; returns (bytes acknowledged,
+        # (seq, segment) to fast-retransmit or None)
+        acked = 0
+        sample = now
+        while self.in_flight:
+            seq = next(iter(self.in_flight))
+            if seq >= next_expected:
+                break
+            segment, sent_at, resent = self.in_flight.popitem(last=False)[1]
+            acked += len(segment)
+            # Karn's rule: an ACK covering a retransmitted segment gives no RTT
+            # sample, nor do later segments that sat behind the hole it filled
+            sample = None if resent or sample is None else now - sent_at
+        if acked:
+            self.last_ack = next_expected
+            self.duplicates = 0
+            self.retries = 0
+            self.timer_start = now
+            if sample is not None:
+                self._update_rto(sample)
+            if self.recover is not None:
+                if next_expected < self.recover and self.in_flight:
+                    # Partial ACK: the next segment was lost too
+                    return acked, self._resend_oldest(now)
+                self.recover = None
+            return acked, None
+        if next_expected == self.last_ack and self.in_flight:
+            self.duplicates += 1
+            if self.duplicates == DUPLICATE_ACKS and self.recover is None:
+                self.recover = self.next_seq
+                return 0, self._resend_oldest(now)
+        return 0, None
+
+    def _update_rto(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def deadline(self):
+        # When the retransmission timer fires, or None with nothing in flight
+        if not self.in_flight:
+            return None
+        return self.timer_start + min(MAX_RTO, self.rto * 2 ** self.retries)
+
+    def due(self, now):
+        # (seq, segment) to resend if the timer expired, otherwise None
+        deadline = self.deadline()
+        if deadline is None or now < deadline:
+            return None
+        self.retries += 1
+        self.recover = self.next_seq
+        return self._resend_oldest(now)
+
+    def _resend_oldest(self, now):
+        seq, entry = next(iter(self.in_flight.items()))
+        entry[2] = True
+        self.timer_start = now
+        self.retransmits += 1
+        return seq, entry[0]
+
+class ReceiveWindow:
+    # Hands segments over in order, holding up to `window` that arrived early
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.expected = 0
+        self.early = {}
+
+    def receive(self, seq, segment):
+        # Returns the segments that are now in order (often none or one)
+        if seq < self.expected or seq >= self.expected + self.window or seq in self.early:
+            return []
+        self.early[seq] = bytes(segment)
+        ready = []
+        while self.expected in self.early:
+            ready.append(self.early.pop(self.expected))
+            self.expected += 1
+        return ready
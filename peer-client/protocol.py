@@ -0,0 +1,196 @@
+#Wire protocol for peer-to-peer connections
+#
+#Every frame is a 4-byte big-endian payload length, a 1-byte frame type and
+#the payload. The first frame on a connection is HELLO from the dialing side
+#(supported version range + username). The listener answers WELCOME (chosen
+#version + its username), or ERROR and closes if the ranges don't overlap.
+#FILE_* frames carry chunked file transfers (see transfer.py). PING is answered
+#with a PONG echoing its payload, which gives the round-trip time.
+import struct
+
+PROTOCOL_VERSION = 1
+MIN_PROTOCOL_VERSION = 1
+
+HEADER = struct.Struct('!IB')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+HELLO = 1
+WELCOME = 2
+ERROR = 3
+TEXT = 4
+GROUP_TEXT = 5
+FILE_OFFER = 6
+FILE_ACCEPT = 7
+FILE_CHUNK = 8
+FILE_ACK = 9
+FILE_CANCEL = 10
+PING = 11
+PONG = 12
+
+FILE_OFFER_HEADER = struct.Struct('!16sQI')   # transfer id, file size, chunk size; name follows
+FILE_ACCEPT_HEADER = struct.Struct('!16sQI')  # transfer id, resume offset, window in chunks
+FILE_CHUNK_HEADER = struct.Struct('!16sQI')   # transfer id, offset, CRC32; data follows
+FILE_ACK_HEADER = struct.Struct('!16sQ')      # transfer id, bytes stored contiguously
+
+class ProtocolError(Exception):
+    pass
+
+def encode_frame(frame_type, payload=b''):
+    return HEADER.pack(len(payload), frame_type) + payload
+
+def encode_hello(username):
+    return encode_frame(HELLO, bytes([MIN_PROTOCOL_VERSION, PROTOCOL_VERSION]) + username.encode('utf-8'))
+
+def decode_hello(payload):
+    # Returns (min_version, max_version, username)
+    if len(payload) < 2:
+        raise ProtocolError("Short HELLO frame")
+    return payload[0], payload[1], str(payload[2:], 'utf-8')
+
+def negotiate_version(peer_min, peer_max):
+    version = min(PROTOCOL_VERSION, peer_max)
+    if version < max(MIN_PROTOCOL_VERSION, peer_min):
+        return None
+    return version
+
+def encode_welcome(version, username):
+    return encode_frame(WELCOME, bytes([version]) + username.encode('utf-8'))
+
+def decode_welcome(payload):
+    # Returns (version, username)
+    if len(payload) < 1:
+        raise ProtocolError("Short WELCOME frame")
+    return payload[0], str(payload[1:], 'utf-8')
+
+def encode_group_text(group, message):
+    name = group.encode('utf-8')[:255]
+    return encode_frame(GROUP_TEXT, bytes([len(name)]) + name + message.encode('utf-8'))
+
+def decode_group_text(payload):
+    # Returns (group, message)
+    if len(payload) < 1 or len(payload) < 1 + payload[0]:
+        raise ProtocolError("Short GROUP_TEXT frame")
+    end = 1 + payload[0]
+    return str(payload[1:end], 'utf-8'), str(payload[end:], 'utf-8')
+
+def _short(payload, header, name):
+    if len(payload) < header.size:
+        raise ProtocolError(f"Short {name} frame")
+
+def encode_file_offer(transfer_id, size, chunk_size, name):
+    return encode_frame(FILE_OFFER, FILE_OFFER_HEADER.pack(transfer_id, size, chunk_size) + name.encode('utf-8'))
+
+def decode_file_offer(payload):
+    # Returns (transfer_id, size, chunk_size, name)
+    _short(payload, FILE_OFFER_HEADER, 'FILE_OFFER')
+    transfer_id, size, chunk_size = FILE_OFFER_HEADER.unpack_from(payload)
+    return transfer_id, size, chunk_size, str(payload[FILE_OFFER_HEADER.size:], 'utf-8')
+
+def encode_file_accept(transfer_id, offset, window):
+    return encode_frame(FILE_ACCEPT, FILE_ACCEPT_HEADER.pack(transfer_id, offset, window))
+
+def decode_file_accept(payload):
+    # Returns (transfer_id, offset, window)
+    _short(payload, FILE_ACCEPT_HEADER, 'FILE_ACCEPT')
+    return FILE_ACCEPT_HEADER.unpack_from(payload)
+
+def encode_chunk_header(transfer_id, offset, crc, length):
+    # Frame header and chunk header only; the caller queues the data after it
+    # so file contents are never copied into a frame
+    return HEADER.pack(FILE_CHUNK_HEADER.size + length, FILE_CHUNK) + FILE_CHUNK_HEADER.pack(transfer_id, offset, crc)
+
+def decode_file_chunk(payload):
+    # Returns (transfer_id, offset, crc, data)
+    _short(payload, FILE_CHUNK_HEADER, 'FILE_CHUNK')
+    transfer_id, offset, crc = FILE_CHUNK_HEADER.unpack_from(payload)
+    return transfer_id, offset, crc, payload[FILE_CHUNK_HEADER.size:]
+
+def encode_file_ack(transfer_id, offset):
+    return encode_frame(FILE_ACK, FILE_ACK_HEADER.pack(transfer_id, offset))
+
+def decode_file_ack(payload):
+    # Returns (transfer_id, offset)
+    _short(payload, FILE_ACK_HEADER, 'FILE_ACK')
+    return FILE_ACK_HEADER.unpack_from(payload)
+
+def encode_file_cancel(transfer_id, reason):
+    return encode_frame(FILE_CANCEL, transfer_id + reason.encode('utf-8'))
+
+def decode_file_cancel(payload):
+    # Returns (transfer_id, reason)
+    if len(payload) < 16:
+        raise ProtocolError("Short FILE_CANCEL frame")
+    return bytes(payload[:16]), str(payload[16:], 'utf-8', errors='replace')
+
+PING_HEADER = struct.Struct('!Q')
+
+def encode_ping(token):
+    return encode_frame(PING, PING_HEADER.pack(token))
+
+def encode_pong(payload):
+    return encode_frame(PONG, bytes(payload))
+
+def decode_pong(payload):
+    _short(payload, PING_HEADER, 'PONG')
+    return PING_HEADER.unpack_from(payload)[0]
+
+class FrameReader:
+    # Receives straight into one reusable buffer with recv_into. Payloads are
+    # handed out as memoryview slices of that buffer, so they are only valid
+    # until the next recv_into call.
+
+    def __init__(self, size=64 * 1024, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.max_frame_size = max_frame_size
+
+    def recv_into(self, sock):
+        if self.end == len(self.buffer):
+            self._make_room(1)
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        # Appends bytes that arrived some other way than recv_into (e.g. a datagram channel)
+        if self.end + len(data) > len(self.buffer):
+            self._make_room(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        return len(data)
+
+    def _make_room(self, needed):
+        pending = self.end - self.start
+        if pending + needed > len(self.buffer):
+            # Grow to fit a large frame; bytes already received are copied once
+            buffer = bytearray(max(len(self.buffer) * 2, pending + needed))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def frames(self):
+        # Yields (frame_type, payload) for every complete frame in the buffer
+        while True:
+            available = self.end - self.start
+            if available < HEADER.size:
+                break
+            length, frame_type = HEADER.unpack_from(self.buffer, self.start)
+            if length > self.max_frame_size:
+                raise ProtocolError(f"Frame of {length} bytes exceeds limit")
+            frame_end = self.start + HEADER.size + length
+            if frame_end > self.end:
+                if frame_end > len(self.buffer):
+                    self._make_room(HEADER.size + length - available)
+                break
+            payload = self.view[self.start + HEADER.size:frame_end]
+            self.start = frame_end
+            yield frame_type, payload
+        if self.start == self.end:
+            self.start = self.end = 0
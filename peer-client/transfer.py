@@ -0,0 +1,204 @@
+#Chunked file transfer over peer connections
+#
+#The sender offers a file (FILE_OFFER) and the receiver answers FILE_ACCEPT
+#with the number of bytes it already has on disk, so an interrupted transfer
+#resumes where it stopped. Every FILE_CHUNK carries its offset and a CRC32 of
+#its data. At most `window` chunks may be unacknowledged; the receiver sends
+#cumulative FILE_ACKs as it writes. A chunk with a bad checksum makes the
+#receiver send FILE_ACCEPT again from its last good offset, and the sender
+#rewinds to it.
+import hashlib
+import mmap
+import os
+import shutil
+import threading
+import time
+import zlib
+
+CHUNK_SIZE = int(os.getenv('FILE_CHUNK_SIZE', 256 * 1024))
+WINDOW = int(os.getenv('FILE_WINDOW', 16))
+DOWNLOAD_DIR = os.getenv('DOWNLOAD_DIR', 'downloads')
+# Offers above FILE_MAX_SIZE bytes, or that would leave less than FILE_MIN_FREE bytes
+# free in DOWNLOAD_DIR, are refused
+MAX_FILE_SIZE = int(os.getenv('FILE_MAX_SIZE', 4 * 1024 ** 3))
+MIN_FREE_SPACE = int(os.getenv('FILE_MIN_FREE', 256 * 1024 ** 2))
+
+def make_transfer_id(sender, name, stat):
+    # Stable for the same file from the same sender, so a retry resumes the old partial file
+    key = f"{sender}\0{name}\0{stat.st_size}\0{stat.st_mtime_ns}".encode('utf-8')
+    return hashlib.sha256(key).digest()[:16]
+
+def safe_name(name):
+    name = os.path.basename(name.replace('\\', '/')).strip()
+    if name in ('', '.', '..'):
+        return None
+    return name
+
+def offer_error(directory, size):
+    # Why an offer of `size` bytes cannot be stored in `directory`, or None
+    if size > MAX_FILE_SIZE:
+        return f"file larger than {MAX_FILE_SIZE} bytes"
+    os.makedirs(directory, exist_ok=True)
+    if size + MIN_FREE_SPACE > shutil.disk_usage(directory).free:
+        return "not enough disk space"
+    return None
+
+def unique_path(path):
+    base, ext = os.path.splitext(path)
+    n = 1
+    while os.path.exists(path):
+        path = f"{base} ({n}){ext}"
+        n += 1
+    return path
+
+class OutgoingTransfer:
+    def __init__(self, conn, path, sender, chunk_size=None, window=None):
+        self.conn = conn
+        self.path = path
+        self.name = os.path.basename(path)
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.id = make_transfer_id(sender, self.name, stat)
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        self.window = window or WINDOW
+        # Chunks are sent straight out of the page cache through a read-only mapping
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.view = memoryview(self.map) if self.map else None
+        self.next_offset = 0
+        self.acked = 0
+        self.resumed_from = None
+        # offered -> sending -> done, or failed / interrupted
+        self.state = 'offered'
+        self.error = None
+        self.started = time.monotonic()
+        self.finished = None
+        self.done = threading.Event()
+
+    def accept(self, offset, window):
+        # Called for the first FILE_ACCEPT and again whenever the receiver asks for a rewind
+        offset = min(offset, self.size)
+        if self.resumed_from is None:
+            self.resumed_from = offset
+        self.acked = self.next_offset = offset
+        if window:
+            self.window = min(self.window, window)
+        self.state = 'sending'
+
+    def ack(self, offset):
+        self.acked = max(self.acked, min(offset, self.size))
+        return self.acked == self.size
+
+    def chunks(self):
+        # Yields (offset, crc, data) for every chunk the window currently allows
+        limit = min(self.size, self.acked + self.window * self.chunk_size)
+        while self.next_offset < limit:
+            end = min(self.next_offset + self.chunk_size, self.size)
+            data = self.view[self.next_offset:end]
+            offset, self.next_offset = self.next_offset, end
+            yield offset, zlib.crc32(data), data
+
+    def finish(self, state, error=None):
+        if self.done.is_set():
+            return
+        self.state = state
+        self.error = error
+        self.finished = time.monotonic()
+        if self.view is not None:
+            self.view.release()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                pass  # chunks still queued on a dead socket; the mapping goes with them
+        self.file.close()
+        self.done.set()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def progress(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        sent = self.acked - (self.resumed_from or 0)
+        return {
+            'name': self.name,
+            'state': self.state,
+            'size': self.size,
+            'acked': self.acked,
+            'resumed_from': self.resumed_from,
+            'mb_per_s': round(sent / elapsed / 1e6, 2) if elapsed > 0 else None,
+            'error': self.error
+        }
+
+class IncomingTransfer:
+    def __init__(self, conn, transfer_id, name, size, chunk_size, directory):
+        self.conn = conn
+        self.id = transfer_id
+        self.name = name
+        self.size = size
+        self.chunk_size = chunk_size
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, name)
+        # Partial data lives next to the target; its length is the resume offset
+        self.part_path = os.path.join(directory, f".{name}.{transfer_id.hex()[:16]}.part")
+        self.fd = os.open(self.part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        self.offset = os.fstat(self.fd).st_size
+        if self.offset > size:
+            os.ftruncate(self.fd, 0)
+            self.offset = 0
+        self.resumed_from = self.offset
+        self.acked = self.offset
+        self.state = 'receiving'
+        self.error = None
+        self.started = time.monotonic()
+        self.finished = None
+
+    def write(self, offset, crc, data):
+        # Returns 'ok', 'skip' for a chunk sent before a rewind, 'bad' on a checksum
+        # mismatch, or 'overflow' for data past the offered size
+        if offset != self.offset:
+            return 'skip'
+        if offset + len(data) > self.size:
+            return 'overflow'
+        if zlib.crc32(data) != crc:
+            return 'bad'
+        written = 0
+        while written < len(data):
+            written += os.pwrite(self.fd, data[written:], offset + written)
+        self.offset += len(data)
+        return 'ok'
+
+    def should_ack(self, window):
+        # Acknowledge every half window so the sender never stalls on a full one
+        return self.offset == self.size or self.offset - self.acked >= max(1, window // 2) * self.chunk_size
+
+    def complete(self):
+        os.close(self.fd)
+        self.fd = None
+        self.path = unique_path(self.path)
+        os.replace(self.part_path, self.path)
+        self.state = 'done'
+        self.finished = time.monotonic()
+
+    def abort(self, state, error=None):
+        # Keeps the partial file so a later offer of the same file resumes
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.state = state
+        self.error = error
+        self.finished = time.monotonic()
+
+    def progress(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        received = self.offset - self.resumed_from
+        return {
+            'name': self.name,
+            'state': self.state,
+            'size': self.size,
+            'received': self.offset,
+            'resumed_from': self.resumed_from,
+            'mb_per_s': round(received / elapsed / 1e6, 2) if elapsed > 0 else None,
+            'path': self.path,
+            'error': self.error
+        }
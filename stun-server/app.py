@@ -1,13 +1,36 @@
 #Mehrnia Amouei 40213020
 #Please read the README file
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 import redis
+from redis.backoff import ExponentialBackoff
+from redis.client import Pipeline
+from redis.exceptions import NoScriptError
+from redis.retry import Retry
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import bisect
+import hashlib
+import heapq
+import hmac
+import itertools
 import os
 import logging
+import secrets
+import socket
+import threading
+import time
 
-logging.basicConfig(level=logging.INFO)
+try:
+    import msgpack
+except ImportError:  # /peers and /peerinfo then always answer in JSON
+    msgpack = None
+
+from cache import ReadThroughCache
+from metrics import Registry
+from profiler import SamplingProfiler
+
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
@@ -16,23 +39,1178 @@ REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
 REDIS_DB = int(os.getenv('REDIS_DB', 0))
 
-PEERS_KEY = 'p2p:peers'
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', 2))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30))
+REDIS_RETRIES = int(os.getenv('REDIS_RETRIES', 3))
+REDIS_STREAM_CONNECTIONS = int(os.getenv('REDIS_STREAM_CONNECTIONS', 100))
+# Comma separated host:port[/db] nodes that hold the peer records; unset keeps
+# everything on REDIS_HOST. Version, change feed and locks stay on REDIS_HOST.
+REDIS_SHARDS = [s.strip() for s in os.getenv('REDIS_SHARDS', '').split(',') if s.strip()]
+SHARD_RING_REPLICAS = int(os.getenv('SHARD_RING_REPLICAS', 160))
+
+PEER_TTL = int(os.getenv('PEER_TTL', 300))
+# 'hash' (compact Redis hash per peer) or 'json' (the older JSON string); reads accept both.
+# Keep 'json' while servers that only read JSON records are still running.
+PEER_RECORD_FORMAT = os.getenv('PEER_RECORD_FORMAT', 'hash')
+SWEEP_INTERVAL = int(os.getenv('SWEEP_INTERVAL', 30))
+SWEEP_BATCH = int(os.getenv('SWEEP_BATCH', 500))
+PEERS_DEFAULT_LIMIT = int(os.getenv('PEERS_DEFAULT_LIMIT', 100))
+PEERS_MAX_LIMIT = int(os.getenv('PEERS_MAX_LIMIT', 1000))
+EVENTS_MAXLEN = int(os.getenv('EVENTS_MAXLEN', 10000))
+CHANGES_MAX_WAIT = int(os.getenv('CHANGES_MAX_WAIT', 25))
+CHANGES_MAX_COUNT = int(os.getenv('CHANGES_MAX_COUNT', 1000))
+HEARTBEAT_MAX_BATCH = int(os.getenv('HEARTBEAT_MAX_BATCH', 1000))
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', 1000))
+# Seconds between publishing this worker's metrics for its siblings; 0 keeps them per process
+METRICS_SHARE_INTERVAL = float(os.getenv('METRICS_SHARE_INTERVAL', 10))
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', '0') == '1'
+# Offline mailboxes: at most MAILBOX_MAXLEN messages of MAILBOX_MAX_MESSAGE_BYTES per
+# recipient, dropped MAILBOX_TTL seconds after the last deposit
+MAILBOX_MAXLEN = int(os.getenv('MAILBOX_MAXLEN', 500))
+MAILBOX_MAX_MESSAGE_BYTES = int(os.getenv('MAILBOX_MAX_MESSAGE_BYTES', 4096))
+MAILBOX_TTL = int(os.getenv('MAILBOX_TTL', 7 * 24 * 3600))
+# 'drop-oldest' evicts the oldest message of a full mailbox, 'reject' refuses the new one
+MAILBOX_FULL_POLICY = os.getenv('MAILBOX_FULL_POLICY', 'drop-oldest')
+MAILBOX_MAX_FETCH = int(os.getenv('MAILBOX_MAX_FETCH', 500))
+# Room for all mailboxes together, split evenly across the shards: a deposit that would
+# open more than MAILBOX_MAX_BOXES mailboxes or store more than MAILBOX_MAX_BYTES gets 507
+MAILBOX_MAX_BOXES = int(os.getenv('MAILBOX_MAX_BOXES', 100000))
+MAILBOX_MAX_BYTES = int(os.getenv('MAILBOX_MAX_BYTES', 256 * 1024 * 1024))
+# Punch requests are only useful while both peers are still trying
+SIGNAL_TTL = int(os.getenv('SIGNAL_TTL', 30))
+SIGNAL_MAXLEN = int(os.getenv('SIGNAL_MAXLEN', 100))
+# Per-process cache of /peers pages and /peerinfo records (0 disables it). Every
+# directory change published by any server drops it, so the TTL only bounds how
+# far behind heartbeats the cached last_seen can be.
+READ_CACHE_TTL = float(os.getenv('READ_CACHE_TTL', 1))
+READ_CACHE_PEERS = int(os.getenv('READ_CACHE_PEERS', 10000))
+READ_CACHE_LISTINGS = int(os.getenv('READ_CACHE_LISTINGS', 1000))
+
+# One key per peer (expires on its own) plus a ZSET of usernames scored by last_seen
+PEER_KEY_PREFIX = 'p2p:peer:'
+PEERS_INDEX_KEY = 'p2p:peers:seen'
+# Same usernames with score 0, so ZRANGEBYLEX gives cursors and prefix filters
+PEERS_NAMES_KEY = 'p2p:peers:names'
+# Bumped on every directory change, served as the /peers ETag
+PEERS_VERSION_KEY = 'p2p:peers:version'
+# Capped stream of joined/updated/left events; entry IDs are the feed sequence numbers
+PEERS_EVENTS_KEY = 'p2p:peers:events'
+# Pub/sub channel carrying the usernames of every directory change (JSON list)
+PEERS_INVALIDATE_CHANNEL = 'p2p:peers:invalidate'
+SWEEP_LOCK_KEY = 'p2p:sweeper:lock'
+# Old layout: every peer as a field of one hash
+LEGACY_PEERS_KEY = 'p2p:peers'
+# Latest metrics snapshot of every server worker, by worker id
+METRICS_WORKERS_KEY = 'p2p:metrics:workers'
+# Stream of messages waiting for an offline peer; lives on the recipient's shard
+MAILBOX_KEY_PREFIX = 'p2p:mailbox:'
+# Set by every registration for MAILBOX_TTL to the SHA-256 of the mailbox token it
+# issued; only those usernames receive mail, and only that token reads or acks it
+MAILBOX_OWNER_KEY_PREFIX = 'p2p:mailboxes:owner:'
+# Per shard: mailbox owners scored by expiry, stored bytes by owner, and their total
+MAILBOXES_EXPIRY_KEY = 'p2p:mailboxes:expiry'
+MAILBOXES_BYTES_KEY = 'p2p:mailboxes:bytes'
+MAILBOXES_TOTAL_KEY = 'p2p:mailboxes:total'
+# Stream of UDP hole-punching requests addressed to a peer
+SIGNAL_KEY_PREFIX = 'p2p:signal:'
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+# Writes a peer record and indexes it in one step; returns 'joined' or 'updated'.
+# ARGV: username, ttl, last-seen score, 'hash' then field/value pairs, or 'json' then the JSON string
+REGISTER_SCRIPT = """
+local existed = redis.call('EXISTS', KEYS[1])
+if ARGV[4] == 'json' then
+    redis.call('SET', KEYS[1], ARGV[5], 'EX', ARGV[2])
+else
+    redis.call('DEL', KEYS[1])
+    redis.call('HSET', KEYS[1], unpack(ARGV, 5))
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+redis.call('ZADD', KEYS[3], 0, ARGV[1])
+if existed == 1 then
+    return 'updated'
+end
+return 'joined'
+"""
+
+# Reads the peer records in KEYS in whichever format they were written: a flat
+# field/value list for a hash, {'', json} for a JSON string, {} when missing
+LOAD_SCRIPT = """
+local records = {}
+for i = 1, #KEYS do
+    local kind = redis.call('TYPE', KEYS[i])['ok']
+    if kind == 'hash' then
+        records[i] = redis.call('HGETALL', KEYS[i])
+    elseif kind == 'string' then
+        records[i] = {'', redis.call('GET', KEYS[i])}
+    else
+        records[i] = {}
+    end
+end
+return records
+"""
+
+# Rewrites the JSON record in KEYS[1] as a hash (ARGV[2..] field/value pairs),
+# keeping its TTL, unless it changed since it was read as ARGV[1]; returns 1/0
+CONVERT_SCRIPT = """
+if redis.call('TYPE', KEYS[1])['ok'] ~= 'string' or redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+local ttl = redis.call('PTTL', KEYS[1])
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+if ttl > 0 then
+    redis.call('PEXPIRE', KEYS[1], ttl)
+end
+return 1
+"""
+
+# Extends the TTL of each peer key (KEYS[3..]) and bumps its last-seen score, skipping
+# peers whose record already expired. A live record that lost its index entries (swept
+# by a server whose clock runs ahead) is indexed again. Returns per peer 0 (expired),
+# 1 (alive) or 2 (alive and re-indexed)
+HEARTBEAT_SCRIPT = """
+local alive = {}
+for i = 3, #KEYS do
+    local ok = redis.call('EXPIRE', KEYS[i], ARGV[2])
+    if ok == 1 and redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i]) == 1 then
+        redis.call('ZADD', KEYS[2], 0, ARGV[i])
+        ok = 2
+    end
+    alive[#alive + 1] = ok
+end
+return alive
+"""
+
+# Atomically pop up to ARGV[2] usernames last seen before ARGV[1] from both indexes
+SWEEP_SCRIPT = """
+local stale = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1], 'LIMIT', 0, ARGV[2])
+if #stale > 0 then
+    redis.call('ZREM', KEYS[1], unpack(stale))
+    redis.call('ZREM', KEYS[2], unpack(stale))
+end
+return stale
+"""
+
+# Releases the bytes accounted to mailboxes that expired (at most 100 per call)
+MAILBOX_PRUNE = """
+local function entry_bytes(entry)
+    local fields = entry[2]
+    for i = 1, #fields, 2 do
+        if fields[i] == 'text' then
+            return #fields[i + 1]
+        end
+    end
+    return 0
+end
+
+local function release(owner)
+    local held = tonumber(redis.call('HGET', KEYS[4], owner) or 0)
+    redis.call('HDEL', KEYS[4], owner)
+    redis.call('ZREM', KEYS[3], owner)
+    redis.call('DECRBY', KEYS[5], held)
+end
+
+for _, owner in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1], 'LIMIT', 0, 100)) do
+    release(owner)
+end
+"""
+
+# Appends a message to a mailbox capped at ARGV[2] entries; returns {id, evicted, ''},
+# or {'', 0, reason} with reason 'unknown' (recipient never registered), 'full' (the
+# mailbox is full and the policy is 'reject') or 'capacity' (the shard's share of
+# MAILBOX_MAX_BOXES/MAILBOX_MAX_BYTES is used up).
+# KEYS: mailbox, owner, expiry index, bytes hash, bytes total
+# ARGV: now, maxlen, ttl, policy, recipient, sender, text, max boxes, max bytes
+MAILBOX_SCRIPT = MAILBOX_PRUNE + """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return {'', 0, 'unknown'}
+end
+local length = redis.call('XLEN', KEYS[1])
+local limit = tonumber(ARGV[2])
+if length >= limit and ARGV[4] == 'reject' then
+    return {'', 0, 'full'}
+end
+if length == 0 then
+    release(ARGV[5])
+    if redis.call('ZCARD', KEYS[3]) >= tonumber(ARGV[8]) then
+        return {'', 0, 'capacity'}
+    end
+end
+local oldest = {}
+if length >= limit then
+    oldest = redis.call('XRANGE', KEYS[1], '-', '+', 'COUNT', length + 1 - limit)
+end
+local freed = 0
+for _, entry in ipairs(oldest) do
+    freed = freed + entry_bytes(entry)
+end
+local size = #ARGV[7] - freed
+if tonumber(redis.call('GET', KEYS[5]) or 0) + size > tonumber(ARGV[9]) then
+    return {'', 0, 'capacity'}
+end
+for _, entry in ipairs(oldest) do
+    redis.call('XDEL', KEYS[1], entry[1])
+end
+local id = redis.call('XADD', KEYS[1], '*', 'from', ARGV[6], 'text', ARGV[7])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('ZADD', KEYS[3], tonumber(ARGV[1]) + tonumber(ARGV[3]), ARGV[5])
+redis.call('HINCRBY', KEYS[4], ARGV[5], size)
+redis.call('INCRBY', KEYS[5], size)
+return {id, #oldest, ''}
+"""
+
+# Deletes acknowledged entries and drops the mailbox once it is empty
+# KEYS: mailbox, owner (unused), expiry index, bytes hash, bytes total
+# ARGV: now, owner, entry ids
+MAILBOX_ACK_SCRIPT = MAILBOX_PRUNE + """
+local acked, freed = 0, 0
+for i = 3, #ARGV do
+    local entry = redis.call('XRANGE', KEYS[1], ARGV[i], ARGV[i])[1]
+    if entry then
+        freed = freed + entry_bytes(entry)
+        acked = acked + redis.call('XDEL', KEYS[1], ARGV[i])
+    end
+end
+if redis.call('XLEN', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[1])
+    release(ARGV[2])
+elseif freed > 0 then
+    redis.call('HINCRBY', KEYS[4], ARGV[2], -freed)
+    redis.call('DECRBY', KEYS[5], freed)
+end
+return acked
+"""
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+metrics = Registry()
+HTTP_REQUESTS = metrics.counter('p2p_http_requests_total', 'HTTP requests served',
+                                ('endpoint', 'method', 'status'))
+HTTP_DURATION = metrics.histogram('p2p_http_request_duration_seconds', 'Time spent handling a request',
+                                  ('endpoint',))
+REDIS_DURATION = metrics.histogram('p2p_redis_command_duration_seconds',
+                                   'Redis round trip, including pool wait and retries',
+                                   ('command',),
+                                   buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+REDIS_ERRORS = metrics.counter('p2p_redis_errors_total', 'Redis commands that raised', ('command',))
+PEERS_EVICTED = metrics.counter('p2p_stale_peers_evicted_total', 'Peers removed by the sweeper after PEER_TTL')
+SWEEPS = metrics.counter('p2p_sweeps_total', 'Sweeper runs that held the sweep lock')
+MAILBOX_MESSAGES = metrics.counter('p2p_mailbox_messages_total', 'Offline messages by outcome',
+                                   ('outcome',))
+CACHE_REQUESTS = metrics.counter('p2p_read_cache_requests_total',
+                                 'Directory reads by cache result (hit, miss, coalesced)', ('cache', 'result'))
+PEER_STARTUP = metrics.histogram('p2p_peer_startup_seconds',
+                                 'Time from a client starting up to its registration reaching the server',
+                                 buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+PEER_STARTUP_RETRIES = metrics.counter('p2p_peer_startup_retries_total',
+                                       'Registration attempts clients made before the one that arrived')
+
+class MeteredPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        except redis.RedisError:
+            REDIS_ERRORS.inc('PIPELINE')
+            raise
+        finally:
+            REDIS_DURATION.observe(time.perf_counter() - start, 'PIPELINE')
+
+class MeteredRedis(redis.Redis):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # SHAs of the scripts this node is known to hold (see run_pipeline)
+        self.loaded_scripts = set()
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        except redis.RedisError:
+            REDIS_ERRORS.inc(args[0])
+            raise
+        finally:
+            REDIS_DURATION.observe(time.perf_counter() - start, args[0])
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MeteredPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class MeteredConnectionPool(redis.BlockingConnectionPool):
+    def reset(self):
+        super().reset()
+        # reset() also runs in a forked child, so the counters are per process
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.exhausted = 0
+
+    def get_connection(self, command_name, *keys, **options):
+        try:
+            connection = super().get_connection(command_name, *keys, **options)
+        except redis.ConnectionError as e:
+            if str(e) == "No connection available.":
+                with self.stats_lock:
+                    self.exhausted += 1
+                logger.warning("Redis pool exhausted (max_connections=%d)", self.max_connections)
+            raise
+        with self.stats_lock:
+            self.checkouts += 1
+        return connection
+
+    def stats(self):
+        created = len(self._connections)
+        idle = sum(1 for c in list(self.pool.queue) if c is not None)
+        return {
+            "max_connections": self.max_connections,
+            "created": created,
+            "in_use": created - idle,
+            "idle": idle,
+            "checkouts": self.checkouts,
+            "exhausted": self.exhausted
+        }
+
+_redis_clients = {}
+_redis_lock = threading.Lock()
+
+def _pooled_client(name, max_connections, socket_timeout, host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB):
+    client = _redis_clients.get(name)
+    if client is not None:
+        return client
+    with _redis_lock:
+        if name not in _redis_clients:
+            try:
+                pool = MeteredConnectionPool(
+                    host=host,
+                    port=port,
+                    db=db,
+                    decode_responses=True,
+                    socket_connect_timeout=3,
+                    socket_timeout=socket_timeout,
+                    socket_keepalive=True,
+                    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+                    retry=Retry(ExponentialBackoff(cap=1.0, base=0.05), REDIS_RETRIES),
+                    retry_on_error=[redis.ConnectionError, redis.TimeoutError],
+                    max_connections=max_connections,
+                    timeout=REDIS_POOL_TIMEOUT
+                )
+                _redis_clients[name] = MeteredRedis(connection_pool=pool)
+                logger.info("Redis pool '%s' created for %s:%s (max %d connections)",
+                            name, host, port, max_connections)
+            except Exception as e:
+                logger.error("Redis connection error: %s", e)
+                return None
+        return _redis_clients[name]
 
 def get_redis():
+    return _pooled_client('default', REDIS_MAX_CONNECTIONS, 5)
+
+def get_stream_redis():
+    # Blocking XREADs get their own pool so long-polls cannot starve regular requests
+    return _pooled_client('stream', REDIS_STREAM_CONNECTIONS, CHANGES_MAX_WAIT + 5)
+
+class HashRing:
+    # Consistent hashing: each node owns many points on a 64-bit ring and a key
+    # belongs to the next point clockwise, so adding a node moves ~1/N of the keys
+    def __init__(self, nodes, replicas=SHARD_RING_REPLICAS):
+        points = sorted(
+            (self.hash(f"{node}#{i}"), index)
+            for index, node in enumerate(nodes)
+            for i in range(replicas)
+        )
+        self.hashes = [h for h, _ in points]
+        self.owners = [index for _, index in points]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def node_for(self, key):
+        # Index (into the node list) of the node owning `key`
+        i = bisect.bisect(self.hashes, self.hash(key)) % len(self.hashes)
+        return self.owners[i]
+
+# Points are placed by node address, so reordering REDIS_SHARDS moves nothing
+SHARD_RING = HashRing(REDIS_SHARDS) if len(REDIS_SHARDS) > 1 else None
+
+def parse_shard(spec):
+    address, _, db = spec.partition('/')
+    host, _, port = address.partition(':')
+    return host, int(port or 6379), int(db or 0)
+
+def get_shards():
+    # Clients for the nodes holding peer records, in REDIS_SHARDS order; [] when one is unavailable
+    if not REDIS_SHARDS:
+        r = get_redis()
+        return [r] if r else []
+    shards = []
+    for index, spec in enumerate(REDIS_SHARDS):
+        client = _pooled_client(f'shard{index}', REDIS_MAX_CONNECTIONS, 5, *parse_shard(spec))
+        if client is None:
+            return []
+        shards.append(client)
+    return shards
+
+_shard_executor = None
+
+def _shard_map(func, items):
+    # func(item) for every item, concurrently when more than one shard is involved
+    global _shard_executor
+    if len(items) < 2:
+        return [func(item) for item in items]
+    if _shard_executor is None:
+        with _redis_lock:
+            if _shard_executor is None:
+                _shard_executor = ThreadPoolExecutor(max_workers=4 * len(REDIS_SHARDS),
+                                                     thread_name_prefix='redis-shard')
+    return list(_shard_executor.map(func, items))
+
+def shard_for(shards, username):
+    return shards[SHARD_RING.node_for(username)] if SHARD_RING else shards[0]
+
+def route(shards, usernames):
+    # [(shard, positions in usernames)] for every shard that owns some of the usernames
+    if SHARD_RING is None:
+        return [(shards[0], list(range(len(usernames))))]
+    owned = {}
+    for position, username in enumerate(usernames):
+        owned.setdefault(SHARD_RING.node_for(username), []).append(position)
+    return [(shards[index], positions) for index, positions in owned.items()]
+
+def scatter(shards, items, func, key=None):
+    # Calls func(shard, items it owns) per shard; returns the per-item results in input order
+    keys = [key(item) for item in items] if key else items
+    routes = route(shards, keys)
+    results = [None] * len(items)
+    outputs = _shard_map(lambda entry: func(entry[0], [items[p] for p in entry[1]]), routes)
+    for (_, positions), values in zip(routes, outputs):
+        for position, value in zip(positions, values):
+            results[position] = value
+    return results
+
+# SHA1 of every script source queued with queue_script, and the reverse map for reloading
+_script_shas = {}
+_script_sources = {}
+
+def queue_script(pipe, source, keys, args):
+    # Queues EVALSHA with a precomputed SHA. Unlike Script(client=pipe), this adds no
+    # SCRIPT EXISTS round trip to execute(); run_pipeline loads scripts a node lacks
+    sha = _script_shas.get(source)
+    if sha is None:
+        sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        _script_sources[sha] = source
+        _script_shas[source] = sha
+    pipe.evalsha(sha, len(keys), *keys, *args)
+
+def run_pipeline(client, pipe):
+    # pipe.execute() in one round trip. A script is loaded once per client before its
+    # first use; if the node lost it since (restart, SCRIPT FLUSH), it is loaded again
+    # and only the calls refused with NOSCRIPT run again
+    stack = list(pipe.command_stack)
+    for sha in {args[1] for args, _ in stack if args[0] == 'EVALSHA'} - client.loaded_scripts:
+        client.script_load(_script_sources[sha])
+        client.loaded_scripts.add(sha)
+    results = pipe.execute(raise_on_error=False)
+    missing = [i for i, result in enumerate(results) if isinstance(result, NoScriptError)]
+    if missing:
+        for sha in {stack[i][0][1] for i in missing}:
+            client.script_load(_script_sources[sha])
+        retry = client.pipeline(transaction=False)
+        for i in missing:
+            args, options = stack[i]
+            retry.execute_command(*args, **options)
+        for i, result in zip(missing, retry.execute(raise_on_error=False)):
+            results[i] = result
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+def close_redis():
+    global _shard_executor
+    with _redis_lock:
+        for client in _redis_clients.values():
+            client.connection_pool.disconnect()
+        _redis_clients.clear()
+        if _shard_executor is not None:
+            _shard_executor.shutdown(wait=False)
+            _shard_executor = None
+
+def pool_stats():
+    return {name: client.connection_pool.stats() for name, client in _redis_clients.items()}
+
+def _pool_gauge(field):
+    def collect():
+        return {(name,): stats[field] for name, stats in pool_stats().items()}
+    return collect
+
+def _directory_size():
+    shards = get_shards()
+    return {(): sum(_shard_map(lambda shard: shard.zcard(PEERS_INDEX_KEY), shards))} if shards else {}
+
+# Pool gauges describe the worker that answers the scrape
+metrics.gauge('p2p_redis_pool_max_connections', 'Pool size limit', ('pool',), _pool_gauge('max_connections'))
+metrics.gauge('p2p_redis_pool_connections_in_use', 'Connections checked out', ('pool',), _pool_gauge('in_use'))
+metrics.gauge('p2p_redis_pool_connections_idle', 'Connections waiting in the pool', ('pool',), _pool_gauge('idle'))
+metrics.gauge('p2p_redis_pool_checkouts', 'Connections handed out since start', ('pool',), _pool_gauge('checkouts'))
+metrics.gauge('p2p_redis_pool_exhausted', 'Checkouts that timed out on a full pool', ('pool',), _pool_gauge('exhausted'))
+metrics.gauge('p2p_directory_peers', 'Peers in the directory index', (), _directory_size)
+
+# Version and /peers pages, keyed by directory version and query; records by username
+listing_cache = ReadThroughCache(READ_CACHE_TTL, READ_CACHE_LISTINGS,
+                                 lambda result: CACHE_REQUESTS.inc('listings', result))
+peer_cache = ReadThroughCache(READ_CACHE_TTL, READ_CACHE_PEERS,
+                              lambda result: CACHE_REQUESTS.inc('peers', result))
+metrics.gauge('p2p_read_cache_entries', 'Entries in the read caches of the worker that answered', ('cache',),
+              lambda: {('listings',): len(listing_cache), ('peers',): len(peer_cache)})
+
+def _sibling_metrics(r):
+    # Snapshots other workers published recently; stale ones (dead workers) are dropped
+    snapshots = []
+    cutoff = time.time() - 3 * METRICS_SHARE_INTERVAL
+    for worker, raw in r.hgetall(METRICS_WORKERS_KEY).items():
+        if worker == WORKER_ID:
+            continue
+        entry = json.loads(raw)
+        if entry['at'] < cutoff:
+            r.hdel(METRICS_WORKERS_KEY, worker)
+            continue
+        snapshots.append(entry['metrics'])
+    return snapshots
+
+def publish_metrics():
+    r = get_redis()
+    if r:
+        r.hset(METRICS_WORKERS_KEY, WORKER_ID, json.dumps({"at": time.time(), "metrics": metrics.snapshot()}))
+
+def _metrics_loop():
+    while True:
+        time.sleep(METRICS_SHARE_INTERVAL)
+        try:
+            publish_metrics()
+        except Exception as e:
+            logger.warning("Publishing metrics failed: %s", e)
+
+_metrics_thread = None
+
+def start_metrics_publisher():
+    global _metrics_thread, WORKER_ID
+    # Called after fork, so take the worker's own pid
+    WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+    if METRICS_SHARE_INTERVAL <= 0:
+        return
+    if _metrics_thread is None or not _metrics_thread.is_alive():
+        _metrics_thread = threading.Thread(target=_metrics_loop, name="metrics-publisher")
+        _metrics_thread.daemon = True
+        _metrics_thread.start()
+
+def withdraw_metrics():
     try:
-        r = redis.Redis(
-            host=REDIS_HOST,
-            port=REDIS_PORT,
-            db=REDIS_DB,
-            decode_responses=True,
-            socket_connect_timeout=3
+        r = get_redis()
+        if r:
+            r.hdel(METRICS_WORKERS_KEY, WORKER_ID)
+    except redis.RedisError:
+        pass
+
+profiler = SamplingProfiler()
+
+def peer_key(username):
+    return PEER_KEY_PREFIX + username
+
+def publish_changes(r, events):
+    # Bumps the directory version and appends the events to the change feed.
+    # Runs after the shards were written, so the version never runs ahead of the data.
+    if not events:
+        return
+    pipe = r.pipeline()
+    pipe.incr(PEERS_VERSION_KEY)
+    for fields in events:
+        pipe.xadd(PEERS_EVENTS_KEY, fields, maxlen=EVENTS_MAXLEN, approximate=True)
+    pipe.publish(PEERS_INVALIDATE_CHANNEL, json.dumps([fields['username'] for fields in events]))
+    pipe.execute()
+
+def clear_read_caches(enabled=None):
+    listing_cache.clear(enabled)
+    peer_cache.clear(enabled)
+
+def _invalidation_loop():
+    # Keeps the read caches in step with changes made by every server; they stay
+    # off whenever this subscription is down, as changes could be missed
+    while True:
+        pubsub = None
+        try:
+            pubsub = get_stream_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(PEERS_INVALIDATE_CHANNEL)
+            # Changes made before the subscription took effect were not seen
+            clear_read_caches(enabled=True)
+            while True:
+                message = pubsub.get_message(timeout=CHANGES_MAX_WAIT)
+                if message is None:
+                    pubsub.ping()
+                    continue
+                if message['type'] != 'message':
+                    continue
+                listing_cache.clear()
+                try:
+                    peer_cache.invalidate(json.loads(message['data']))
+                except (ValueError, TypeError):
+                    peer_cache.clear()
+        except Exception as e:
+            logger.warning("Cache invalidation subscription lost: %s", e)
+        finally:
+            clear_read_caches(enabled=False)
+            if pubsub is not None:
+                try:
+                    pubsub.close()
+                except redis.RedisError:
+                    pass
+        time.sleep(1)
+
+_invalidation_thread = None
+
+def start_cache_invalidation():
+    global _invalidation_thread
+    if READ_CACHE_TTL <= 0:
+        return
+    if _invalidation_thread is None or not _invalidation_thread.is_alive():
+        _invalidation_thread = threading.Thread(target=_invalidation_loop, name="cache-invalidation")
+        _invalidation_thread.daemon = True
+        _invalidation_thread.start()
+
+def sweep_stale_peers(r, shards):
+    def sweep_shard(shard):
+        sweep = shard.register_script(SWEEP_SCRIPT)
+        removed = []
+        while True:
+            cutoff = time.time() - PEER_TTL
+            stale = sweep(keys=[PEERS_INDEX_KEY, PEERS_NAMES_KEY], args=[cutoff, SWEEP_BATCH])
+            removed.extend(stale)
+            if len(stale) < SWEEP_BATCH:
+                return removed
+    removed = list(itertools.chain.from_iterable(_shard_map(sweep_shard, shards)))
+    publish_changes(r, [{"type": "left", "username": username} for username in removed])
+    return removed
+
+def migrate_legacy_peers(r, shards):
+    if not r.exists(LEGACY_PEERS_KEY):
+        return 0
+    now = time.time()
+    entries = []
+    for username, peer_data in r.hscan_iter(LEGACY_PEERS_KEY):
+        try:
+            peer_info = json.loads(peer_data)
+            seen = datetime.fromisoformat(peer_info['last_seen']).timestamp()
+            record = record_args(peer_info, seen)
+        except (ValueError, KeyError, TypeError):
+            continue
+        ttl = int(seen + PEER_TTL - now)
+        if ttl > 0:
+            entries.append((username, record, seen, ttl))
+    
+    def migrate(shard, owned):
+        pipe = shard.pipeline(transaction=False)
+        for username, record, seen, ttl in owned:
+            queue_script(pipe, REGISTER_SCRIPT, [peer_key(username), PEERS_INDEX_KEY, PEERS_NAMES_KEY],
+                         [username, ttl, seen] + record)
+        run_pipeline(shard, pipe)
+        return owned
+    
+    scatter(shards, entries, migrate, key=lambda entry: entry[0])
+    pipe = r.pipeline()
+    pipe.delete(LEGACY_PEERS_KEY)
+    pipe.incr(PEERS_VERSION_KEY)
+    pipe.execute()
+    migrated = len(entries)
+    logger.info("Migrated %d peers from legacy hash %s", migrated, LEGACY_PEERS_KEY)
+    return migrated
+
+def convert_json_records(shards, batch=500):
+    # Rewrites JSON peer records left by older servers as hashes; safe to run on every worker
+    def convert_shard(shard):
+        load = shard.register_script(LOAD_SCRIPT)
+        converted = 0
+        usernames = [u for u, _ in shard.zscan_iter(PEERS_NAMES_KEY, count=batch)]
+        for start in range(0, len(usernames), batch):
+            owned = usernames[start:start + batch]
+            records = load(keys=[peer_key(u) for u in owned])
+            pipe = shard.pipeline(transaction=False)
+            pending = 0
+            for username, record in zip(owned, records):
+                if len(record) != 2 or record[0] != '':
+                    continue
+                try:
+                    peer_info = json.loads(record[1])
+                    seen = datetime.fromisoformat(peer_info['last_seen']).timestamp()
+                    fields = encode_record(peer_info, seen)
+                except (ValueError, KeyError, TypeError):
+                    continue
+                queue_script(pipe, CONVERT_SCRIPT, [peer_key(username)],
+                             [record[1]] + list(itertools.chain.from_iterable(fields.items())))
+                pending += 1
+            if pending:
+                converted += sum(run_pipeline(shard, pipe))
+        return converted
+    
+    converted = sum(_shard_map(convert_shard, shards))
+    if converted:
+        logger.info("Converted %d JSON peer records to hashes", converted)
+    return converted
+
+def encode_record(peer_info, seen):
+    # Hash fields of a stored peer: the username is in the key and status is always online
+    fields = {"ip": peer_info['ip'], "port": peer_info['port'], "seen": int(seen)}
+    if 'local_ip' in peer_info:
+        fields['local'] = peer_info['local_ip']
+    if 'udp' in peer_info:
+        fields['udp'] = ','.join(f"{host}:{port}" for host, port in peer_info['udp'])
+    return fields
+
+def decode_record(username, record, score):
+    # Peer info from a LOAD_SCRIPT reply; None when the record is missing or unreadable
+    if not record:
+        return None
+    if record[0] == '':
+        peer_info = json.loads(record[1])
+    else:
+        fields = dict(zip(record[::2], record[1::2]))
+        peer_info = {
+            "username": username,
+            "ip": fields['ip'],
+            "port": int(fields['port']),
+            "last_seen": None,
+            "status": "online"
+        }
+        if 'local' in fields:
+            peer_info['local_ip'] = fields['local']
+        if 'udp' in fields:
+            candidates = (c.rpartition(':') for c in fields['udp'].split(','))
+            peer_info['udp'] = [[host, int(port)] for host, _, port in candidates]
+        score = score or float(fields['seen'])
+    # Heartbeats only move the index score, so it is the freshest last_seen
+    if score:
+        peer_info['last_seen'] = seen_at(score)
+    return peer_info
+
+def record_args(peer_info, seen):
+    # REGISTER_SCRIPT arguments that follow the score
+    if PEER_RECORD_FORMAT == 'json':
+        return ['json', json.dumps(peer_info)]
+    return ['hash'] + list(itertools.chain.from_iterable(encode_record(peer_info, seen).items()))
+
+def build_peer_info(data, now):
+    # Returns (peer_info, None) or (None, error message)
+    if not isinstance(data, dict):
+        return None, "Peer entry must be an object"
+    required_fields = ['username', 'ip', 'port']
+    for field in required_fields:
+        if field not in data:
+            return None, f"Field '{field}' is required"
+    if not isinstance(data['username'], str) or not data['username']:
+        return None, "Field 'username' must be a non-empty string"
+    if not isinstance(data['ip'], str) or not data['ip']:
+        return None, "Field 'ip' must be a non-empty string"
+    try:
+        port = int(data['port'])
+    except (TypeError, ValueError):
+        return None, "Field 'port' must be an integer"
+    if not 0 < port < 65536:
+        return None, "Field 'port' must be between 1 and 65535"
+    peer_info = {
+        "username": data['username'],
+        "ip": data['ip'],
+        "port": port,
+        "last_seen": datetime.fromtimestamp(now).isoformat(),
+        "status": "online"
+    }
+    # Address inside the peer's own network, when `ip` is its STUN reflexive address
+    if isinstance(data.get('local_ip'), str) and data['local_ip'] != data['ip']:
+        peer_info['local_ip'] = data['local_ip']
+    # UDP addresses for hole punching, NAT mapping first
+    candidates = udp_candidates(data.get('udp'))
+    if candidates:
+        peer_info['udp'] = candidates
+    return peer_info, None
+
+def observe_startup(startup):
+    # Clients in auto mode report {"seconds": since start-up, "attempt": n} when registering
+    if not isinstance(startup, dict):
+        return
+    seconds, attempt = startup.get('seconds'), startup.get('attempt')
+    if isinstance(seconds, (int, float)) and 0 <= seconds < 86400:
+        PEER_STARTUP.observe(seconds)
+    if isinstance(attempt, int) and 1 < attempt < 1000:
+        PEER_STARTUP_RETRIES.inc(amount=attempt - 1)
+
+def udp_candidates(value):
+    # [[ip, port], ...] with at most 4 entries, or None when malformed
+    if not isinstance(value, list) or not 0 < len(value) <= 4:
+        return None
+    candidates = []
+    for item in value:
+        if not (isinstance(item, list) and len(item) == 2 and isinstance(item[0], str)
+                and isinstance(item[1], int) and 0 < item[1] < 65536):
+            return None
+        candidates.append([item[0], item[1]])
+    return candidates
+
+def store_peers(r, shards, peers, now):
+    # One script call per peer, one round trip per shard; returns 'joined'/'updated' per
+    # peer and {username: mailbox token}. A new token replaces the previous registration's
+    tokens = {peer_info['username']: secrets.token_urlsafe(24) for peer_info in peers}
+    
+    def register_on(shard, owned):
+        pipe = shard.pipeline(transaction=False)
+        for peer_info in owned:
+            username = peer_info['username']
+            queue_script(pipe, REGISTER_SCRIPT, [peer_key(username), PEERS_INDEX_KEY, PEERS_NAMES_KEY],
+                         [username, PEER_TTL, now] + record_args(peer_info, now))
+            pipe.set(mailbox_owner_key(username), mailbox_token_digest(tokens[username]), ex=MAILBOX_TTL)
+        return run_pipeline(shard, pipe)[::2]
+    
+    kinds = scatter(shards, peers, register_on, key=lambda peer_info: peer_info['username'])
+    publish_changes(r, [
+        {"type": kind, "username": peer_info['username'], "peer": json.dumps(peer_info)}
+        for peer_info, kind in zip(peers, kinds)
+    ])
+    return kinds, tokens
+
+def remove_peers(r, shards, usernames):
+    def remove_from(shard, owned):
+        pipe = shard.pipeline()
+        for username in owned:
+            pipe.delete(peer_key(username))
+            pipe.zrem(PEERS_INDEX_KEY, username)
+            pipe.zrem(PEERS_NAMES_KEY, username)
+        return pipe.execute()[::3]
+    
+    deleted = scatter(shards, usernames, remove_from)
+    removed = [u for u, count in zip(usernames, deleted) if count]
+    publish_changes(r, [{"type": "left", "username": username} for username in removed])
+    return removed
+
+def load_peers(shards, usernames):
+    # Returns {username: peer_info} for the usernames that are registered
+    # One round trip per shard
+    def fetch(shard, owned):
+        pipe = shard.pipeline(transaction=False)
+        queue_script(pipe, LOAD_SCRIPT, [peer_key(u) for u in owned], [])
+        pipe.zmscore(PEERS_INDEX_KEY, owned)
+        records, scores = run_pipeline(shard, pipe)
+        return list(zip(records, scores))
+    
+    peers = {}
+    for username, (record, score) in zip(usernames, scatter(shards, usernames, fetch)):
+        try:
+            peer_info = decode_record(username, record, score)
+        except (ValueError, KeyError):
+            logger.error("Error processing user data: %s", username)
+            continue
+        if peer_info:
+            peers[username] = peer_info
+    return peers
+
+def batch_field(data, field, item_type=None, max_size=BATCH_MAX_SIZE):
+    # The list under `field`, or None when it is missing, not a list, too long or mistyped
+    if not isinstance(data, dict) or not isinstance(data.get(field), list):
+        return None
+    items = data[field]
+    if len(items) > max_size:
+        return None
+    if item_type and not all(isinstance(item, item_type) for item in items):
+        return None
+    return items
+
+def batch_error(field):
+    return jsonify({
+        "status": "error",
+        "message": f"Field '{field}' must be a list of at most {BATCH_MAX_SIZE} valid items"
+    }), 400
+
+def touch_peers(r, shards, usernames):
+    now = time.time()
+    
+    def touch(shard, owned):
+        heartbeat = shard.register_script(HEARTBEAT_SCRIPT)
+        return heartbeat(
+            keys=[PEERS_INDEX_KEY, PEERS_NAMES_KEY] + [peer_key(u) for u in owned],
+            args=[now, PEER_TTL] + list(owned)
         )
-        r.ping()
-        logger.info(f"Connected to Redis at {REDIS_HOST}:{REDIS_PORT}")
-        return r
+    
+    alive = scatter(shards, usernames, touch)
+    live = [u for u, ok in zip(usernames, alive) if ok]
+    unknown = [u for u, ok in zip(usernames, alive) if not ok]
+    restored = [u for u, ok in zip(usernames, alive) if ok == 2]
+    if restored:
+        # Their 'left' event went out when they were swept
+        peers = load_peers(shards, restored)
+        publish_changes(r, [
+            {"type": "joined", "username": username, "peer": json.dumps(peer_info)}
+            for username, peer_info in peers.items()
+        ])
+    return now, live, unknown
+
+def seen_at(score):
+    return datetime.fromtimestamp(score).isoformat()
+
+def directory_version(r):
+    return int(r.get(PEERS_VERSION_KEY) or 0)
+
+def list_peers(shards, cursor=None, limit=PEERS_DEFAULT_LIMIT, prefix=None, exclude=None, status=None):
+    # Walks the names indexes of all shards in username order; returns (peers, next_cursor)
+    if prefix:
+        upper = b'[' + prefix.encode('utf-8') + b'\xff'
+    else:
+        upper = '+'
+    if cursor and (not prefix or cursor >= prefix):
+        lower = '(' + cursor
+    elif prefix:
+        lower = '[' + prefix
+    else:
+        lower = '-'
+    
+    peers = []
+    # Filters can drop entries, so read a few more batches before returning a short page
+    for _ in range(5):
+        pages = _shard_map(
+            lambda shard: shard.zrangebylex(PEERS_NAMES_KEY, lower, upper, start=0, num=limit), shards)
+        # The first `limit` merged names are complete: a shard's unread names sort after its page.
+        # groupby drops a name held by two shards while records move after a resharding.
+        merged = [u for u, _ in itertools.groupby(heapq.merge(*pages))]
+        usernames = merged[:limit]
+        if not usernames:
+            return peers, None
+        records = load_peers(shards, usernames)
+        for username in usernames:
+            # Expired records are skipped here and dropped from the index by the sweeper
+            peer_info = records.get(username)
+            if not peer_info or username == exclude:
+                continue
+            if status and peer_info.get('status') != status:
+                continue
+            peers.append(peer_info)
+            if len(peers) == limit:
+                return peers, username
+        # Done only when no shard has more and nothing was cut from the merge
+        if len(merged) <= limit and all(len(page) < limit for page in pages):
+            return peers, None
+        lower = '(' + usernames[-1]
+    return peers, usernames[-1]
+
+def stream_id(entry_id):
+    ms, _, seq = entry_id.partition('-')
+    return int(ms), int(seq or 0)
+
+def format_event(entry_id, fields):
+    event = {
+        "id": entry_id,
+        "type": fields.get('type'),
+        "username": fields.get('username')
+    }
+    if 'peer' in fields:
+        event['peer'] = json.loads(fields['peer'])
+    return event
+
+def feed_bounds(r):
+    pipe = r.pipeline(transaction=False)
+    pipe.xrange(PEERS_EVENTS_KEY, count=1)
+    pipe.xrevrange(PEERS_EVENTS_KEY, count=1)
+    first, last = pipe.execute()
+    return (first[0][0] if first else None), (last[0][0] if last else '0-0')
+
+def needs_reset(since, first_id, last_id):
+    # The client missed trimmed events, or holds a sequence from a different stream
+    since_id = stream_id(since)
+    if since_id > stream_id(last_id):
+        return True
+    return first_id is not None and since_id < stream_id(first_id) and since != '0-0'
+
+def read_changes(since, timeout, count):
+    # Returns (events, last_id); blocks up to `timeout` seconds when nothing is pending
+    r = get_stream_redis()
+    block = int(timeout * 1000) if timeout > 0 else None
+    result = r.xread({PEERS_EVENTS_KEY: since}, count=count, block=block)
+    events = []
+    last_id = since
+    for _, entries in result or []:
+        for entry_id, fields in entries:
+            events.append(format_event(entry_id, fields))
+            last_id = entry_id
+    return events, last_id
+
+def mailbox_key(username):
+    return MAILBOX_KEY_PREFIX + username
+
+def mailbox_owner_key(username):
+    return MAILBOX_OWNER_KEY_PREFIX + username
+
+def mailbox_token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def mailbox_authorized(shards, username):
+    # True if the request carries the token issued by the username's latest registration
+    # as "Authorization: Bearer <token>"
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return False
+    digest = shard_for(shards, username).get(mailbox_owner_key(username))
+    return digest is not None and hmac.compare_digest(digest, mailbox_token_digest(token.strip()))
+
+def mailbox_unauthorized():
+    return jsonify({
+        "status": "error",
+        "message": "A valid mailbox token is required"
+    }), 401
+
+def mailbox_keys(username):
+    # KEYS of MAILBOX_SCRIPT and MAILBOX_ACK_SCRIPT
+    return [mailbox_key(username), mailbox_owner_key(username),
+            MAILBOXES_EXPIRY_KEY, MAILBOXES_BYTES_KEY, MAILBOXES_TOTAL_KEY]
+
+# Metric outcome of each refusal reason returned by MAILBOX_SCRIPT
+MAILBOX_REFUSALS = {'unknown': 'unknown_recipient', 'full': 'rejected', 'capacity': 'over_capacity'}
+# HTTP status of a refused single deposit, by result status
+MAILBOX_STATUS_CODES = {'unknown': 404, 'rejected': 429, 'over_capacity': 507}
+
+def deposit_messages(shards, messages):
+    # Stores (sender, recipient, text) tuples, one round trip per shard; returns
+    # [entry id or None when refused, messages evicted to make room, refusal reason or None]
+    now = time.time()
+    max_boxes = -(-MAILBOX_MAX_BOXES // len(shards))
+    max_bytes = -(-MAILBOX_MAX_BYTES // len(shards))
+    
+    def deposit(shard, owned):
+        pipe = shard.pipeline(transaction=False)
+        for sender, recipient, text in owned:
+            queue_script(pipe, MAILBOX_SCRIPT, mailbox_keys(recipient),
+                         [now, MAILBOX_MAXLEN, MAILBOX_TTL, MAILBOX_FULL_POLICY, recipient, sender, text,
+                          max_boxes, max_bytes])
+        return run_pipeline(shard, pipe)
+    
+    results = [[entry_id or None, evicted, reason or None] for entry_id, evicted, reason in
+               scatter(shards, messages, deposit, key=lambda message: message[1])]
+    for entry_id, evicted, reason in results:
+        MAILBOX_MESSAGES.inc('stored' if entry_id else MAILBOX_REFUSALS[reason])
+        if evicted:
+            MAILBOX_MESSAGES.inc('evicted', amount=evicted)
+    return results
+
+def read_mailbox(shards, username, after=None, count=MAILBOX_MAX_FETCH):
+    # Oldest first, starting after entry `after`; returns (messages, total waiting)
+    pipe = shard_for(shards, username).pipeline(transaction=False)
+    pipe.xrange(mailbox_key(username), min='(' + after if after else '-', max='+', count=count)
+    pipe.xlen(mailbox_key(username))
+    entries, waiting = pipe.execute()
+    messages = [{
+        "id": entry_id,
+        "from": fields.get('from'),
+        "text": fields.get('text'),
+        "sent_at": seen_at(stream_id(entry_id)[0] / 1000)
+    } for entry_id, fields in entries]
+    return messages, waiting
+
+def ack_mailbox(shards, username, ids):
+    ack = shard_for(shards, username).register_script(MAILBOX_ACK_SCRIPT)
+    acked = ack(keys=mailbox_keys(username), args=[time.time(), username] + ids)
+    MAILBOX_MESSAGES.inc('delivered', amount=acked)
+    return acked
+
+def signal_key(username):
+    return SIGNAL_KEY_PREFIX + username
+
+def post_signal(r, sender, recipient, session, candidates):
+    pipe = r.pipeline()
+    pipe.xadd(signal_key(recipient),
+              {"from": sender, "session": session, "candidates": json.dumps(candidates)},
+              maxlen=SIGNAL_MAXLEN, approximate=True)
+    pipe.expire(signal_key(recipient), SIGNAL_TTL)
+    return pipe.execute()[0]
+
+def read_signals(username, since, timeout):
+    # Returns (signals, last_id); blocks up to `timeout` seconds when none are pending
+    r = get_stream_redis()
+    block = int(timeout * 1000) if timeout > 0 else None
+    result = r.xread({signal_key(username): since}, count=SIGNAL_MAXLEN, block=block)
+    now_ms = time.time() * 1000
+    signals = []
+    last_id = since
+    for _, entries in result or []:
+        for entry_id, fields in entries:
+            last_id = entry_id
+            signals.append({
+                "id": entry_id,
+                "from": fields.get('from'),
+                "session": fields.get('session'),
+                "candidates": json.loads(fields.get('candidates', '[]')),
+                # Seconds since the request, so the peer skips ones it is too late for
+                "age": round(max(0, now_ms - stream_id(entry_id)[0]) / 1000, 3)
+            })
+    return signals, last_id
+
+def _sweep_loop():
+    try:
+        migrate_legacy_peers(get_redis(), get_shards())
+        if PEER_RECORD_FORMAT == 'hash':
+            convert_json_records(get_shards())
     except Exception as e:
-        logger.error(f"Redis connection error: {e}")
+        logger.error("Legacy migration error: %s", e)
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        try:
+            r = get_redis()
+            # Only one process (of any number of servers) sweeps per interval
+            if r and r.set(SWEEP_LOCK_KEY, os.getpid(), nx=True, ex=SWEEP_INTERVAL):
+                removed = sweep_stale_peers(r, get_shards())
+                SWEEPS.inc()
+                if removed:
+                    PEERS_EVICTED.inc(amount=len(removed))
+                    logger.info("Swept %d stale peers", len(removed))
+        except Exception as e:
+            logger.error("Sweeper error: %s", e)
+
+_sweeper_thread = None
+
+def start_sweeper():
+    global _sweeper_thread
+    if _sweeper_thread is None or not _sweeper_thread.is_alive():
+        _sweeper_thread = threading.Thread(target=_sweep_loop, name="peer-sweeper")
+        _sweeper_thread.daemon = True
+        _sweeper_thread.start()
+
+@app.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_DURATION.observe(time.perf_counter() - started, endpoint)
+        HTTP_REQUESTS.inc(endpoint, request.method, str(response.status_code))
+    return response
+
+def db_error():
+    return jsonify({
+        "status": "error",
+        "message": "Database connection error"
+    }), 500
+
+def response_mimetype():
+    # The msgpack type the client prefers in Accept, or None for JSON
+    if msgpack is None:
         return None
+    best = request.accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES)
+    return best if best in MSGPACK_MIMETYPES else None
+
+def encode_response(payload, mimetype=None):
+    if mimetype:
+        response = app.response_class(msgpack.packb(payload), mimetype=mimetype)
+    else:
+        response = jsonify(payload)
+    response.vary.add('Accept')
+    return response
 
 @app.route('/register', methods=['POST'])
 def register_peer():
@@ -45,46 +1223,40 @@ def register_peer():
                 "message": "No JSON data provided"
             }), 400
         
-        required_fields = ['username', 'ip', 'port']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({
-                    "status": "error",
-                    "message": f"Field '{field}' is required"
-                }), 400
-        
-        username = data['username']
-        ip = data['ip']
-        port = data['port']
-        
-        r = get_redis()
-        if not r:
+        now = time.time()
+        peer_info, error = build_peer_info(data, now)
+        if error:
             return jsonify({
                 "status": "error",
-                "message": "Database connection error"
-            }), 500
+                "message": error
+            }), 400
         
-        peer_info = {
-            "username": username,
-            "ip": ip,
-            "port": int(port),
-            "last_seen": datetime.now().isoformat(),
-            "status": "online"
-        }
+        username = peer_info['username']
+        ip = peer_info['ip']
+        port = peer_info['port']
         
-        r.hset(PEERS_KEY, username, json.dumps(peer_info))
-        r.expire(PEERS_KEY, 3600)
+        r = get_redis()
+        shards = get_shards()
+        if not r or not shards:
+            return db_error()
         
-        logger.info(f"User '{username}' registered: {ip}:{port}")
+        _, tokens = store_peers(r, shards, [peer_info], now)
+        observe_startup(data.get('startup'))
+        
+        logger.info("User '%s' registered: %s:%s", username, ip, port)
         
         return jsonify({
             "status": "success",
             "message": "Registration successful",
-            "peer": peer_info
+            "peer": peer_info,
+            "mailbox_token": tokens[username]
         }), 201
         
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logger.error("Redis error: %s", e)
+        return db_error()
     except Exception as e:
-        logger.error(f"Registration error: {e}")
+        logger.error("Registration error: %s", e)
         return jsonify({
             "status": "error",
             "message": "Internal server error"
@@ -94,45 +1266,134 @@ def register_peer():
 def get_peers():
     try:
         r = get_redis()
-        if not r:
+        shards = get_shards()
+        if not r or not shards:
+            return db_error()
+        
+        try:
+            limit = int(request.args.get('limit', PEERS_DEFAULT_LIMIT))
+        except ValueError:
+            return jsonify({
+                "status": "error",
+                "message": "Parameter 'limit' must be an integer"
+            }), 400
+        limit = max(1, min(limit, PEERS_MAX_LIMIT))
+        
+        # Read the version before the listing so the ETag never runs ahead of the data
+        version = listing_cache.get('version', lambda: directory_version(r))
+        mimetype = response_mimetype()
+        # Each encoding is a separate representation with its own ETag
+        etag = f"{version}-msgpack" if mimetype else str(version)
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            response.vary.add('Accept')
+            return response
+        
+        query = (request.args.get('cursor'), limit, request.args.get('prefix'),
+                 request.args.get('exclude'), request.args.get('status'))
+        # Cached pages are shared between requests and must not be modified
+        active_peers, next_cursor = listing_cache.get((version,) + query, lambda: list_peers(
+            shards,
+            cursor=query[0],
+            limit=limit,
+            prefix=query[2],
+            exclude=query[3],
+            status=query[4]
+        ))
+        
+        response = encode_response({
+            "status": "success",
+            "count": len(active_peers),
+            "peers": active_peers,
+            "next_cursor": next_cursor,
+            "version": version
+        }, mimetype)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response, 200
+        
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logger.error("Redis error: %s", e)
+        return db_error()
+    except Exception as e:
+        logger.error("Error getting peers: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+@app.route('/peers/changes', methods=['GET'])
+def get_peer_changes():
+    try:
+        since = request.args.get('since') or request.headers.get('Last-Event-ID')
+        try:
+            timeout = min(float(request.args.get('timeout', 0)), CHANGES_MAX_WAIT)
+            count = max(1, min(int(request.args.get('limit', CHANGES_MAX_COUNT)), CHANGES_MAX_COUNT))
+            if since:
+                stream_id(since)
+        except ValueError:
             return jsonify({
                 "status": "error",
-                "message": "Database connection error"
-            }), 500
+                "message": "Invalid 'since', 'timeout' or 'limit' parameter"
+            }), 400
         
-        all_peers = r.hgetall(PEERS_KEY)
+        r = get_redis()
+        if not r or not get_stream_redis():
+            return db_error()
         
-        current_time = datetime.now()
-        active_peers = []
+        first_id, last_id = feed_bounds(r)
         
-        for username, peer_data in all_peers.items():
-            try:
-                peer_info = json.loads(peer_data)
-                last_seen = datetime.fromisoformat(peer_info['last_seen'])
-                
-                if (current_time - last_seen).total_seconds() < 300:
-                    active_peers.append(peer_info)
-                else:
-                    r.hdel(PEERS_KEY, username)
-                    logger.info(f"Removed old user: {username}")
-                    
-            except json.JSONDecodeError:
-                logger.error(f"Error processing user data: {username}")
-                continue
+        if not since or needs_reset(since, first_id, last_id):
+            # Fetch /peers after this and follow the feed from last_id
+            return jsonify({
+                "status": "success",
+                "reset": bool(since),
+                "events": [],
+                "last_id": last_id
+            }), 200
+        
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            return app.response_class(
+                _event_stream(since),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+        
+        events, last_id = read_changes(since, timeout, count)
         
         return jsonify({
             "status": "success",
-            "count": len(active_peers),
-            "peers": active_peers
+            "reset": False,
+            "events": events,
+            "last_id": last_id
         }), 200
         
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logger.error("Redis error: %s", e)
+        return db_error()
     except Exception as e:
-        logger.error(f"Error getting peers: {e}")
+        logger.error("Error getting peer changes: %s", e)
         return jsonify({
             "status": "error",
             "message": "Internal server error"
         }), 500
 
+def _event_stream(since):
+    last_id = since
+    while True:
+        try:
+            events, last_id = read_changes(last_id, CHANGES_MAX_WAIT, CHANGES_MAX_COUNT)
+        except redis.RedisError as e:
+            logger.error("Event stream error: %s", e)
+            return
+        if not events:
+            # Comment line keeps proxies from closing an idle stream
+            yield ": keepalive\n\n"
+            continue
+        for event in events:
+            yield f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
 @app.route('/peerinfo', methods=['GET'])
 def get_peer_info():
     try:
@@ -144,30 +1405,84 @@ def get_peer_info():
                 "message": "Username parameter is required"
             }), 400
         
-        r = get_redis()
-        if not r:
-            return jsonify({
-                "status": "error",
-                "message": "Database connection error"
-            }), 500
+        shards = get_shards()
+        if not shards:
+            return db_error()
         
-        peer_data = r.hget(PEERS_KEY, username)
+        peer_info = peer_cache.get(username, lambda: load_peers(shards, [username]).get(username))
         
-        if not peer_data:
+        if not peer_info:
             return jsonify({
                 "status": "error",
                 "message": f"User '{username}' not found"
             }), 404
         
-        peer_info = json.loads(peer_data)
+        return encode_response({
+            "status": "success",
+            "peer": peer_info
+        }, response_mimetype()), 200
+        
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logger.error("Redis error: %s", e)
+        return db_error()
+    except Exception as e:
+        logger.error("Error getting peer info: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+@app.route('/heartbeat', methods=['POST'])
+def heartbeat():
+    try:
+        data = request.get_json(silent=True)
+        
+        if not isinstance(data, dict) or not ('username' in data or 'usernames' in data):
+            return jsonify({
+                "status": "error",
+                "message": "Field 'username' or 'usernames' is required"
+            }), 400
+        
+        single = 'username' in data
+        if single and not isinstance(data['username'], str):
+            return jsonify({
+                "status": "error",
+                "message": "Field 'username' must be a string"
+            }), 400
+        usernames = [data['username']] if single else batch_field(data, 'usernames', str, HEARTBEAT_MAX_BATCH)
+        if usernames is None:
+            return jsonify({
+                "status": "error",
+                "message": f"Field 'usernames' must be a list of at most {HEARTBEAT_MAX_BATCH} strings"
+            }), 400
+        
+        r = get_redis()
+        shards = get_shards()
+        if not r or not shards:
+            return db_error()
+        
+        now, alive, unknown = touch_peers(r, shards, usernames) if usernames else (time.time(), [], [])
+        
+        if single and unknown:
+            # The record expired: the peer has to register again
+            return jsonify({
+                "status": "error",
+                "message": f"User '{usernames[0]}' not registered"
+            }), 404
         
         return jsonify({
             "status": "success",
-            "peer": peer_info
+            "alive": alive,
+            "unknown": unknown,
+            "last_seen": seen_at(now),
+            "ttl": PEER_TTL
         }), 200
         
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logger.error("Redis error: %s", e)
+        return db_error()
     except Exception as e:
-        logger.error(f"Error getting peer info: {e}")
+        logger.error("Heartbeat error: %s", e)
         return jsonify({
             "status": "error",
             "message": "Internal server error"
@@ -176,27 +1491,28 @@ def get_peer_info():
 @app.route('/unregister', methods=['POST'])
 def unregister_peer():
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True)
         
-        if not data or 'username' not in data:
+        if not isinstance(data, dict) or 'username' not in data:
             return jsonify({
                 "status": "error",
                 "message": "Username parameter is required"
             }), 400
         
         username = data['username']
-        
-        r = get_redis()
-        if not r:
+        if not isinstance(username, str) or not username:
             return jsonify({
                 "status": "error",
-                "message": "Database connection error"
-            }), 500
+                "message": "Field 'username' must be a non-empty string"
+            }), 400
         
-        deleted = r.hdel(PEERS_KEY, username)
+        r = get_redis()
+        shards = get_shards()
+        if not r or not shards:
+            return db_error()
         
-        if deleted > 0:
-            logger.info(f"User removed: {username}")
+        if remove_peers(r, shards, [username]):
+            logger.info("User removed: %s", username)
             return jsonify({
                 "status": "success",
                 "message": f"User '{username}' removed"
@@ -207,23 +1523,449 @@ def unregister_peer():
                 "message": f"User '{username}' not found"
             }), 404
             
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logger.error("Redis error: %s", e)
+        return db_error()
+    except Exception as e:
+        logger.error("Error removing user: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+@app.route('/register/batch', methods=['POST'])
+def register_batch():
+    try:
+        entries = batch_field(request.get_json(silent=True), 'peers')
+        if entries is None:
+            return batch_error('peers')
+        
+        now = time.time()
+        results = []
+        valid = []
+        for entry in entries:
+            peer_info, error = build_peer_info(entry, now)
+            if error:
+                username = entry.get('username') if isinstance(entry, dict) else None
+                results.append({"username": username, "status": "error", "message": error})
+            else:
+                results.append({"username": peer_info['username'], "status": None})
+                valid.append(peer_info)
+        
+        r = get_redis()
+        shards = get_shards()
+        if not r or not shards:
+            return db_error()
+        
+        kinds, tokens = store_peers(r, shards, valid, now) if valid else ([], {})
+        outcomes = iter(kinds)
+        for result in results:
+            if result['status'] is None:
+                result.update(status=next(outcomes), mailbox_token=tokens[result['username']])
+        
+        logger.info("Batch registration: %d of %d peers stored", len(valid), len(entries))
+        
+        return jsonify({
+            "status": "success",
+            "registered": len(valid),
+            "results": results
+        }), 200
+        
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logger.error("Redis error: %s", e)
+        return db_error()
+    except Exception as e:
+        logger.error("Batch registration error: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+@app.route('/unregister/batch', methods=['POST'])
+def unregister_batch():
+    try:
+        usernames = batch_field(request.get_json(silent=True), 'usernames', str)
+        if usernames is None:
+            return batch_error('usernames')
+        
+        r = get_redis()
+        shards = get_shards()
+        if not r or not shards:
+            return db_error()
+        
+        removed = set(remove_peers(r, shards, usernames)) if usernames else set()
+        
+        logger.info("Batch unregistration: %d of %d peers removed", len(removed), len(usernames))
+        
+        return jsonify({
+            "status": "success",
+            "removed": len(removed),
+            "results": [
+                {"username": u, "status": "removed" if u in removed else "not_found"}
+                for u in usernames
+            ]
+        }), 200
+        
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logger.error("Redis error: %s", e)
+        return db_error()
+    except Exception as e:
+        logger.error("Batch unregistration error: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+@app.route('/peerinfo/batch', methods=['POST'])
+def get_peer_info_batch():
+    try:
+        usernames = batch_field(request.get_json(silent=True), 'usernames', str)
+        if usernames is None:
+            return batch_error('usernames')
+        
+        shards = get_shards()
+        if not shards:
+            return db_error()
+        
+        peers = load_peers(shards, usernames) if usernames else {}
+        
+        return encode_response({
+            "status": "success",
+            "peers": peers,
+            "missing": [u for u in usernames if u not in peers]
+        }, response_mimetype()), 200
+        
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logger.error("Redis error: %s", e)
+        return db_error()
+    except Exception as e:
+        logger.error("Error getting peer info batch: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+@app.route('/mailbox', methods=['POST'])
+def post_mailbox():
+    # {"from", "to", "text"} for one message, or {"from", "messages": [{"to", "text"}, ...]}
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('from'), str) or not data['from']:
+            return jsonify({
+                "status": "error",
+                "message": "Field 'from' must be a non-empty string"
+            }), 400
+        
+        single = 'messages' not in data
+        entries = [data] if single else batch_field(data, 'messages', dict)
+        if entries is None:
+            return batch_error('messages')
+        
+        results = []
+        valid = []
+        for entry in entries:
+            recipient, text = entry.get('to'), entry.get('text')
+            if not isinstance(recipient, str) or not recipient or not isinstance(text, str):
+                results.append({"to": recipient, "status": "error",
+                                "message": "Fields 'to' and 'text' must be strings"})
+            elif len(text.encode('utf-8')) > MAILBOX_MAX_MESSAGE_BYTES:
+                results.append({"to": recipient, "status": "error",
+                                "message": f"Message longer than {MAILBOX_MAX_MESSAGE_BYTES} bytes"})
+            else:
+                results.append({"to": recipient, "status": None})
+                valid.append((data['from'], recipient, text))
+        
+        shards = get_shards()
+        if not shards:
+            return db_error()
+        
+        outcomes = iter(deposit_messages(shards, valid) if valid else [])
+        for result in results:
+            if result['status'] is None:
+                entry_id, evicted, reason = next(outcomes)
+                if entry_id:
+                    result.update(status="stored", id=entry_id, evicted=evicted)
+                elif reason == 'unknown':
+                    result.update(status="unknown", message=f"No registered peer '{result['to']}'")
+                elif reason == 'full':
+                    result.update(status="rejected", message=f"Mailbox of '{result['to']}' is full")
+                else:
+                    result.update(status="over_capacity", message="Mailbox storage is full")
+        
+        if single:
+            result = results[0]
+            if result['status'] == 'stored':
+                return jsonify({"status": "success", **result}), 201
+            return jsonify({
+                "status": "error",
+                "message": result['message']
+            }), MAILBOX_STATUS_CODES.get(result['status'], 400)
+        
+        return jsonify({
+            "status": "success",
+            "stored": sum(1 for r in results if r['status'] == 'stored'),
+            "results": results
+        }), 200
+        
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logger.error("Redis error: %s", e)
+        return db_error()
+    except Exception as e:
+        logger.error("Mailbox deposit error: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+@app.route('/mailbox', methods=['GET'])
+def get_mailbox():
+    try:
+        username = request.args.get('username')
+        if not username:
+            return jsonify({
+                "status": "error",
+                "message": "Username parameter is required"
+            }), 400
+        
+        after = request.args.get('after')
+        try:
+            count = max(1, min(int(request.args.get('limit', MAILBOX_MAX_FETCH)), MAILBOX_MAX_FETCH))
+            if after:
+                stream_id(after)
+        except ValueError:
+            return jsonify({
+                "status": "error",
+                "message": "Invalid 'after' or 'limit' parameter"
+            }), 400
+        
+        shards = get_shards()
+        if not shards:
+            return db_error()
+        if not mailbox_authorized(shards, username):
+            return mailbox_unauthorized()
+        
+        messages, waiting = read_mailbox(shards, username, after, count)
+        
+        return jsonify({
+            "status": "success",
+            "messages": messages,
+            "waiting": waiting
+        }), 200
+        
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logger.error("Redis error: %s", e)
+        return db_error()
+    except Exception as e:
+        logger.error("Mailbox read error: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+@app.route('/mailbox/ack', methods=['POST'])
+def ack_mailbox_messages():
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('username'), str) or not data['username']:
+            return jsonify({
+                "status": "error",
+                "message": "Username parameter is required"
+            }), 400
+        
+        ids = batch_field(data, 'ids', str)
+        if ids is None:
+            return batch_error('ids')
+        try:
+            for entry_id in ids:
+                stream_id(entry_id)
+        except ValueError:
+            return batch_error('ids')
+        
+        shards = get_shards()
+        if not shards:
+            return db_error()
+        if not mailbox_authorized(shards, data['username']):
+            return mailbox_unauthorized()
+        
+        acked = ack_mailbox(shards, data['username'], ids) if ids else 0
+        
+        return jsonify({
+            "status": "success",
+            "acked": acked
+        }), 200
+        
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logger.error("Redis error: %s", e)
+        return db_error()
+    except Exception as e:
+        logger.error("Mailbox ack error: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+@app.route('/signal', methods=['POST'])
+def post_punch_signal():
+    # Asks `to` to start UDP hole punching towards `candidates` for channel `session`
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({
+                "status": "error",
+                "message": "No JSON data provided"
+            }), 400
+        
+        candidates = udp_candidates(data.get('candidates'))
+        session = data.get('session')
+        if not all(isinstance(data.get(f), str) and data[f] for f in ('from', 'to')) \
+                or not isinstance(session, str) or not 0 < len(session) <= 32 or candidates is None:
+            return jsonify({
+                "status": "error",
+                "message": "Fields 'from', 'to', 'session' and 'candidates' are required"
+            }), 400
+        
+        r = get_redis()
+        if not r:
+            return db_error()
+        
+        entry_id = post_signal(r, data['from'], data['to'], session, candidates)
+        
+        return jsonify({
+            "status": "success",
+            "id": entry_id
+        }), 201
+        
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logger.error("Redis error: %s", e)
+        return db_error()
     except Exception as e:
-        logger.error(f"Error removing user: {e}")
+        logger.error("Signal error: %s", e)
         return jsonify({
             "status": "error",
             "message": "Internal server error"
         }), 500
 
+@app.route('/signal', methods=['GET'])
+def get_punch_signals():
+    try:
+        username = request.args.get('username')
+        if not username:
+            return jsonify({
+                "status": "error",
+                "message": "Username parameter is required"
+            }), 400
+        
+        since = request.args.get('since')
+        try:
+            timeout = min(float(request.args.get('timeout', 0)), CHANGES_MAX_WAIT)
+            if since:
+                stream_id(since)
+        except ValueError:
+            return jsonify({
+                "status": "error",
+                "message": "Invalid 'since' or 'timeout' parameter"
+            }), 400
+        
+        r = get_redis()
+        if not r or not get_stream_redis():
+            return db_error()
+        
+        if not since:
+            # First call: only requests made from now on are of interest
+            last = r.xrevrange(signal_key(username), count=1)
+            return jsonify({
+                "status": "success",
+                "signals": [],
+                "last_id": last[0][0] if last else '0-0'
+            }), 200
+        
+        signals, last_id = read_signals(username, since, timeout)
+        
+        return jsonify({
+            "status": "success",
+            "signals": signals,
+            "last_id": last_id
+        }), 200
+        
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logger.error("Redis error: %s", e)
+        return db_error()
+    except Exception as e:
+        logger.error("Error reading signals: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    others = []
+    if METRICS_SHARE_INTERVAL > 0:
+        try:
+            r = get_redis()
+            if r:
+                others = _sibling_metrics(r)
+        except (redis.ConnectionError, redis.TimeoutError):
+            pass  # still serve this worker's own numbers
+    return app.response_class(metrics.render(others), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/profile', methods=['GET', 'POST', 'DELETE'])
+def profile():
+    # GET: status, or ?seconds=N to sample for N seconds and return collapsed stacks
+    # POST: start sampling (?interval=seconds); DELETE: stop and return collapsed stacks
+    # Only the worker that receives the request is profiled.
+    if not PROFILER_ENABLED:
+        return jsonify({"status": "error", "message": "Profiler disabled (set PROFILER_ENABLED=1)"}), 404
+    try:
+        interval = float(request.args.get('interval', 0.005))
+        seconds = float(request.args.get('seconds', 0))
+        limit = int(request.args.get('limit', 0)) or None
+    except ValueError:
+        return jsonify({"status": "error", "message": "interval, seconds and limit must be numbers"}), 400
+    interval = max(0.001, interval)
+    
+    if request.method == 'POST':
+        if not profiler.start(interval):
+            return jsonify({"status": "error", "message": "Profiler already running", "profiler": profiler.status()}), 409
+        return jsonify({"status": "success", "profiler": profiler.status()}), 200
+    if request.method == 'DELETE':
+        profiler.stop()
+        return app.response_class(profiler.collapsed(limit), mimetype='text/plain')
+    if seconds > 0:
+        if not profiler.start(interval):
+            return jsonify({"status": "error", "message": "Profiler already running", "profiler": profiler.status()}), 409
+        time.sleep(min(seconds, 60))
+        profiler.stop()
+        return app.response_class(profiler.collapsed(limit), mimetype='text/plain')
+    return jsonify({"status": "success", "profiler": profiler.status()}), 200
+
 @app.route('/health', methods=['GET'])
 def health_check():
     try:
         r = get_redis()
-        redis_status = "connected" if r else "disconnected"
+        try:
+            redis_status = "connected" if r and r.ping() else "disconnected"
+        except redis.RedisError:
+            redis_status = "disconnected"
+        
+        shard_status = {}
+        for spec, shard in zip(REDIS_SHARDS, get_shards()):
+            try:
+                shard_status[spec] = "connected" if shard.ping() else "disconnected"
+            except redis.RedisError:
+                shard_status[spec] = "disconnected"
         
         return jsonify({
             "status": "healthy",
             "service": "P2P STUN Server",
             "redis": redis_status,
+            "redis_shards": shard_status,
+            "redis_pools": pool_stats(),
+            "read_cache": {
+                "enabled": listing_cache.enabled,
+                "listings": len(listing_cache),
+                "peers": len(peer_cache)
+            },
             "timestamp": datetime.now().isoformat()
         }), 200
     except Exception as e:
@@ -238,15 +1980,28 @@ def index():
         "service": "P2P STUN Server",
         "endpoints": {
             "register": "POST /register",
-            "peers": "GET /peers",
+            "peers": "GET /peers?limit=&cursor=&prefix=&exclude=&status=",
+            "changes": "GET /peers/changes?since=<id>&timeout=<seconds>",
             "peerinfo": "GET /peerinfo?username=<username>",
+            "register_batch": "POST /register/batch",
+            "peerinfo_batch": "POST /peerinfo/batch",
+            "unregister_batch": "POST /unregister/batch",
+            "heartbeat": "POST /heartbeat",
             "unregister": "POST /unregister",
-            "health": "GET /health"
+            "mailbox": "POST /mailbox, GET /mailbox?username=&after=&limit=",
+            "mailbox_ack": "POST /mailbox/ack",
+            "signal": "POST /signal, GET /signal?username=&since=&timeout=",
+            "health": "GET /health",
+            "metrics": "GET /metrics"
         }
     })
 
 if __name__ == '__main__':
+    # Development server; production runs under gunicorn (see gunicorn.conf.py)
     logger.info("Starting STUN Server...")
+    start_sweeper()
+    start_metrics_publisher()
+    start_cache_invalidation()
     app.run(
         host='0.0.0.0',
         port=5000,
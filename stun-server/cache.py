@@ -0,0 +1,92 @@
+#In-process read-through cache with request coalescing
+#
+#Entries live for `ttl` seconds and at most `maxsize` of them are kept, least
+#recently used first out. get(key, load) returns the cached value or calls
+#load(); concurrent misses on the same key wait for that one call instead of
+#each going to Redis. invalidate() and clear() also detach loads in progress:
+#their result still reaches the callers already waiting but is not stored, and
+#later callers start a fresh load. A disabled cache (the default) passes every
+#call through to load().
+import collections
+import threading
+import time
+
+class _Flight:
+    __slots__ = ('done', 'value', 'error', 'stale')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.stale = False
+
+class ReadThroughCache:
+    def __init__(self, ttl, maxsize, record=None):
+        # record(result) is called with 'hit', 'miss' or 'coalesced' for every get()
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.record = record
+        self.entries = collections.OrderedDict()  # key -> (expires, value)
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.enabled = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, load):
+        if not self.enabled or self.ttl <= 0 or self.maxsize <= 0:
+            return load()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                result = 'hit'
+            else:
+                flight = self.flights.get(key)
+                result = 'coalesced' if flight else 'miss'
+                if flight is None:
+                    flight = self.flights[key] = _Flight()
+        if self.record:
+            self.record(result)
+        if result == 'hit':
+            return entry[1]
+        if result == 'coalesced':
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = load()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+                if flight.error is None and not flight.stale and self.enabled:
+                    self.entries[key] = (time.monotonic() + self.ttl, flight.value)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.maxsize:
+                        self.entries.popitem(last=False)
+            flight.done.set()
+        return flight.value
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+                flight = self.flights.pop(key, None)
+                if flight:
+                    flight.stale = True
+
+    def clear(self, enabled=None):
+        with self.lock:
+            self.entries.clear()
+            for flight in self.flights.values():
+                flight.stale = True
+            self.flights.clear()
+            if enabled is not None:
+                self.enabled = enabled
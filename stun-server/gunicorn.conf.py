@@ -0,0 +1,37 @@
+# Production settings for the STUN server: gunicorn -c gunicorn.conf.py app:app
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+
+# Every worker is a separate process with its own Redis pool; they all share
+# one Redis, so any number of workers (or containers) can serve the registry
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# Threads let a worker hold long-polls and event streams open without blocking other requests
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+# Must stay above CHANGES_MAX_WAIT
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 0))
+
+accesslog = os.getenv('GUNICORN_ACCESSLOG', None)
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOGLEVEL', 'info')
+
+
+def post_fork(server, worker):
+    import app
+    # Every worker runs a sweeper; the Redis lock lets only one of them sweep at a time
+    app.start_sweeper()
+    app.start_metrics_publisher()
+    app.start_cache_invalidation()
+
+
+def worker_exit(server, worker):
+    import app
+    app.withdraw_metrics()
+    app.close_redis()
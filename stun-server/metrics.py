@@ -0,0 +1,151 @@
+#Minimal Prometheus text-format metrics (exposition format 0.0.4)
+#
+#Counters and histograms live in the process that records them. Under
+#gunicorn every worker has its own, so snapshot() / render(others=...) let a
+#worker add the latest snapshots published by its siblings to its own values.
+#Gauges registered with a callback are computed when /metrics is scraped.
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(k), v] for k, v in self.values.items()]
+
+    def merge(self, values, snapshot):
+        for labels, value in snapshot:
+            labels = tuple(labels)
+            values[labels] = values.get(labels, 0) + value
+
+    def samples(self, values):
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_labels(self.labels, labels)} {_number(value)}"
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (non-cumulative, last is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(k), list(counts), total] for k, (counts, total) in self.values.items()]
+
+    def merge(self, values, snapshot):
+        for labels, counts, total in snapshot:
+            labels = tuple(labels)
+            entry = values.setdefault(labels, [[0] * (len(self.buckets) + 1), 0.0])
+            for i, count in enumerate(counts[:len(entry[0])]):
+                entry[0][i] += count
+            entry[1] += total
+
+    def samples(self, values):
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.labels, labels, ('le', _number(bound)))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        # collect() returns {label values tuple: value}; it runs at scrape time
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.collect = collect
+
+    def samples(self, values):
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_labels(self.labels, labels)} {_number(value)}"
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def snapshot(self):
+        return {m.name: m.snapshot() for m in self.metrics if m.kind != 'gauge'}
+
+    def render(self, others=()):
+        lines = []
+        for metric in self.metrics:
+            if metric.kind == 'gauge':
+                try:
+                    values = metric.collect() if metric.collect else {}
+                except Exception:
+                    # A failing collector (e.g. Redis down) drops its gauge, not the scrape
+                    continue
+            else:
+                values = {}
+                metric.merge(values, metric.snapshot())
+                for other in others:
+                    metric.merge(values, other.get(metric.name, []))
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples(values))
+        return '\n'.join(lines) + '\n'
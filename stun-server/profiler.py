@@ -0,0 +1,85 @@
+#Sampling profiler for a running server process
+#
+#A background thread grabs every thread's stack with sys._current_frames()
+#at a fixed interval and counts identical stacks. The result is in the
+#"collapsed" format (frame;frame;frame count) that flamegraph.pl and
+#speedscope read. Nothing runs until start() is called.
+import collections
+import os
+import sys
+import threading
+import time
+
+class SamplingProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.interval = None
+        self.started = None
+        self.stopped = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval=0.005):
+        with self.lock:
+            if self.running:
+                return False
+            self.stacks = collections.Counter()
+            self.samples = 0
+            self.interval = interval
+            self.started = time.time()
+            self.stopped = None
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._sample_loop, name="sampling-profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        with self.lock:
+            thread = self.thread
+            if thread is None:
+                return False
+            self.stop_event.set()
+        thread.join()
+        self.stopped = time.time()
+        return True
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                self.samples += 1
+                for ident, frame in frames.items():
+                    if ident != own:
+                        self.stacks[self._collapse(frame)] += 1
+
+    @staticmethod
+    def _collapse(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def collapsed(self, limit=None):
+        with self.lock:
+            stacks = self.stacks.most_common(limit)
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def status(self):
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "samples": self.samples,
+            "distinct_stacks": len(self.stacks),
+            "started": self.started,
+            "stopped": self.stopped,
+            "pid": os.getpid()
+        }
@@ -0,0 +1,159 @@
+#STUN (RFC 5389) binding service: answers Binding Requests over UDP with the
+#sender's reflexive transport address (XOR-MAPPED-ADDRESS)
+import asyncio
+import argparse
+import ipaddress
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import zlib
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STUN_UDP_HOST = os.getenv('STUN_UDP_HOST', '0.0.0.0')
+STUN_UDP_PORT = int(os.getenv('STUN_UDP_PORT', 3478))
+STUN_UDP_WORKERS = int(os.getenv('STUN_UDP_WORKERS', 1))
+STUN_UDP_RCVBUF = int(os.getenv('STUN_UDP_RCVBUF', 4 * 1024 * 1024))
+
+MAGIC_COOKIE = 0x2112A442
+HEADER = struct.Struct('!HHI12s')
+ATTR_HEADER = struct.Struct('!HH')
+
+BINDING_REQUEST = 0x0001
+BINDING_SUCCESS = 0x0101
+
+ATTR_XOR_MAPPED_ADDRESS = 0x0020
+ATTR_SOFTWARE = 0x8022
+ATTR_FINGERPRINT = 0x8028
+FINGERPRINT_XOR = 0x5354554E
+
+SOFTWARE = b'p2p-stun'
+
+def parse_request(data):
+    # Returns the transaction ID of a well-formed Binding Request, otherwise None
+    if len(data) < HEADER.size:
+        return None
+    msg_type, length, cookie, txid = HEADER.unpack_from(data)
+    if msg_type != BINDING_REQUEST or cookie != MAGIC_COOKIE:
+        return None
+    if length % 4 or HEADER.size + length != len(data):
+        return None
+    return txid
+
+def xor_address(host, port, txid):
+    addr = ipaddress.ip_address(host)
+    xport = port ^ (MAGIC_COOKIE >> 16)
+    if addr.version == 4:
+        xaddr = struct.pack('!I', int(addr) ^ MAGIC_COOKIE)
+        family = 0x01
+    else:
+        mask = int.from_bytes(struct.pack('!I', MAGIC_COOKIE) + txid, 'big')
+        xaddr = (int(addr) ^ mask).to_bytes(16, 'big')
+        family = 0x02
+    return struct.pack('!BBH', 0, family, xport) + xaddr
+
+def attribute(attr_type, value):
+    padding = b'\x00' * (-len(value) % 4)
+    return ATTR_HEADER.pack(attr_type, len(value)) + value + padding
+
+def build_response(txid, host, port):
+    body = attribute(ATTR_XOR_MAPPED_ADDRESS, xor_address(host, port, txid))
+    body += attribute(ATTR_SOFTWARE, SOFTWARE)
+    # FINGERPRINT covers everything before it, with the length already including itself
+    header = HEADER.pack(BINDING_SUCCESS, len(body) + 8, MAGIC_COOKIE, txid)
+    crc = (zlib.crc32(header + body) ^ FINGERPRINT_XOR) & 0xFFFFFFFF
+    return header + body + attribute(ATTR_FINGERPRINT, struct.pack('!I', crc))
+
+class StunProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.requests = 0
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        txid = parse_request(data)
+        if txid is None:
+            # RFC 5389: silently discard anything that is not a valid request
+            self.dropped += 1
+            return
+        self.requests += 1
+        self.transport.sendto(build_response(txid, addr[0], addr[1]), addr)
+
+    def error_received(self, exc):
+        logger.warning("UDP error: %s", exc)
+
+def make_socket(host, port, reuse_port):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    if reuse_port:
+        # Several processes bind the same port and the kernel spreads datagrams across them
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, STUN_UDP_RCVBUF)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, STUN_UDP_RCVBUF)
+    except OSError:
+        pass
+    sock.bind((host, port))
+    sock.setblocking(False)
+    return sock
+
+async def serve(host, port, reuse_port=False):
+    loop = asyncio.get_running_loop()
+    sock = make_socket(host, port, reuse_port)
+    transport, protocol = await loop.create_datagram_endpoint(StunProtocol, sock=sock)
+    logger.info("STUN binding service listening on udp://%s:%d (pid %d)", host, port, os.getpid())
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        transport.close()
+        logger.info("STUN service stopping: %d requests answered, %d datagrams dropped",
+                    protocol.requests, protocol.dropped)
+
+def run_worker(host, port, reuse_port):
+    try:
+        asyncio.run(serve(host, port, reuse_port))
+    except KeyboardInterrupt:
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description='STUN binding service')
+    parser.add_argument('--host', default=STUN_UDP_HOST, help='Address to bind')
+    parser.add_argument('--port', type=int, default=STUN_UDP_PORT, help='UDP port')
+    parser.add_argument('--workers', type=int, default=STUN_UDP_WORKERS,
+                        help='Processes sharing the port through SO_REUSEPORT')
+    args = parser.parse_args()
+
+    if args.workers <= 1:
+        run_worker(args.host, args.port, False)
+        return
+
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(args.host, args.port, True))
+        for _ in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    def forward(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for worker in workers:
+        worker.join()
+
+if __name__ == '__main__':
+    main()
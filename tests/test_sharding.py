@@ -0,0 +1,182 @@
+#Peer directory spread over several Redis nodes (REDIS_SHARDS)
+#
+#Every node is an in-process fakeredis server (with Lua, for the server's
+#scripts); the meta node holding the version, change feed and legacy hash is
+#one more. Run from the repository root:  python -m pytest tests
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import fakeredis
+import pytest
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stun-server'))
+
+import app as registry
+
+NODES = ['10.0.0.1:6379', '10.0.0.2:6379', '10.0.0.3:6379']
+
+def fake_client(server):
+    pool = redis.ConnectionPool(connection_class=fakeredis.FakeRedisConnection, server=server,
+                                decode_responses=True)
+    return registry.MeteredRedis(connection_pool=pool)
+
+@pytest.fixture
+def client(monkeypatch):
+    registry.close_redis()
+    meta = fake_client(fakeredis.FakeServer())
+    clients = {'default': meta, 'stream': meta}
+    for index in range(len(NODES)):
+        clients[f'shard{index}'] = fake_client(fakeredis.FakeServer())
+    monkeypatch.setattr(registry, '_redis_clients', clients)
+    monkeypatch.setattr(registry, 'REDIS_SHARDS', NODES)
+    monkeypatch.setattr(registry, 'SHARD_RING', registry.HashRing(NODES))
+    yield registry.app.test_client()
+    registry.close_redis()
+
+def register(client, *usernames):
+    for i, username in enumerate(usernames):
+        response = client.post('/register', json={"username": username, "ip": "203.0.113.7", "port": 7000 + i})
+        assert response.status_code == 201
+
+def listed(client, **params):
+    # Every username of /peers, following next_cursor page by page
+    usernames, cursor = [], None
+    while True:
+        query = dict(params, **({"cursor": cursor} if cursor else {}))
+        page = client.get('/peers', query_string=query).get_json()
+        usernames += [peer['username'] for peer in page['peers']]
+        cursor = page['next_cursor']
+        if cursor is None:
+            return usernames
+
+def owners(usernames):
+    shards = registry.get_shards()
+    return {username: shards.index(registry.shard_for(shards, username)) for username in usernames}
+
+def test_adding_a_node_only_moves_keys_to_it():
+    keys = [f"user{i}" for i in range(10000)]
+    before = registry.HashRing(NODES)
+    after = registry.HashRing(NODES + ['10.0.0.4:6379'])
+    moved = [key for key in keys if before.node_for(key) != after.node_for(key)]
+    assert all(after.node_for(key) == 3 for key in moved)
+    assert 0.15 < len(moved) / len(keys) < 0.35
+
+def test_node_order_does_not_change_ownership():
+    ring = registry.HashRing(NODES)
+    reordered = registry.HashRing(NODES[::-1])
+    for i in range(1000):
+        key = f"user{i}"
+        assert NODES[ring.node_for(key)] == NODES[::-1][reordered.node_for(key)]
+
+def test_records_live_on_their_owner_only(client):
+    usernames = [f"peer{i:02d}" for i in range(40)]
+    register(client, *usernames)
+    shards = registry.get_shards()
+    for username, owner in owners(usernames).items():
+        for index, shard in enumerate(shards):
+            assert shard.exists(registry.peer_key(username)) == (index == owner)
+    assert set(owners(usernames).values()) == {0, 1, 2}
+
+def test_listing_merges_all_shards_in_order(client):
+    usernames = [f"peer{i:02d}" for i in range(40)]
+    register(client, *usernames)
+    for limit in (1, 7, 40, 100):
+        assert listed(client, limit=limit) == sorted(usernames)
+
+def test_listing_filters_across_shards(client):
+    register(client, *[f"al{i}" for i in range(12)], *[f"bo{i}" for i in range(12)])
+    assert listed(client, limit=5, prefix='al') == sorted(f"al{i}" for i in range(12))
+    assert listed(client, limit=5, prefix='bo', exclude='bo3') == sorted(f"bo{i}" for i in range(12) if i != 3)
+    assert listed(client, limit=5, status='online') == sorted(listed(client, limit=100))
+    assert listed(client, limit=5, status='offline') == []
+    # A cursor inside the prefix range resumes after it
+    page = client.get('/peers', query_string={"limit": 3, "prefix": 'al', "cursor": 'al3'}).get_json()
+    assert [peer['username'] for peer in page['peers']] == ['al4', 'al5', 'al6']
+
+def test_listing_skips_a_name_held_by_two_shards(client):
+    register(client, 'moving', 'other')
+    shards = registry.get_shards()
+    owner = owners(['moving'])['moving']
+    # Left behind on another node while records move after a resharding
+    shards[(owner + 1) % len(shards)].zadd(registry.PEERS_NAMES_KEY, {'moving': 0})
+    assert listed(client, limit=1) == ['moving', 'other']
+
+def test_peerinfo_batch_gathers_from_every_shard(client):
+    usernames = [f"peer{i:02d}" for i in range(12)]
+    register(client, *usernames)
+    response = client.post('/peerinfo/batch', json={"usernames": usernames + ['missing']}).get_json()
+    assert sorted(response['peers']) == usernames
+    assert response['missing'] == ['missing']
+
+def test_heartbeat_spans_shards(client):
+    usernames = [f"peer{i:02d}" for i in range(12)]
+    register(client, *usernames)
+    response = client.post('/heartbeat', json={"usernames": usernames + ['missing']}).get_json()
+    assert sorted(response['alive']) == usernames
+    assert response['unknown'] == ['missing']
+    for username, owner in owners(usernames).items():
+        score = registry.get_shards()[owner].zscore(registry.PEERS_INDEX_KEY, username)
+        assert score == pytest.approx(time.time(), abs=5)
+
+def test_heartbeat_restores_a_swept_live_peer(client):
+    register(client, 'bob')
+    shard = registry.shard_for(registry.get_shards(), 'bob')
+    # Swept by a server whose clock runs ahead while bob's record is still alive
+    shard.zadd(registry.PEERS_INDEX_KEY, {'bob': time.time() - registry.PEER_TTL - 60})
+    assert registry.sweep_stale_peers(registry.get_redis(), registry.get_shards()) == ['bob']
+    assert listed(client) == []
+    assert client.post('/heartbeat', json={"username": 'bob'}).get_json()['alive'] == ['bob']
+    assert listed(client) == ['bob']
+
+def test_unregister_removes_from_the_owning_shard(client):
+    usernames = [f"peer{i:02d}" for i in range(12)]
+    register(client, *usernames)
+    gone = usernames[::3]
+    for username in gone:
+        assert client.post('/unregister', json={"username": username}).status_code == 200
+    response = client.post('/unregister/batch', json={"usernames": usernames[1::3] + ['missing']}).get_json()
+    assert response['removed'] == len(usernames[1::3])
+    assert response['results'][-1] == {"username": 'missing', "status": 'not_found'}
+    assert listed(client) == usernames[2::3]
+    for username in gone:
+        assert client.get('/peerinfo', query_string={"username": username}).status_code == 404
+
+def test_sweep_drops_stale_peers_on_every_shard(client):
+    usernames = [f"peer{i:02d}" for i in range(30)]
+    register(client, *usernames)
+    shards = registry.get_shards()
+    stale = usernames[::2]
+    for username, owner in owners(stale).items():
+        shards[owner].zadd(registry.PEERS_INDEX_KEY, {username: time.time() - registry.PEER_TTL - 1})
+    assert len({owners(stale)[u] for u in stale}) > 1
+    removed = registry.sweep_stale_peers(registry.get_redis(), shards)
+    assert sorted(removed) == stale
+    assert listed(client) == usernames[1::2]
+    events = client.get('/peers/changes', query_string={"since": '0-0'}).get_json()['events']
+    assert sorted(e['username'] for e in events if e['type'] == 'left') == stale
+
+def test_legacy_hash_migrates_onto_the_ring(client):
+    meta = registry.get_redis()
+    now = time.time()
+    fresh = [f"old{i}" for i in range(10)]
+    for i, username in enumerate(fresh + ['expired']):
+        seen = now - 30 if username != 'expired' else now - registry.PEER_TTL - 30
+        meta.hset(registry.LEGACY_PEERS_KEY, username, json.dumps({
+            "username": username, "ip": "198.51.100.1", "port": 6000 + i,
+            "last_seen": datetime.fromtimestamp(seen).isoformat(), "status": "online"
+        }))
+    assert registry.migrate_legacy_peers(meta, registry.get_shards()) == len(fresh)
+    assert not meta.exists(registry.LEGACY_PEERS_KEY)
+    shards = registry.get_shards()
+    for username, owner in owners(fresh).items():
+        for index, shard in enumerate(shards):
+            assert shard.exists(registry.peer_key(username)) == (index == owner)
+    assert listed(client) == sorted(fresh)
+    peer = client.get('/peerinfo', query_string={"username": 'old3'}).get_json()['peer']
+    assert (peer['ip'], peer['port']) == ("198.51.100.1", 6003)
+    # Running it again (another worker starting) finds nothing left to move
+    assert registry.migrate_legacy_peers(meta, shards) == 0